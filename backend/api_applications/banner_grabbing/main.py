@@ -1,6 +1,8 @@
 import logging
 
-from . import banner_counsumer
+from shared_libs import change_stream
+
+from . import banner_counsumer, db_operations
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -8,6 +10,12 @@ logging.basicConfig(
 
 
 def main():
+    if change_stream.uses_change_streams():
+        change_stream.StreamConsumer(
+            "banner_grabbing",
+            change_stream.fields_changed(["ports", "last_update"], project=["ports"]),
+            db_operations.update_banners,
+        ).run()
     while True:
         banner_counsumer.get_batches()
         # db_operations.update_banners()
@@ -9,6 +9,7 @@ PLAN_DEFS = [
     "description": "Free plan with limited scans and queries for testing.",
     "scan_limit": 100,
     "query_limit": 100,
+    "bulk_scan_limit": 10,
     "api_call_limit": 1000,
     "duration_days": 30,
     "is_active": True,
@@ -26,6 +27,7 @@ PLAN_DEFS = [
     "description": "Entry-level paid plan with higher limits and improved accuracy.",
     "scan_limit": 1000,
     "query_limit": 2000,
+    "bulk_scan_limit": 100,
     "api_call_limit": 5000,
     "duration_days": 30,
     "is_active": True,
@@ -43,6 +45,7 @@ PLAN_DEFS = [
     "description": "Professional plan with larger scan limits, advanced accuracy, and priority scanning.",
     "scan_limit": 10000,
     "query_limit": 20000,
+    "bulk_scan_limit": 1000,
     "api_call_limit": 50000,
     "duration_days": 30,
     "is_active": True,
@@ -60,6 +63,7 @@ PLAN_DEFS = [
     "description": "Top-tier plan with maximum limits, enterprise-grade accuracy, and full feature set.",
     "scan_limit": 100000,
     "query_limit": 200000,
+    "bulk_scan_limit": 10000,
     "api_call_limit": 1000000,
     "duration_days": 30,
     "is_active": True,
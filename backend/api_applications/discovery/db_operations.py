@@ -2,7 +2,7 @@ import logging
 import time
 from pymongo import UpdateOne
 
-from shared_libs import monogo_connections
+from shared_libs import host_cache, ip_ranges, mongo_indexes, monogo_connections
 
 
 def check_connection():
@@ -17,6 +17,15 @@ def check_connection():
             time.sleep(3)
 
 
+def check_indexes():
+    try:
+        db = monogo_connections.connect_monogo()
+        return mongo_indexes.check_indexes(db.scan_results)
+    except Exception as e:
+        logging.error(f"[db_operation.py] ERROR: Failed to check indexes : {e}")
+        return []
+
+
 def insert_many_scan_result(data: list):
 
     try:
@@ -57,6 +66,7 @@ def update_scan_result(data: list):
                     {
                         "$set": {
                             "ports": doc["ports"],
+                            "ip_num": ip_ranges.ip_to_int(doc["_id"]),
                             "last_update": doc["last_update"]
                         },
                         "$unset": {
@@ -64,6 +74,8 @@ def update_scan_result(data: list):
                             "general": "",
                             "domain": "",
                             "service_type": "",
+                            "banner_tokens": "",
+                            "banner_text": "",
                             "vulnerability": "",
                         },
                     },
@@ -72,6 +84,7 @@ def update_scan_result(data: list):
             )
         if operations:
             result = db.scan_results.bulk_write(operations, ordered=False)
+            host_cache.cache.invalidate(doc["_id"] for doc in data)
             logging.info(f"Flushed {len(operations)} updates in one batch to db")
         return True
     except Exception as e:
@@ -79,7 +92,7 @@ def update_scan_result(data: list):
         return None
 
 
-def find_down_ips():
+def find_down_ips(networks=None):
     try:
 
         db = monogo_connections.connect_monogo()
@@ -87,7 +100,11 @@ def find_down_ips():
             logging.error(
                 "Cannot connect to MongoDB: connect_monogo() returned None")
             return None
-        results = db.scan_results.find({"ports": []})
+        query = {"ports": []}
+        if networks:
+            # each network is one contiguous range of the ip_num index
+            query.update(ip_ranges.networks_query(networks))
+        results = db.scan_results.find(query)
         down_ips = list(results)
         logging.info(down_ips)
         return down_ips
@@ -7,9 +7,12 @@ import os
 
 from . import port_scanner
 from . import db_operations
+from shared_libs import change_stream, ip_ranges
 from shared_models.schema import ScanResult
 from . import discovery_producer
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "2"))
+# optional comma-separated CIDRs the unresponsive-host rescan is limited to
+RESCAN_NETWORKS = [n for n in os.getenv("RESCAN_NETWORKS", "").split(",") if n]
 
 
 logging.basicConfig(
@@ -24,6 +27,15 @@ def generate_public_ipv4_ranges_stream(cidr_prefix=24):
             yield str(subnet)
 
 
+def publish_batches(batch):
+    # in change stream mode the next stages follow scan_results themselves
+    if change_stream.uses_change_streams():
+        return
+    discovery_producer.send_banner_batches(batch)
+    logging.info(f"Sending enrich batch: {batch}")
+    discovery_producer.send_enrich_batches(batch)
+
+
 def daily_scan():
     from . import db_operations
     insert_batch = []
@@ -40,7 +52,8 @@ def daily_scan():
                     update_batch.append(scan_data)
                 else:
                     scan_result = ScanResult(
-                        _id=ip, ports=ports, last_update=now)
+                        _id=ip, ip_num=ip_ranges.ip_to_int(ip),
+                        ports=ports, last_update=now)
 
                     insert_batch.append(scan_result.model_dump(
                         by_alias=True, exclude_none=True))
@@ -50,8 +63,7 @@ def daily_scan():
                     if insert_batch:
                         try:
                             db_operations.insert_many_scan_result(insert_batch)
-                            discovery_producer.send_banner_batches(insert_batch)
-                            discovery_producer.send_enrich_batches(insert_batch)
+                            publish_batches(insert_batch)
                             logging.info(
                                 f"Flushed {len(insert_batch)} documents to disk")
                             insert_batch = []
@@ -64,9 +76,7 @@ def daily_scan():
                             logging.info(
                                 f"scanner.py data looks like{update_batch}")
                             db_operations.update_scan_result(update_batch)
-                            discovery_producer.send_banner_batches(update_batch)
-                            logging.info(f"Sending enrich batch: {update_batch}")
-                            discovery_producer.send_enrich_batches(update_batch)
+                            publish_batches(update_batch)
 
 
                             logging.info(
@@ -96,9 +106,9 @@ def rescan_unresponsive():
     from . import db_operations
     update_batch = []
     while True:
-        down_ips = db_operations.find_down_ips()
+        down_ips = db_operations.find_down_ips(RESCAN_NETWORKS)
         if down_ips:
-            for i in db_operations.find_down_ips():
+            for i in down_ips:
                 result = port_scanner.scan_ports(i["_id"])
                 now = datetime.now()
                 update_data = {
@@ -123,6 +133,7 @@ def rescan_unresponsive():
 
 if __name__ == "__main__":
     db_operations.check_connection()
+    db_operations.check_indexes()
     t1 = threading.Thread(target=daily_scan, name="DailyScanThread")
     t2 = threading.Thread(target=rescan_unresponsive,
                           name="RescanUnresponsiveThread")
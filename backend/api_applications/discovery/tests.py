@@ -8,6 +8,7 @@ parent_dir = os.path.dirname(current_dir)
 sys.path.append(current_dir)
 sys.path.append(parent_dir)
 
+from discovery import db_operations
 from discovery import port_scanner
 from discovery import scanner
 class test(unittest.TestCase):
@@ -31,6 +32,17 @@ class test(unittest.TestCase):
             self.assertIsInstance(subnet, str)
             self.assertIn("/", subnet)
 
+    @patch("discovery.db_operations.monogo_connections.connect_monogo")
+    def test_find_down_ips_scoped_to_networks(self, mock_connect):
+        find = mock_connect.return_value.scan_results.find
+        find.return_value = [{"_id": "10.0.0.5", "ports": []}]
+
+        down = db_operations.find_down_ips(["10.0.0.0/24"])
+
+        find.assert_called_once_with(
+            {"ports": [], "ip_num": {"$gte": 167772160, "$lt": 167772416}})
+        self.assertEqual(down, [{"_id": "10.0.0.5", "ports": []}])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,58 +1,112 @@
 import logging
-from pymongo import UpdateOne
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from shared_libs import monogo_connections
+from shared_libs import write_buffer
 
 from . import dns_reverse, finger_print, geo_info
 from shared_models import schema
 
+# Each sub-stage gets its own pool so a slow provider only holds up its own
+# lookups; the limits keep nmap and ip-api from being hammered.
+FINGER_PRINT_WORKERS = int(os.getenv("ENRICH_FINGER_PRINT_WORKERS", "4"))
+GEO_WORKERS = int(os.getenv("ENRICH_GEO_WORKERS", "8"))
+DNS_WORKERS = int(os.getenv("ENRICH_DNS_WORKERS", "16"))
+SUB_STAGE_TIMEOUT = float(os.getenv("ENRICH_SUB_STAGE_TIMEOUT", "120"))
+
+
+# Long-lived, so a lookup still stuck from an earlier batch keeps holding
+# its worker and the limits above apply across batches.
+_executors = {
+    name: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+    for name, workers in (
+        ("finger_print", FINGER_PRINT_WORKERS),
+        ("general", GEO_WORKERS),
+        ("domain", DNS_WORKERS),
+    )
+}
+
+
+def _sub_stages():
+    # resolved at call time so the lookups can be patched in tests
+    return {
+        "finger_print": finger_print.os_finger_print,
+        "general": geo_info.geo_info,
+        "domain": dns_reverse.get_domain,
+    }
+
+
+def _collect(name, futures, deadline):
+    results = {}
+    done, not_done = wait(futures, timeout=max(0, deadline - time.monotonic()))
+    for future in done:
+        ip = futures[future]
+        try:
+            results[ip] = future.result()
+        except Exception as e:
+            logging.error(f"{name} lookup failed for {ip}: {e}")
+    for future in not_done:
+        future.cancel()
+        logging.warning(f"{name} lookup timed out for {futures[future]}")
+    return results
+
+
+def run_sub_stages(ips):
+    """Run fingerprint, geo and DNS lookups for the whole batch concurrently.
+
+    Returns {sub_stage: {ip: result}}; an ip missing from a sub-stage means
+    that lookup failed or did not finish before SUB_STAGE_TIMEOUT. The
+    timeout only bounds the wait: lookups that have not started are
+    cancelled, running ones finish in the background on their pool.
+    """
+    submitted = {
+        name: {_executors[name].submit(func, ip): ip for ip in ips}
+        for name, func in _sub_stages().items()
+    }
+    deadline = time.monotonic() + SUB_STAGE_TIMEOUT
+    return {
+        name: _collect(name, futures, deadline)
+        for name, futures in submitted.items()
+    }
+
 
 def update_enrichment(results):
 
     try:
 
-        db = monogo_connections.connect_monogo()
-        operations = []
+        updates = {}
+
+        ips = [i["_id"] for i in results]
+        logging.info(f"enriching batch of {len(ips)} hosts")
+        lookups = run_sub_stages(ips)
 
-        for i in results:
+        for ip in ips:
             try:
-                logging.info(f"getting OS finger print of : {i}")
-                f_p = finger_print.os_finger_print(i["_id"])
-                g_l = geo_info.geo_info(i["_id"])
-                domain = dns_reverse.get_domain(i["_id"])
-                finger_print_model = schema.FingerPrintInfo(**f_p)
-                general_model = schema.GeneralInfo(**g_l)
+                f_p = lookups["finger_print"].get(ip)
+                g_l = lookups["general"].get(ip)
+                domain = lookups["domain"].get(ip)
                 update_fields = {}
-                if finger_print_model:
-                    update_fields["finger_print"] = finger_print_model.dict()
-                if general_model:
-                    update_fields["general"] = general_model.dict()
+                if f_p:
+                    update_fields["finger_print"] = schema.FingerPrintInfo(
+                        **f_p).dict()
+                if g_l:
+                    update_fields["general"] = schema.GeneralInfo(**g_l).dict()
                 if domain:
                     update_fields["domain"] = domain
+                if not update_fields:
+                    continue
                 logging.info(
-                    f"Updating {i['_id']} with f_p={f_p}, g_l={g_l}, domain={domain}"
-                )
-                # db.scan_results.update_one(
-                #     {"_id": i["_id"]},
-                #     {"$set": update_fields},
-                # )
-                operations.append(
-                    UpdateOne(
-                        {"_id": i["_id"]},
-                        {
-                            "$set": update_fields
-                                
-                        },
-                        upsert=True,
-                    )
+                    f"Updating {ip} with f_p={f_p}, g_l={g_l}, domain={domain}"
                 )
+                updates[ip] = (update_fields, {})
             except Exception as e:
                 logging.error(
-                    f"Failed enrichment for {i['_id']}: {e}", exc_info=True)
+                    f"Failed enrichment for {ip}: {e}", exc_info=True)
 
-        if operations:
-            result = db.scan_results.bulk_write(operations, ordered=False)
-            logging.info(f"Flushed {operations}\n updates in one batch to db")
+        if updates:
+            write_buffer.buffer.add_many(updates)
+            logging.info(f"Staged {len(updates)} enrichment updates")
 
     except Exception as e:
         logging.error(f"Operation do not complete in enrichs : {e}")
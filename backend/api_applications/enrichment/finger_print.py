@@ -1,9 +1,10 @@
 import nmap
 
 
-scanner = nmap.PortScanner()
-
 def os_finger_print(target, arguments="-O"):
+    # PortScanner keeps the last result on the instance, so each lookup gets
+    # its own scanner to stay safe when the batch runs on a thread pool
+    scanner = nmap.PortScanner()
     scanner.scan(target, arguments=arguments)
 
     if "osmatch" in scanner[target]:
@@ -22,4 +23,4 @@ def os_finger_print(target, arguments="-O"):
                 }
 
             else:
-                return {"os_match": {match["name"]}, "accuracy": {match["accuracy"]}}
+                return {"os_match": match["name"], "accuracy": match["accuracy"]}
@@ -1,11 +1,16 @@
+import os
+
 import requests
 
+GEO_TIMEOUT = float(os.getenv("ENRICH_GEO_TIMEOUT", "10"))
+
 
 def geo_info(ip):
-    resp = requests.get(f"http://ip-api.com/json/{ip}").json()
+    resp = requests.get(f"http://ip-api.com/json/{ip}", timeout=GEO_TIMEOUT).json()
     return {
         "geo": {
             "country": resp["country"],
+            "countrycode": resp.get("countryCode"),
             "city": resp["city"],
             "regionname": resp["regionName"],
             "latlang": [resp["lat"], resp["lon"]],
@@ -1,8 +1,16 @@
-from . import enrich_counsumer
+from shared_libs import change_stream
+
+from . import db_operations, enrich_counsumer
 
 
 def main():
 
+    if change_stream.uses_change_streams():
+        change_stream.StreamConsumer(
+            "enrichment",
+            change_stream.fields_changed(["ports", "last_update"], project=["ports"]),
+            db_operations.update_enrichment,
+        ).run()
     while (True):
         enrich_counsumer.get_batches()
 
@@ -1,14 +1,21 @@
+import os
+import sys
 import unittest
 from unittest.mock import patch, MagicMock
 
-import finger_print
-import geo_info
-import dns_reverse
-import db_operations
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+
+sys.path.append(parent_dir)
+
+from enrichment import finger_print
+from enrichment import geo_info
+from enrichment import dns_reverse
+from enrichment import db_operations
 
 
 class TestFingerPrint(unittest.TestCase):
-    @patch('finger_print.nmap.PortScanner')
+    @patch('enrichment.finger_print.nmap.PortScanner')
     def test_os_finger_print_with_osclass(self, mock_portscanner):
         mock_scan = MagicMock()
         mock_osclass = {
@@ -35,7 +42,7 @@ class TestFingerPrint(unittest.TestCase):
         self.assertEqual(result["os_Gen"], "5.X")
         self.assertEqual(result["vendor"], "Debian")
 
-    @patch('finger_print.nmap.PortScanner')
+    @patch('enrichment.finger_print.nmap.PortScanner')
     def test_os_finger_print_without_osclass(self, mock_portscanner):
         mock_scan = MagicMock()
         mock_scan.__getitem__.return_value = {
@@ -52,11 +59,12 @@ class TestFingerPrint(unittest.TestCase):
 
 
 class TestGeoInfo(unittest.TestCase):
-    @patch('geo_info.requests.get')
+    @patch('enrichment.geo_info.requests.get')
     def test_geo_info(self, mock_get):
         mock_response = MagicMock()
         mock_response.json.return_value = {
             "country": "United States",
+            "countryCode": "US",
             "city": "Mountain View",
             "regionName": "California",
             "lat": 37.386,
@@ -70,6 +78,7 @@ class TestGeoInfo(unittest.TestCase):
         result = geo_info.geo_info("8.8.8.8")
         self.assertIn("geo", result)
         self.assertEqual(result["geo"]["country"], "United States")
+        self.assertEqual(result["geo"]["countrycode"], "US")
         self.assertEqual(result["geo"]["city"], "Mountain View")
         self.assertEqual(result["geo"]["regionname"], "California")
         self.assertEqual(result["geo"]["latlang"], [37.386, -122.0838])
@@ -79,13 +88,13 @@ class TestGeoInfo(unittest.TestCase):
 
 
 class TestDNSReverse(unittest.TestCase):
-    @patch('dns_reverse.socket.gethostbyaddr')
+    @patch('enrichment.dns_reverse.socket.gethostbyaddr')
     def test_get_domain_success(self, mock_gethostbyaddr):
         mock_gethostbyaddr.return_value = ("example.com", [], [])
         domain = dns_reverse.get_domain("8.8.8.8")
         self.assertEqual(domain, "example.com")
 
-    @patch('dns_reverse.socket.gethostbyaddr')
+    @patch('enrichment.dns_reverse.socket.gethostbyaddr')
     def test_get_domain_failure(self, mock_gethostbyaddr):
         mock_gethostbyaddr.side_effect = dns_reverse.socket.herror
         domain = dns_reverse.get_domain("255.255.255.255")
@@ -93,10 +102,10 @@ class TestDNSReverse(unittest.TestCase):
 
 
 class TestDBOperations(unittest.TestCase):
-    @patch('db_operations.monogo_connections.connect_monogo')
-    @patch('db_operations.finger_print.os_finger_print')
-    @patch('db_operations.geo_info.geo_info')
-    @patch('db_operations.dns_reverse.get_domain')
+    @patch('enrichment.db_operations.write_buffer.monogo_connections.connect_monogo')
+    @patch('enrichment.db_operations.finger_print.os_finger_print')
+    @patch('enrichment.db_operations.geo_info.geo_info')
+    @patch('enrichment.db_operations.dns_reverse.get_domain')
     def test_update_enrichment(
         self, mock_get_domain, mock_geo_info, mock_fp, mock_connect_monogo
     ):
@@ -104,25 +113,67 @@ class TestDBOperations(unittest.TestCase):
         mock_coll = MagicMock()
         mock_db.scan_results = mock_coll
         mock_connect_monogo.return_value = mock_db
-        mock_coll.find.return_value = [
-            {
-                "_id": "1.2.3.4",
-                "ports": [22, 80]
-            }
-        ]
         mock_fp.return_value = {"os_match": "Test OS"}
-        mock_geo_info.return_value = {"geo": {"country": "Testland"}}
+        mock_geo_info.return_value = {
+            "geo": {"country": "Testland", "city": None,
+                    "regionname": None, "latlang": None},
+            "isp": None, "organization": None, "asn": None,
+        }
         mock_get_domain.return_value = "test.domain"
 
-        db_operations.update_enrichment()
-        mock_coll.update_one.assert_called_with(
-            {"_id": "1.2.3.4"},
-            {"$set": {
-                "finger_print": {"os_match": "Test OS"},
-                "general": {"geo": {"country": "Testland"}},
-                "domain": "test.domain"
-            }}
-        )
+        db_operations.update_enrichment([{"_id": "1.2.3.4", "ports": [22, 80]}])
+        db_operations.write_buffer.buffer.flush()
+
+        operations = mock_coll.bulk_write.call_args[0][0]
+        self.assertEqual(len(operations), 1)
+        update = operations[0]._doc["$set"]
+        self.assertEqual(update["finger_print"]["os_match"], "Test OS")
+        self.assertEqual(update["general"]["geo"]["country"], "Testland")
+        self.assertEqual(update["domain"], "test.domain")
+
+    @patch('enrichment.db_operations.SUB_STAGE_TIMEOUT', 0.2)
+    @patch('enrichment.db_operations.finger_print.os_finger_print')
+    @patch('enrichment.db_operations.geo_info.geo_info')
+    @patch('enrichment.db_operations.dns_reverse.get_domain')
+    def test_slow_sub_stage_only_drops_its_field(
+        self, mock_get_domain, mock_geo_info, mock_fp
+    ):
+        import time
+
+        mock_fp.side_effect = lambda ip: time.sleep(1)
+        mock_geo_info.side_effect = Exception("provider down")
+        mock_get_domain.side_effect = lambda ip: f"host-{ip}"
+
+        started = time.monotonic()
+        lookups = db_operations.run_sub_stages(["1.1.1.1", "2.2.2.2"])
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(lookups["finger_print"], {})
+        self.assertEqual(lookups["general"], {})
+        self.assertEqual(lookups["domain"]["2.2.2.2"], "host-2.2.2.2")
+
+    @patch('enrichment.db_operations.SUB_STAGE_TIMEOUT', 0.1)
+    @patch('enrichment.db_operations.finger_print.os_finger_print')
+    @patch('enrichment.db_operations.geo_info.geo_info')
+    @patch('enrichment.db_operations.dns_reverse.get_domain')
+    def test_stuck_lookups_keep_their_pool_limit(
+        self, mock_get_domain, mock_geo_info, mock_fp
+    ):
+        import threading
+
+        release = threading.Event()
+        mock_fp.side_effect = lambda ip: release.wait(5)
+        mock_geo_info.return_value = None
+        mock_get_domain.return_value = None
+        try:
+            for batch in range(3):
+                db_operations.run_sub_stages(
+                    [f"10.0.{batch}.{n}" for n in range(10)])
+            threads = [t for t in threading.enumerate()
+                       if t.name.startswith("finger_print")]
+            self.assertLessEqual(len(threads), db_operations.FINGER_PRINT_WORKERS)
+        finally:
+            release.set()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,54 @@
+import os
+
+from pymongo import UpdateOne
+
+from api_applications.shared_libs import mongo_indexes
+from api_applications.shared_libs.mongo_fetch_result import get_collection
+
+
+def add_arguments(parser, batch_size=1000):
+    parser.add_argument("--batch-size", type=int, default=batch_size)
+    parser.add_argument(
+        "--collection", default=os.getenv("MONGO_COLLECTION", "scan_results"))
+    parser.add_argument("--dry-run", action="store_true")
+
+
+def backfill(command, options, query, projection, update, skipped_label="skipped"):
+    """Set derived fields on the scan_results documents missing them, then index.
+
+    query matches those documents and projection is what update(doc)
+    reads; update returns the fields to $set, or None to skip the
+    document. Updated documents stop matching query, so an interrupted run
+    picks up where it stopped. Returns the number of documents updated.
+    """
+    collection = get_collection(options["collection"])
+    batch_size, dry_run = options["batch_size"], options["dry_run"]
+
+    def flush(operations):
+        if dry_run:
+            return len(operations)
+        result = collection.bulk_write(operations, ordered=False)
+        command.stdout.write(f"{result.modified_count} documents updated")
+        return result.modified_count
+
+    operations, updated, skipped = [], 0, 0
+    for doc in collection.find(query, projection, batch_size=batch_size):
+        fields = update(doc)
+        if fields is None:
+            skipped += 1
+            continue
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+        if len(operations) >= batch_size:
+            updated += flush(operations)
+            operations = []
+    if operations:
+        updated += flush(operations)
+
+    if not dry_run:
+        mongo_indexes.ensure_indexes(collection)
+
+    summary = f"{updated} documents backfilled"
+    if skipped:
+        summary += f", {skipped} {skipped_label}"
+    command.stdout.write(command.style.SUCCESS(summary))
+    return updated
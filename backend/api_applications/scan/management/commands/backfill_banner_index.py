@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from api_applications.shared_libs import banner_index
+
+from ._backfill import add_arguments, backfill
+
+
+class Command(BaseCommand):
+    help = "Backfill the banner search fields of scan_results and index them"
+
+    def add_arguments(self, parser):
+        add_arguments(parser)
+
+    def handle(self, *args, **options):
+        backfill(
+            self, options,
+            # hosts with banners that were never tokenized
+            query={
+                "service_type": {"$type": "object"},
+                banner_index.TOKENS_FIELD: {"$exists": False},
+            },
+            projection={"service_type": 1},
+            update=lambda doc: banner_index.banner_fields(doc["service_type"]),
+        )
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from api_applications.shared_libs.ip_ranges import IP_FIELD, ip_to_int
+
+from ._backfill import add_arguments, backfill
+
+
+def ip_num_fields(doc):
+    value = ip_to_int(doc["_id"])
+    return None if value is None else {IP_FIELD: value}
+
+
+class Command(BaseCommand):
+    help = "Backfill the numeric ip_num field of scan_results and index it"
+
+    def add_arguments(self, parser):
+        add_arguments(parser, batch_size=5000)
+
+    def handle(self, *args, **options):
+        backfill(
+            self, options,
+            query={IP_FIELD: {"$exists": False}},
+            projection={"_id": 1},
+            update=ip_num_fields,
+            skipped_label="without an IPv4 _id skipped",
+        )
@@ -0,0 +1,43 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from api_applications.search.facets import FACET_COLLECTION, FACET_INDEXES
+from api_applications.shared_libs import mongo_indexes
+from api_applications.shared_libs.mongo_fetch_result import get_collection
+
+
+class Command(BaseCommand):
+    help = "Create the declared scan_results and facet indexes and report their usage"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--collection", default=os.getenv("MONGO_COLLECTION", "scan_results"))
+        parser.add_argument(
+            "--check", action="store_true", help="only report, create nothing")
+
+    def handle(self, *args, **options):
+        collection = get_collection(options["collection"])
+        declared = mongo_indexes.declared_names()
+
+        for target, indexes in (
+            (collection, mongo_indexes.SCAN_RESULTS_INDEXES),
+            (get_collection(FACET_COLLECTION), FACET_INDEXES),
+        ):
+            if options["check"]:
+                for name in mongo_indexes.missing_indexes(target, indexes):
+                    self.stdout.write(self.style.WARNING(f"missing: {name}"))
+            else:
+                for name in mongo_indexes.ensure_indexes(target, indexes):
+                    self.stdout.write(self.style.SUCCESS(f"created: {name}"))
+
+        for name, ops in sorted(mongo_indexes.index_usage(collection).items()):
+            if name == "_id_":
+                continue
+            if name not in declared:
+                self.stdout.write(self.style.WARNING(
+                    f"undeclared: {name} ({ops} ops)"))
+            elif ops == 0:
+                self.stdout.write(self.style.WARNING(f"unused: {name}"))
+            else:
+                self.stdout.write(f"ok: {name} ({ops} ops)")
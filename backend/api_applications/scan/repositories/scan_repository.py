@@ -1,4 +1,4 @@
-from api_applications.shared_models.models.scan import Scan, ScanHistory
+from api_applications.shared_models.models.scan import Scan, ScanHistory, ScanJob
 from django.utils import timezone
 
 
@@ -20,3 +20,20 @@ class ScanRepository:
         scan.updated_at = timezone.now()
         scan.save()
         return scan
+
+    @staticmethod
+    def create_job(user, target_count):
+        return ScanJob.objects.create(user=user, target_count=target_count)
+
+    @staticmethod
+    def bulk_create_scans(scans):
+        return Scan.objects.bulk_create(scans)
+
+    @staticmethod
+    def bulk_update_scans(scans, fields):
+        # bulk_update skips auto_now, so callers set updated_at themselves
+        return Scan.objects.bulk_update(scans, fields)
+
+    @staticmethod
+    def bulk_log_history(entries):
+        return ScanHistory.objects.bulk_create(entries)
@@ -63,3 +63,9 @@ class ScanSearchSerializer(serializers.Serializer):
     limit = serializers.IntegerField(
         min_value=1, max_value=100, required=False, default=20
     )
+
+
+class BulkScanSerializer(serializers.Serializer):
+    targets = serializers.ListField(
+        child=serializers.CharField(max_length=64), allow_empty=False
+    )
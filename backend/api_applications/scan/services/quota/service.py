@@ -1,4 +1,9 @@
-from .strategies import ScanQuotaStrategy, QueryQuotaStrategy, ReportQuotaStrategy
+from .strategies import (
+    QueryQuotaStrategy,
+    ReportQuotaStrategy,
+    ScanBatchQuotaStrategy,
+    ScanQuotaStrategy,
+)
 
 
 class QuotaService:
@@ -6,6 +11,7 @@ class QuotaService:
         "scan": ScanQuotaStrategy(),
         "query": QueryQuotaStrategy(),
         "report": ReportQuotaStrategy(),
+        "scan_batch": ScanBatchQuotaStrategy(),
     }
 
     @classmethod
@@ -29,6 +29,24 @@ class QueryQuotaStrategy(QuotaStrategy):
         )
 
 
+class ScanBatchQuotaStrategy(QuotaStrategy):
+    """Reserve count scans and count queries in one conditional UPDATE."""
+
+    def consume(self, user, count=1) -> bool:
+        return (
+            Subscription.objects.filter(
+                user=user,
+                end_date__gte=timezone.now(),
+                plan__scan_limit__gte=F("scans_used") + count,
+                plan__query_limit__gte=F("queries_used") + count,
+            ).update(
+                scans_used=F("scans_used") + count,
+                queries_used=F("queries_used") + count,
+            )
+            > 0
+        )
+
+
 # Example: Report downloads, just for demo
 class ReportQuotaStrategy(QuotaStrategy):
     def consume(self, user, count=1) -> bool:
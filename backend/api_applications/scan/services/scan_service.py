@@ -1,10 +1,16 @@
 import ipaddress
 import logging
+import os
+from datetime import datetime, timedelta
 
 from api_applications.scan.repositories.scan_repository import ScanRepository
 from api_applications.scan.services.quota.service import QuotaService
-from api_applications.shared_libs.mongo_fetch_result import fetch_by_ip
+from api_applications.shared_libs.mongo_fetch_result import (
+    fetch_by_ip,
+    fetch_many_by_ip,
+)
 from billing.management.commands.seed_memberships import PLAN_DEFS
+from django.db import transaction
 from django.utils import timezone
 
 from api_applications.scan.services.subscription_service import (
@@ -13,6 +19,92 @@ from api_applications.scan.services.subscription_service import (
 
 logger = logging.getLogger(__name__)
 
+# scans one bulk_scan celery task runs
+BULK_SCAN_TASK_CHUNK = int(os.getenv("BULK_SCAN_TASK_CHUNK", "100"))
+
+# host data younger than this is returned without queueing a live scan
+FAST_PATH_MAX_AGE = int(os.getenv("SCAN_FAST_PATH_MAX_AGE", "86400"))
+
+# a job scan no worker has touched for this long is given up as failed
+SCAN_PENDING_TIMEOUT = int(os.getenv("SCAN_PENDING_TIMEOUT", "3600"))
+
+# Scan field -> path of the value in the scan_results document
+SCAN_FIELD_MAP = {
+    "country": "general.geo.country",
+    "city": "general.geo.city",
+    "region": "general.geo.regionname",
+    "latitude": "general.geo.latlang.0",
+    "longitude": "general.geo.latlang.1",
+    "domain": "domain",
+    "organization": "general.organization",
+    "isp": "general.isp",
+    "asn": "general.asn",
+}
+# only what the mapping reads is fetched from Mongo
+SCAN_PROJECTION = ["ports", "last_update", "general", "domain"]
+# a scan answered in the request also shows the CVEs of the host
+SCAN_RESULT_PROJECTION = [*SCAN_PROJECTION, "vulnerability"]
+
+
+def get_path(document, path):
+    """Value at a dotted path; list items are addressed by index."""
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return None
+        if value is None:
+            return None
+    return value
+
+
+def expand_targets(targets, limit):
+    """Expand IPs and CIDRs into distinct addresses, at most limit of them.
+
+    Raises ValueError for a malformed target or when the expansion would
+    exceed limit. The limit counts the addresses produced, and expansion
+    stops at the first one over it, so a huge network costs no more than
+    limit addresses.
+    """
+    networks = []
+    for target in targets:
+        try:
+            networks.append(ipaddress.ip_network(target.strip(), strict=False))
+        except ValueError:
+            raise ValueError(f"Invalid target: {target}")
+
+    addresses = {}
+    for network in networks:
+        hosts = [network.network_address] if network.num_addresses == 1 else network.hosts()
+        for address in hosts:
+            addresses[str(address)] = None
+            if len(addresses) > limit:
+                raise ValueError(f"Too many targets, your plan allows {limit} per request")
+    return list(addresses)
+
+
+def _is_fresh(ip_data):
+    last_update = ip_data.get("last_update")
+    # discovery stamps last_update with its local naive time
+    return last_update is not None and (
+        datetime.now() - last_update <= timedelta(seconds=FAST_PATH_MAX_AGE)
+    )
+
+
+def map_scan_fields(ip_data):
+    """Turn a scan_results document into Scan field values."""
+    fields = {
+        field: value
+        for field, path in SCAN_FIELD_MAP.items()
+        if (value := get_path(ip_data, path)) is not None
+    }
+    if ip_data.get("ports") is not None:
+        fields["target_ports"] = ",".join(str(p) for p in ip_data["ports"])
+    return fields
+
 
 class ScanService:
     @staticmethod
@@ -39,6 +131,149 @@ class ScanService:
         ScanRepository.log_history(user, scan, "created", {"ip": target_ip})
         return scan, None
 
+    @staticmethod
+    def fetch_fresh(target_ip):
+        """Return the projected host document if it is recent enough.
+
+        Its CVE references are expanded with their details.
+        """
+        ip_data = fetch_by_ip(target_ip, fields=SCAN_RESULT_PROJECTION, resolve_cves=True)
+        return ip_data if ip_data and _is_fresh(ip_data) else None
+
+    @staticmethod
+    def initiate_bulk_scan(user, addresses):
+        """Create a job with one scan per address.
+
+        Quota for every address is reserved in a single UPDATE. Addresses
+        with fresh data are completed straight away; the others are
+        returned as (scan_id, ip) pairs to be queued.
+        """
+        from api_applications.shared_models.models.scan import Scan, ScanHistory
+
+        now = timezone.now()
+        fresh = {
+            ip: data
+            for ip, data in fetch_many_by_ip(addresses, SCAN_PROJECTION).items()
+            if _is_fresh(data)
+        }
+        with transaction.atomic():
+            # the reservation is rolled back if the scans cannot be created
+            if not QuotaService.consume(user, "scan_batch", len(addresses)):
+                return None, None, "Scan quota exhausted"
+            job = ScanRepository.create_job(user, len(addresses))
+            scans = []
+            for ip in addresses:
+                if ip in fresh:
+                    scans.append(Scan(
+                        user=user, job=job, target_ip=ip, status="completed",
+                        completed_at=now, **map_scan_fields(fresh[ip]),
+                    ))
+                else:
+                    scans.append(Scan(user=user, job=job, target_ip=ip, status="pending"))
+            scans = ScanRepository.bulk_create_scans(scans)
+
+            history = []
+            for scan in scans:
+                history.append(ScanHistory(
+                    user=user, scan=scan, action="created",
+                    details={"ip": scan.target_ip, "job": job.pk},
+                ))
+                if scan.status == "completed":
+                    history.append(ScanHistory(
+                        user=user, scan=scan, action="completed",
+                        details={"source": "cache", **map_scan_fields(fresh[scan.target_ip])},
+                    ))
+            ScanRepository.bulk_log_history(history)
+
+        queued = [(scan.pk, scan.target_ip) for scan in scans if scan.status == "pending"]
+        return job, queued, None
+
+    @staticmethod
+    def complete_scan(scan, ip_data, source="live"):
+        fields = map_scan_fields(ip_data)
+        ScanRepository.update_scan(
+            scan, status="completed", completed_at=timezone.now(), **fields
+        )
+        ScanRepository.log_history(
+            scan.user, scan, "completed", {"source": source, **fields}
+        )
+        return scan
+
+    @staticmethod
+    def run_scan_batch(scans):
+        """Run the (scan_id, ip) pairs of one bulk_scan task.
+
+        The hosts are read with one fetch_many_by_ip, then the scans are
+        saved with one bulk_update and their history with one bulk_create.
+        """
+        from api_applications.shared_models.models.scan import Scan
+
+        scan_ids = [scan_id for scan_id, _ in scans]
+        try:
+            hosts = fetch_many_by_ip([ip for _, ip in scans], SCAN_PROJECTION)
+            with transaction.atomic():
+                # a retried task leaves the scans it already finished alone
+                by_id = (
+                    Scan.objects.select_for_update(skip_locked=True)
+                    .filter(status="pending")
+                    .in_bulk(scan_ids)
+                )
+                ScanService._finish_batch(scans, by_id, hosts)
+
+        except Exception as e:
+            logger.error(f"Run scan batch failed: {e}")
+            try:
+                Scan.objects.filter(id__in=scan_ids, status="pending").update(
+                    status="failed")
+            except Exception as e:
+                logger.error(f"Could not fail scan batch: {e}")
+
+    @staticmethod
+    def _finish_batch(scans, by_id, hosts):
+        from api_applications.shared_models.models.scan import ScanHistory
+
+        now = timezone.now()
+        updated = {"status", "started_at", "completed_at", "updated_at"}
+        history = []
+        for scan_id, target_ip in scans:
+            scan = by_id.get(scan_id)
+            if scan is None:
+                continue
+            scan.started_at = scan.updated_at = now
+            ip_data = hosts.get(target_ip)
+            if ip_data:
+                fields = map_scan_fields(ip_data)
+                for key, value in fields.items():
+                    setattr(scan, key, value)
+                updated.update(fields)
+                scan.status, scan.completed_at = "completed", now
+                history.append(ScanHistory(
+                    user_id=scan.user_id, scan=scan, action="completed",
+                    details={"source": "live", **fields},
+                ))
+            else:
+                scan.status = "failed"
+                history.append(ScanHistory(
+                    user_id=scan.user_id, scan=scan, action="no_data",
+                    details={"ip": target_ip},
+                ))
+
+        ScanRepository.bulk_update_scans(list(by_id.values()), sorted(updated))
+        ScanRepository.bulk_log_history(history)
+
+    @staticmethod
+    def fail_stale_scans(job):
+        """Fail the scans of job no worker has touched in SCAN_PENDING_TIMEOUT.
+
+        A chunk Celery never picks up would otherwise keep the job running
+        forever. Returns the number of scans failed.
+        """
+        now = timezone.now()
+        return job.scans.filter(
+            status__in=["pending", "running"],
+            updated_at__lt=now - timedelta(seconds=SCAN_PENDING_TIMEOUT),
+        ).update(status="failed", updated_at=now)
+
     @staticmethod
     def run_scan(scan_id, target_ip):
         from shared_models.models.scan import (
@@ -52,31 +287,10 @@ class ScanService:
             )
             ScanRepository.log_history(scan.user, scan, "running")
 
-            ip_data = fetch_by_ip(target_ip)
+            ip_data = fetch_by_ip(target_ip, fields=SCAN_PROJECTION)
 
             if ip_data:
-                ScanRepository.update_scan(
-                    scan,
-                    status="completed",
-                    completed_at=timezone.now(),
-                    **{
-                        k: v
-                        for k, v in ip_data.items()
-                        if k
-                        in {
-                            "country",
-                            "city",
-                            "region",
-                            "latitude",
-                            "longitude",
-                            "domain",
-                            "organization",
-                            "isp",
-                            "asn",
-                        }
-                    },
-                )
-                ScanRepository.log_history(scan.user, scan, "completed", ip_data)
+                ScanService.complete_scan(scan, ip_data)
             else:
                 ScanRepository.update_scan(scan, status="failed")
                 ScanRepository.log_history(
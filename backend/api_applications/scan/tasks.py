@@ -1,8 +1,26 @@
-from celery import shared_task
+from celery import group, shared_task
 
-from api_applications.scan.services.scan_service import ScanService
+from api_applications.scan.services.scan_service import (
+    BULK_SCAN_TASK_CHUNK,
+    ScanService,
+)
 
 
 @shared_task(bind=True, max_retries=3)
 def run_scan_task(self, scan_id, target_ip):
-    ScanService.run_scan(scan_id, target_ip)
\ No newline at end of file
+    ScanService.run_scan(scan_id, target_ip)
+
+
+@shared_task(bind=True, max_retries=3)
+def run_scan_batch_task(self, scans):
+    ScanService.run_scan_batch(scans)
+
+
+def enqueue_scan_batches(scans):
+    """Queue (scan_id, ip) pairs as one group of chunked tasks."""
+    if not scans:
+        return None
+    return group(
+        run_scan_batch_task.s(scans[start:start + BULK_SCAN_TASK_CHUNK])
+        for start in range(0, len(scans), BULK_SCAN_TASK_CHUNK)
+    ).apply_async()
@@ -1,11 +1,20 @@
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+from django.core.management import call_command
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
 from django.contrib.auth import get_user_model
 from django.test import TestCase
-from api_applications.shared_models.models.scan import Scan, ScanHistory
+from django.utils import timezone
+from api_applications.shared_models.models.scan import Scan, ScanHistory, ScanJob
 from api_applications.shared_models.models import CustomUser
 from api_applications.scan.serializers import ScanSerializer, ScanHistorySerializer , ScanSearchSerializer
+from api_applications.scan.services.scan_service import ScanService, expand_targets, map_scan_fields
+from api_applications.shared_libs.host_cache import HostCache
+from api_applications.shared_libs.lru import LRUCache
 
 User = get_user_model()
 
@@ -147,4 +156,289 @@ class UserScansAndHistoryTests(APITestCase):
         invalid_url = reverse("user_scan_history", args=[999])
         resp = self.client.get(invalid_url)
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
-        self.assertIn("error", resp.data)
\ No newline at end of file
+        self.assertIn("error", resp.data)
+
+
+class BackfillIPNumCommandTests(TestCase):
+
+    @patch("api_applications.scan.management.commands._backfill.get_collection")
+    def test_backfills_in_batches_and_indexes(self, mock_get_collection):
+        collection = mock_get_collection.return_value
+        collection.find.return_value = [
+            {"_id": "10.0.0.1"}, {"_id": "10.0.0.2"}, {"_id": "not-an-ip"},
+            {"_id": "10.0.0.3"},
+        ]
+        collection.bulk_write.side_effect = lambda ops, ordered: MagicMock(
+            modified_count=len(ops))
+
+        out = StringIO()
+        call_command("backfill_ip_num", "--batch-size", "2", stdout=out)
+
+        batches = [c.args[0] for c in collection.bulk_write.call_args_list]
+        self.assertEqual([len(b) for b in batches], [2, 1])
+        self.assertEqual(batches[0][0]._doc, {"$set": {"ip_num": 167772161}})
+        collection.create_indexes.assert_called_once()
+        self.assertIn("3 documents backfilled, 1 without an IPv4 _id skipped", out.getvalue())
+
+
+class MongoIndexesCommandTests(TestCase):
+
+    @patch("api_applications.scan.management.commands.mongo_indexes.get_collection")
+    def test_creates_missing_and_reports_usage(self, mock_get_collection):
+        collection, facet_counts = MagicMock(), MagicMock()
+        mock_get_collection.side_effect = lambda name: (
+            facet_counts if name == "facet_counts" else collection)
+        facet_counts.index_information.return_value = {"_id_": {}}
+        facet_counts.create_indexes.side_effect = lambda models: [
+            m.document["name"] for m in models]
+        collection.index_information.return_value = {"_id_": {}, "ports_id": {}}
+        collection.create_indexes.side_effect = lambda models: [
+            m.document["name"] for m in models]
+        collection.aggregate.return_value = [
+            {"name": "_id_", "accesses": {"ops": 9}},
+            {"name": "ports_id", "accesses": {"ops": 0}},
+            {"name": "banner_text", "accesses": {"ops": 3}},
+        ]
+
+        out = StringIO()
+        call_command("mongo_indexes", stdout=out)
+
+        created = collection.create_indexes.call_args.args[0]
+        self.assertNotIn("ports_id", [m.document["name"] for m in created])
+        self.assertIn("created: down_hosts", out.getvalue())
+        self.assertIn("created: dim_scope_value", out.getvalue())
+        self.assertIn("unused: ports_id", out.getvalue())
+        self.assertIn("undeclared: banner_text (3 ops)", out.getvalue())
+
+    @patch("api_applications.scan.management.commands.mongo_indexes.get_collection")
+    def test_check_only_reports(self, mock_get_collection):
+        collection = mock_get_collection.return_value
+        collection.index_information.return_value = {"_id_": {}}
+        collection.aggregate.return_value = []
+
+        out = StringIO()
+        call_command("mongo_indexes", "--check", stdout=out)
+
+        collection.create_indexes.assert_not_called()
+        self.assertIn("missing: ports_id", out.getvalue())
+
+
+HOST_DOCUMENT = {
+    "_id": "203.0.113.5",
+    "ports": [22, 443],
+    "domain": "host.example",
+    "general": {
+        "geo": {"country": "Germany", "city": "Berlin", "regionname": "Berlin",
+                "latlang": [52.52, 13.40]},
+        "isp": "Example ISP", "organization": "Example Org", "asn": "AS64500",
+    },
+}
+
+
+class MapScanFieldsTests(TestCase):
+
+    def test_nested_fields_are_mapped(self):
+        self.assertEqual(map_scan_fields(HOST_DOCUMENT), {
+            "country": "Germany", "city": "Berlin", "region": "Berlin",
+            "latitude": 52.52, "longitude": 13.40, "domain": "host.example",
+            "organization": "Example Org", "isp": "Example ISP", "asn": "AS64500",
+            "target_ports": "22,443",
+        })
+
+    def test_missing_enrichment_is_skipped(self):
+        self.assertEqual(map_scan_fields({"_id": "1.1.1.1", "ports": []}),
+                         {"target_ports": ""})
+
+
+class ScanFastPathTests(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse("search_ip")
+
+    @patch("api_applications.scan.views.run_scan_task")
+    @patch("api_applications.scan.services.scan_service.fetch_by_ip")
+    def test_fresh_data_completes_in_request(self, mock_fetch, mock_task):
+        mock_fetch.return_value = {**HOST_DOCUMENT, "last_update": datetime.now()}
+
+        resp = self.client.get(self.url, {"ip": "203.0.113.5"})
+
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data["scan"]["country"], "Germany")
+        self.assertEqual(resp.data["scan"]["status"], "completed")
+        mock_task.delay.assert_not_called()
+        scan = Scan.objects.get(pk=resp.data["scan_id"])
+        self.assertEqual(scan.asn, "AS64500")
+        self.assertTrue(ScanHistory.objects.filter(scan=scan, action="completed").exists())
+
+    @patch("api_applications.shared_libs.mongo_fetch_result._cve_cache", LRUCache(10))
+    @patch("api_applications.shared_libs.mongo_fetch_result.host_cache",
+           HostCache(max_size=10, ttl=60))
+    @patch("api_applications.shared_libs.mongo_fetch_result.get_collection")
+    @patch("api_applications.scan.views.run_scan_task")
+    def test_fresh_data_includes_cve_details(self, mock_task, mock_get_collection):
+        host = {**HOST_DOCUMENT, "last_update": datetime.now(),
+                "vulnerability": {"OpenSSH": [{"cve_id": "CVE-2023-1", "score": 7.5}]}}
+        # hosts are read with a projection argument, CVEs without one
+        mock_get_collection.return_value.find.side_effect = lambda query, *projection: (
+            [host] if projection
+            else [{"_id": "CVE-2023-1", "description": "OpenSSH flaw"}])
+
+        resp = self.client.get(self.url, {"ip": "203.0.113.5"})
+
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data["vulnerabilities"]["OpenSSH"][0], {
+            "cve_id": "CVE-2023-1", "score": 7.5, "description": "OpenSSH flaw"})
+
+    @patch("api_applications.scan.views.run_scan_task")
+    @patch("api_applications.scan.services.scan_service.fetch_by_ip")
+    def test_stale_data_queues_live_scan(self, mock_fetch, mock_task):
+        mock_fetch.return_value = {
+            **HOST_DOCUMENT, "last_update": datetime.now() - timedelta(days=30)}
+
+        resp = self.client.get(self.url, {"ip": "203.0.113.5"})
+
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        mock_task.delay.assert_called_once_with(resp.data["scan_id"], "203.0.113.5")
+
+
+class ExpandTargetsTests(TestCase):
+
+    def test_ips_and_cidrs_are_deduplicated(self):
+        self.assertEqual(
+            expand_targets(["10.0.0.1", "10.0.0.0/30", "10.0.0.2/32"], 10),
+            ["10.0.0.1", "10.0.0.2"],
+        )
+
+    def test_limit_is_checked_before_expanding(self):
+        with self.assertRaisesMessage(ValueError, "allows 100"):
+            expand_targets(["10.0.0.0/8"], 100)
+
+    def test_limit_counts_the_addresses_produced(self):
+        # a /30 has four addresses but only two hosts
+        self.assertEqual(expand_targets(["10.0.0.0/30"], 2), ["10.0.0.1", "10.0.0.2"])
+
+    def test_invalid_target(self):
+        with self.assertRaisesMessage(ValueError, "Invalid target: nope"):
+            expand_targets(["nope"], 10)
+
+
+@patch("api_applications.scan.views.SubscriptionService.get_active_subscription",
+       return_value=MagicMock())
+@patch("api_applications.scan.views.ScanResultFilter.get_plan_features",
+       return_value={"bulk_scan_limit": 16})
+class BulkScanTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="bulk", password="pass", email="bulk@example.com"
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse("bulk_scan")
+
+    @patch("api_applications.scan.views.enqueue_scan_batches")
+    @patch("api_applications.scan.services.scan_service.fetch_many_by_ip")
+    @patch("api_applications.scan.services.scan_service.QuotaService.consume",
+           return_value=True)
+    def test_creates_job_and_queues_stale_targets(
+        self, mock_consume, mock_fetch, mock_enqueue, *_
+    ):
+        mock_fetch.return_value = {
+            "203.0.113.1": {**HOST_DOCUMENT, "_id": "203.0.113.1",
+                            "last_update": datetime.now()},
+        }
+
+        resp = self.client.post(
+            self.url, {"targets": ["203.0.113.0/30", "203.0.113.9"]}, format="json")
+
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual((resp.data["target_count"], resp.data["completed"],
+                          resp.data["queued"]), (3, 1, 2))
+        mock_consume.assert_called_once_with(self.user, "scan_batch", 3)
+        job = ScanJob.objects.get(pk=resp.data["job_id"])
+        self.assertEqual(job.scans.count(), 3)
+        self.assertEqual(job.scans.get(target_ip="203.0.113.1").country, "Germany")
+        self.assertEqual(ScanHistory.objects.filter(scan__job=job).count(), 4)
+        queued = mock_enqueue.call_args[0][0]
+        self.assertEqual(sorted(ip for _, ip in queued), ["203.0.113.2", "203.0.113.9"])
+
+        poll = self.client.get(reverse("scan_job", args=[job.pk]))
+        self.assertEqual(poll.data["counts"], {"completed": 1, "pending": 2})
+        self.assertEqual(poll.data["status"], "running")
+
+    @patch("api_applications.scan.views.enqueue_scan_batches")
+    @patch("api_applications.scan.services.scan_service.fetch_many_by_ip")
+    @patch("api_applications.scan.services.scan_service.QuotaService.consume",
+           return_value=True)
+    def test_all_fresh_completes_in_request(self, mock_consume, mock_fetch, *_):
+        mock_fetch.return_value = {
+            "203.0.113.9": {**HOST_DOCUMENT, "_id": "203.0.113.9",
+                            "last_update": datetime.now()},
+        }
+        resp = self.client.post(self.url, {"targets": ["203.0.113.9"]}, format="json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data["queued"], 0)
+
+    @patch("api_applications.scan.views.enqueue_scan_batches")
+    @patch("api_applications.scan.services.scan_service.fetch_many_by_ip", return_value={})
+    @patch("api_applications.scan.services.scan_service.QuotaService.consume",
+           return_value=True)
+    def test_scans_never_picked_up_fail(self, mock_consume, mock_fetch, *_):
+        resp = self.client.post(self.url, {"targets": ["203.0.113.9"]}, format="json")
+        job = ScanJob.objects.get(pk=resp.data["job_id"])
+        job.scans.update(updated_at=timezone.now() - timedelta(days=1))
+
+        poll = self.client.get(reverse("scan_job", args=[job.pk]))
+
+        self.assertEqual(poll.data["counts"], {"failed": 1})
+        self.assertEqual(poll.data["status"], "done")
+
+    @patch("api_applications.scan.services.scan_service.fetch_many_by_ip", return_value={})
+    @patch("api_applications.scan.services.scan_service.QuotaService.consume",
+           return_value=False)
+    def test_quota_exhausted_creates_nothing(self, mock_consume, mock_fetch, *_):
+        resp = self.client.post(self.url, {"targets": ["203.0.113.9"]}, format="json")
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(ScanJob.objects.exists())
+
+    def test_over_plan_limit(self, *_):
+        resp = self.client.post(self.url, {"targets": ["203.0.113.0/24"]}, format="json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RunScanBatchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="batch", password="pass", email="batch@example.com"
+        )
+        self.scans = [
+            Scan.objects.create(user=self.user, target_ip=ip, status="pending")
+            for ip in ("203.0.113.1", "203.0.113.2")
+        ]
+
+    @patch("api_applications.scan.services.scan_service.fetch_many_by_ip")
+    def test_one_fetch_and_bulk_writes_per_batch(self, mock_fetch):
+        mock_fetch.return_value = {"203.0.113.1": {**HOST_DOCUMENT, "_id": "203.0.113.1"}}
+
+        ScanService.run_scan_batch([(s.pk, s.target_ip) for s in self.scans])
+
+        mock_fetch.assert_called_once()
+        found, missing = (Scan.objects.get(pk=s.pk) for s in self.scans)
+        self.assertEqual((found.status, found.country), ("completed", "Germany"))
+        self.assertEqual(missing.status, "failed")
+        self.assertEqual(
+            sorted(ScanHistory.objects.values_list("action", flat=True)),
+            ["completed", "no_data"],
+        )
+
+    @patch("api_applications.scan.services.scan_service.fetch_many_by_ip")
+    def test_retry_leaves_finished_scans_alone(self, mock_fetch):
+        mock_fetch.return_value = {}
+        done = self.scans[0]
+        Scan.objects.filter(pk=done.pk).update(status="completed", country="France")
+
+        ScanService.run_scan_batch([(s.pk, s.target_ip) for s in self.scans])
+
+        done.refresh_from_db()
+        self.assertEqual((done.status, done.country), ("completed", "France"))
+        self.assertFalse(ScanHistory.objects.filter(scan=done).exists())
+        self.assertEqual(Scan.objects.get(pk=self.scans[1].pk).status, "failed")
@@ -1,10 +1,18 @@
 from django.urls import path
 
-from .views import PerformScanView, UserScanHistoryView, UserScansView
+from .views import (
+    BulkScanView,
+    PerformScanView,
+    ScanJobView,
+    UserScanHistoryView,
+    UserScansView,
+)
 
 urlpatterns = [
     path("search/", PerformScanView.as_view(), name="search_ip"),
     path("scans/", UserScansView.as_view(), name="user_scans"),
+    path("scans/bulk/", BulkScanView.as_view(), name="bulk_scan"),
+    path("scans/jobs/<int:job_id>/", ScanJobView.as_view(), name="scan_job"),
     path(
         "scans/<int:scan_id>/history/",
         UserScanHistoryView.as_view(),
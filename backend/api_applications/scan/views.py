@@ -2,17 +2,22 @@ import logging
 import os
 
 from django.core.cache import cache
+from django.db.models import Count
 from dotenv import load_dotenv
 from rest_framework import permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from api_applications.scan.serializers import ScanHistorySerializer, ScanSerializer
+from api_applications.scan.serializers import (
+    BulkScanSerializer,
+    ScanHistorySerializer,
+    ScanSerializer,
+)
 from api_applications.scan.services.subscription_service import SubscriptionService
-from api_applications.shared_models.models.scan import Scan, ScanHistory
+from api_applications.shared_models.models.scan import Scan, ScanHistory, ScanJob
 
-from .services.scan_service import ScanResultFilter, ScanService
-from .tasks import run_scan_task
+from .services.scan_service import ScanResultFilter, ScanService, expand_targets
+from .tasks import enqueue_scan_batches, run_scan_task
 
 load_dotenv()
 
@@ -42,21 +47,7 @@ class PerformScanView(APIView):
             if not scan:
                 return Response({"detail": error}, status=status.HTTP_403_FORBIDDEN)
 
-            run_scan_task.delay(scan.pk, target_ip)
-
-            # fetch results (if any already exist, otherwise empty list)
-            # raw_results = ScanService.get_results(scan.pk)
-            # filtered_results = ScanResultFilter.filter_results(
-                # request.user, raw_results
-            # )
-            return Response(
-                {
-                    "detail": "Scan queued",
-                    "scan_id": scan.pk,
-                    # "results": filtered_results,
-                },
-                status=status.HTTP_202_ACCEPTED,
-            )
+            return self.dispatch_scan(scan, target_ip, "Scan queued")
 
         # Handle anonymous user (quota based on IP)
         client_ip = request.META.get("REMOTE_ADDR", "unknown")
@@ -81,19 +72,93 @@ class PerformScanView(APIView):
                 status=status.HTTP_403_FORBIDDEN,
             )
 
+        return self.dispatch_scan(scan, target_ip, "Anonymous scan queued")
+
+    @staticmethod
+    def dispatch_scan(scan, target_ip, queued_detail):
+        # fresh data already in Mongo: answer in this request
+        ip_data = ScanService.fetch_fresh(target_ip)
+        if ip_data:
+            ScanService.complete_scan(scan, ip_data, source="cache")
+            return Response(
+                {
+                    "detail": "Scan completed",
+                    "scan_id": scan.pk,
+                    "scan": ScanSerializer(scan).data,
+                    "vulnerabilities": ip_data.get("vulnerability") or {},
+                },
+                status=status.HTTP_200_OK,
+            )
+
         run_scan_task.delay(scan.pk, target_ip)
+        return Response(
+            {"detail": queued_detail, "scan_id": scan.pk},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+
+class BulkScanView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
 
-        # fetch results for anonymous (limited visibility)
-        # raw_results = ScanService.run_scan(scan.pk)
-        # filtered_results = ScanResultFilter.filter_results(None, raw_results)
+    def post(self, request):
+        serializer = BulkScanSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
 
+        subscription = SubscriptionService.get_active_subscription(request.user)
+        if not subscription:
+            return Response({"detail": "No active subscription"}, status=403)
+
+        plan = ScanResultFilter.get_plan_features(request.user)
+        try:
+            addresses = expand_targets(
+                serializer.validated_data["targets"], plan.get("bulk_scan_limit", 0)
+            )
+        except ValueError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        job, queued, error = ScanService.initiate_bulk_scan(request.user, addresses)
+        if not job:
+            return Response({"detail": error}, status=status.HTTP_403_FORBIDDEN)
+
+        enqueue_scan_batches(queued)
         return Response(
             {
-                "detail": "Anonymous scan queued",
-                "scan_id": scan.pk,
-                # "results": filtered_results,
+                "detail": "Bulk scan queued" if queued else "Bulk scan completed",
+                "job_id": job.pk,
+                "target_count": job.target_count,
+                "completed": job.target_count - len(queued),
+                "queued": len(queued),
             },
-            status=status.HTTP_202_ACCEPTED,
+            # every target answered from fresh data: nothing left to poll
+            status=status.HTTP_202_ACCEPTED if queued else status.HTTP_200_OK,
+        )
+
+
+class ScanJobView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, job_id):
+        try:
+            job = ScanJob.objects.get(pk=job_id, user=request.user)
+        except ScanJob.DoesNotExist:
+            return Response(
+                {"error": "Job not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        ScanService.fail_stale_scans(job)
+        counts = {
+            row["status"]: row["count"]
+            for row in job.scans.values("status").annotate(count=Count("id"))
+        }
+        finished = counts.get("completed", 0) + counts.get("failed", 0)
+        return Response(
+            {
+                "job_id": job.pk,
+                "target_count": job.target_count,
+                "status": "done" if finished == job.target_count else "running",
+                "counts": counts,
+            },
+            status=status.HTTP_200_OK,
         )
 
 
@@ -0,0 +1,295 @@
+import logging
+import os
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING, DeleteOne, IndexModel, ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from api_applications.shared_libs.mongo_fetch_result import _COLLECTION, get_collection
+from api_applications.shared_libs.write_buffer import MODIFIED_FIELD
+
+from .filters import ALIASES, QueryError, compile_terms, country_code, parse_query
+
+FACET_COLLECTION = os.getenv("FACET_COLLECTION", "facet_counts")
+# the facet keys each host currently counts towards, so an update only
+# applies the difference
+FACET_HOSTS_COLLECTION = os.getenv("FACET_HOSTS_COLLECTION", "facet_hosts")
+FACET_STATE_COLLECTION = os.getenv("FACET_STATE_COLLECTION", "facet_state")
+FACET_BATCH_SIZE = int(os.getenv("FACET_BATCH_SIZE", "1000"))
+# hosts written this long before the last run are read again; last_update
+# comes from the scanner's clock and modified_at from Mongo's
+FACET_WATERMARK_SLACK = int(os.getenv("FACET_WATERMARK_SLACK", "300"))
+# one update runs at a time; its lease is renewed after every batch and
+# lapses this long after a worker died holding it
+FACET_LEASE_TTL = int(os.getenv("FACET_LEASE_TTL", "600"))
+# hosts a filtered facet that no rollup covers is computed over
+FACET_SAMPLE_SIZE = int(os.getenv("FACET_SAMPLE_SIZE", "10000"))
+FACET_MAX_SIZE = int(os.getenv("FACET_MAX_SIZE", "50"))
+FACET_MAX_TIME_MS = int(os.getenv("FACET_MAX_TIME_MS", "2000"))
+
+# dimension -> (host field, whether a host has several values)
+DIMENSIONS = {
+    "port": ("ports", True),
+    "country": ("general.geo.countrycode", False),
+    "org": ("general.organization", False),
+    "asn": ("general.asn", False),
+    # "product:version" keys, counted by product
+    "product": ("service_keys", True),
+}
+# rollups are also kept per value of these dimensions, so e.g.
+# country:DE facet=port is answered without touching scan_results
+# (single-valued dimensions only)
+SCOPES = [
+    s for s in os.getenv("FACET_SCOPES", "country").split(",")
+    if s in DIMENSIONS and not DIMENSIONS[s][1]
+]
+ALL = ""
+_LEASE = "rollups_lease"
+
+# created by `manage.py mongo_indexes`
+FACET_INDEXES = [
+    IndexModel(
+        [("dim", ASCENDING), ("scope", ASCENDING), ("count", DESCENDING)],
+        name="dim_scope_count",
+    ),
+    IndexModel(
+        [("dim", ASCENDING), ("scope", ASCENDING), ("value", ASCENDING)],
+        name="dim_scope_value",
+        unique=True,
+    ),
+]
+
+_PROJECTION = {field: 1 for field, _ in DIMENSIONS.values()}
+
+
+def _expression(dim):
+    """Aggregation expression of a dimension's value."""
+    field, _ = DIMENSIONS[dim]
+    if dim == "product":
+        return {"$setUnion": [{"$map": {
+            "input": {"$ifNull": ["$service_keys", []]},
+            "in": {"$arrayElemAt": [{"$split": ["$$this", ":"]}, 0]},
+        }}]}
+    return f"${field}"
+
+
+def host_values(host, dim):
+    """The values a host counts towards in one dimension."""
+    value = host
+    for part in DIMENSIONS[dim][0].split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    values = value if isinstance(value, list) else [value]
+    if dim == "product":
+        values = [key.partition(":")[0] for key in values if isinstance(key, str)]
+    return {v for v in values if v not in (None, "")}
+
+
+def host_keys(host):
+    """Every (dim, scope, value) row of facet_counts the host counts in."""
+    keys = set()
+    for dim in DIMENSIONS:
+        values = host_values(host, dim)
+        for value in values:
+            keys.add((dim, ALL, value))
+        for scope in SCOPES:
+            if scope == dim:
+                continue
+            for scope_value in host_values(host, scope):
+                for value in values:
+                    keys.add((dim, f"{scope}:{scope_value}", value))
+    return keys
+
+
+def apply_hosts(hosts):
+    """Move the counts of hosts from their stored keys to their current ones.
+
+    Only the difference is written: one $inc per changed row and the new
+    key list of each host whose keys changed. Returns the rows changed.
+    """
+    counts = get_collection(FACET_COLLECTION)
+    contributions = get_collection(FACET_HOSTS_COLLECTION)
+    ids = [host["_id"] for host in hosts]
+    before = {
+        doc["_id"]: {tuple(key) for key in doc["keys"]}
+        for doc in contributions.find({"_id": {"$in": ids}})
+    }
+    delta, replaced = Counter(), []
+    for host in hosts:
+        old, new = before.get(host["_id"], set()), host_keys(host)
+        if old == new:
+            continue
+        delta.update(new - old)
+        delta.subtract(old - new)
+        replaced.append(ReplaceOne(
+            {"_id": host["_id"]}, {"keys": [list(key) for key in new]}, upsert=True))
+
+    changes = [(key, n) for key, n in delta.items() if n]
+    if changes:
+        counts.bulk_write([
+            UpdateOne({"dim": d, "scope": s, "value": v}, {"$inc": {"count": n}},
+                      upsert=True)
+            for (d, s, v), n in changes
+        ], ordered=False)
+        emptied = [
+            DeleteOne({"dim": d, "scope": s, "value": v, "count": {"$lte": 0}})
+            for (d, s, v), n in changes if n < 0
+        ]
+        if emptied:
+            counts.bulk_write(emptied, ordered=False)
+    if replaced:
+        contributions.bulk_write(replaced, ordered=False)
+    return len(changes)
+
+
+def _acquire_lease(state, owner):
+    """Take the update lease unless another run holds an unexpired one."""
+    now = datetime.now()
+    try:
+        state.find_one_and_update(
+            {"_id": _LEASE, "expires": {"$lt": now}},
+            {"$set": {"owner": owner, "expires": now + timedelta(seconds=FACET_LEASE_TTL)}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # the lease document exists and has not expired
+        return False
+    return True
+
+
+def _renew_lease(state, owner):
+    result = state.update_one(
+        {"_id": _LEASE, "owner": owner},
+        {"$set": {"expires": datetime.now() + timedelta(seconds=FACET_LEASE_TTL)}},
+    )
+    return result.matched_count == 1
+
+
+def update_rollups(full=False):
+    """Apply the hosts written since the last run to the facet tables.
+
+    Hosts are picked by last_update (discovery) and modified_at (the write
+    buffer), both indexed, so a run reads only what changed. The first run,
+    or full=True, empties the tables and counts every host once; until it
+    finishes, readers see partial counts. A run that finds the lease held
+    by another one does nothing and returns None.
+    """
+    state = get_collection(FACET_STATE_COLLECTION)
+    owner = uuid.uuid4().hex
+    if not _acquire_lease(state, owner):
+        logging.info("[facets] another update holds the lease, skipping")
+        return None
+    try:
+        return _update_rollups(state, owner, full)
+    finally:
+        state.delete_one({"_id": _LEASE, "owner": owner})
+
+
+def _update_rollups(state, owner, full):
+    started = datetime.now()
+    counts = get_collection(FACET_COLLECTION)
+    last = state.find_one({"_id": "rollups"})
+    if full or last is None:
+        # a recount that stops half way is started over by the next run
+        state.delete_one({"_id": "rollups"})
+        counts.delete_many({})
+        get_collection(FACET_HOSTS_COLLECTION).delete_many({})
+        query = {}
+    else:
+        since = last["at"] - timedelta(seconds=FACET_WATERMARK_SLACK)
+        query = {"$or": [
+            {"last_update": {"$gte": since}},
+            {MODIFIED_FIELD: {"$gte": since}},
+        ]}
+
+    hosts, batch, changed = 0, [], 0
+    cursor = get_collection(_COLLECTION).find(
+        query, _PROJECTION, batch_size=FACET_BATCH_SIZE)
+    for host in cursor:
+        batch.append(host)
+        if len(batch) == FACET_BATCH_SIZE:
+            changed += apply_hosts(batch)
+            hosts += len(batch)
+            batch = []
+            if not _renew_lease(state, owner):
+                # the watermark stays put, so the next run reads these
+                # hosts again and finds nothing left to apply
+                logging.error(f"[facets] lease lost after {hosts} hosts, stopping")
+                return hosts
+    if batch:
+        changed += apply_hosts(batch)
+        hosts += len(batch)
+    state.update_one({"_id": "rollups"}, {"$set": {"at": started}}, upsert=True)
+    logging.info(f"[facets] {hosts} hosts applied, {changed} rows changed")
+    return hosts
+
+
+def _rollup_scope(query):
+    """The rollup scope a query is exactly, or None if it needs a filter."""
+    terms = parse_query(query)
+    if not terms:
+        return ALL
+    if len(terms) == 1 and not terms[0].negate:
+        field, value = ALIASES.get(terms[0].field, terms[0].field), terms[0].value
+        if field == "country":
+            # country rollups are keyed by ISO code; a name is sampled
+            value = country_code(value)
+            if value is None:
+                return None
+        if field in SCOPES:
+            return f"{field}:{value}"
+    return None
+
+
+def _from_rollup(dim, scope, size):
+    cursor = (
+        get_collection(FACET_COLLECTION)
+        .find({"dim": dim, "scope": scope}, {"_id": 0, "value": 1, "count": 1})
+        .sort("count", DESCENDING)
+        .limit(size)
+    )
+    return [{"value": row["value"], "count": row["count"]} for row in cursor]
+
+
+def _sampled(dim, query, size, text=None):
+    pipeline = [
+        {"$match": compile_terms(parse_query(query), text)},
+        # bounded: the cost does not grow with the number of matches
+        {"$limit": FACET_SAMPLE_SIZE},
+        {"$project": {"_id": 0, "value": _expression(dim)}},
+        *([{"$unwind": "$value"}] if DIMENSIONS[dim][1] else []),
+        {"$match": {"value": {"$nin": [None, ""]}}},
+        {"$group": {"_id": "$value", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": size},
+    ]
+    rows = get_collection(_COLLECTION).aggregate(pipeline, maxTimeMS=FACET_MAX_TIME_MS)
+    return [{"value": row["_id"], "count": row["count"]} for row in rows]
+
+
+def check_facets(query, dims, text=None):
+    """Raise QueryError unless query compiles and every dim is known."""
+    for dim in dims:
+        if dim not in DIMENSIONS:
+            raise QueryError(f"Unknown facet {dim}")
+    compile_terms(parse_query(query), text)
+
+
+def facets(query, dims, size=10, text=None):
+    """{dim: {"values": [{value, count}], "sampled": bool}} for a query.
+
+    Unfiltered queries and a single scope filter read the rollups. Any
+    other filter counts its first FACET_SAMPLE_SIZE matches, so sampled
+    counts are a lower bound.
+    """
+    check_facets(query, dims, text)
+    size = min(size, FACET_MAX_SIZE)
+    scope = _rollup_scope(query)
+    result = {}
+    for dim in dims:
+        if scope is not None and not scope.startswith(f"{dim}:"):
+            result[dim] = {"values": _from_rollup(dim, scope, size), "sampled": False}
+        else:
+            result[dim] = {"values": _sampled(dim, query, size, text), "sampled": True}
+    return result
@@ -0,0 +1,172 @@
+import re
+from collections import namedtuple
+from datetime import datetime
+
+from api_applications.shared_libs import banner_index, ip_ranges
+from api_applications.vulnerability.cpe import normalize_product
+
+# phrase: the value was quoted, so a bare phrase is banner text and not a
+# product name
+Term = namedtuple("Term", "field value negate phrase")
+
+# key:value, key:"quoted value", "quoted phrase" or a bare word; a leading
+# "-" negates the term
+_TOKEN_RE = re.compile(r'(-)?(?:(\w+):)?(?:"((?:[^"\\]|\\.)*)"|(\S+))')
+
+
+class QueryError(ValueError):
+    """The search query cannot be parsed or compiled."""
+
+
+def parse_query(query):
+    """Split a query into Terms; bare words and phrases have field None.
+
+    >>> parse_query('port:22 -country:"United States" nginx')[1]
+    Term(field='country', value='United States', negate=True, phrase=True)
+    """
+    terms = []
+    for m in _TOKEN_RE.finditer(query or ""):
+        negate, field, quoted, word = m.groups()
+        value = quoted.replace('\\"', '"') if quoted is not None else word
+        if not value:
+            raise QueryError(f"Empty value for {field or 'term'}")
+        terms.append(Term(
+            field.lower() if field else None, value, bool(negate), quoted is not None))
+    return terms
+
+
+def _int(field, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise QueryError(f"{field}: expects a number, got {value!r}")
+
+
+def _date(field, value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise QueryError(f"{field}: expects a date like 2024-01-31, got {value!r}")
+
+
+def _asn(value):
+    number = value.upper().removeprefix("AS")
+    if not number.isdigit():
+        raise QueryError(f"asn: expects a number like AS24940, got {value!r}")
+    # ip-api stores "AS24940 Hetzner Online GmbH"; an anchored prefix
+    # regex is answered from the index
+    return {"general.asn": re.compile(rf"^AS{number}(?:\s|$)")}
+
+
+def country_code(value):
+    """The ISO 3166-1 alpha-2 code value spells, or None for a country name."""
+    return value.upper() if len(value) == 2 and value.isalpha() else None
+
+
+def _country(value):
+    # ip-api gives both the name ("Germany") and the code ("DE")
+    code = country_code(value)
+    if code is not None:
+        return {"general.geo.countrycode": code}
+    return {"general.geo.country": value}
+
+
+def _product(value, version=None):
+    product = normalize_product(value)
+    if version is not None:
+        return {"service_keys": f"{product}:{str(version).lower()}"}
+    return {"service_keys": re.compile(f"^{re.escape(product)}:")}
+
+
+def _cidr(value):
+    try:
+        return ip_ranges.cidr_query(value)
+    except ValueError:
+        raise QueryError(f"net: expects a CIDR like 10.0.0.0/8, got {value!r}")
+
+
+# field -> function(value) returning a Mongo condition; every field is
+# backed by one of the scan_results indexes in shared_libs.mongo_indexes
+FIELDS = {
+    "ip": lambda v: {"_id": v},
+    "net": _cidr,
+    "port": lambda v: {"ports": _int("port", v)},
+    "country": _country,
+    "city": lambda v: {"general.geo.city": v},
+    "org": lambda v: {"general.organization": v},
+    "asn": _asn,
+    "product": _product,
+    "after": lambda v: {"last_update": {"$gte": _date("after", v)}},
+    "before": lambda v: {"last_update": {"$lt": _date("before", v)}},
+}
+ALIASES = {"organization": "org", "service": "product", "cidr": "net"}
+
+
+def banner_match(terms):
+    """Banner text condition of banner Terms, from the banner_tokens index."""
+    conditions = []
+    for term in terms:
+        try:
+            condition = banner_index.match(term.value)
+        except ValueError as e:
+            raise QueryError(f"banner: {e}")
+        conditions.append({"$nor": [condition]} if term.negate else condition)
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def _negate(condition):
+    (field, value), = condition.items()
+    if isinstance(value, (dict, re.Pattern)):
+        return {field: {"$not": value}}
+    return {field: {"$ne": value}}
+
+
+def compile_terms(terms, text=None):
+    """Compile Terms into one Mongo filter.
+
+    Bare words are product names. Quoted bare phrases and banner: terms
+    are banner text; text (banner_match unless given) is called with them
+    and returns the condition that matches them.
+    """
+    versions = [t.value for t in terms if t.field == "version"]
+    if len(versions) > 1:
+        raise QueryError("Only one version: filter is allowed")
+    version = versions[0] if versions else None
+    conditions, phrases = [], []
+    for term in terms:
+        field = ALIASES.get(term.field, term.field)
+        if field == "version":
+            continue
+        if field is None:
+            field = "banner" if term.phrase else "product"
+        if field == "banner":
+            phrases.append(term)
+            continue
+        if field not in FIELDS:
+            raise QueryError(f"Unknown filter {term.field}:")
+        if field == "product":
+            product, _, inline = term.value.partition("/")
+            if term.negate:
+                # -nginx/1.18.0 excludes that version, -nginx every version
+                condition = _product(product, inline or None)
+            else:
+                # "nginx/1.18.0" is how banners spell product and version
+                condition = _product(product, version or inline or None)
+                version = None
+        else:
+            condition = FIELDS[field](term.value)
+        conditions.append(_negate(condition) if term.negate else condition)
+
+    if version is not None:
+        raise QueryError("version: needs a product")
+    if phrases:
+        conditions.append((text or banner_match)(phrases))
+    if not conditions:
+        return {}
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def compile_query(query, text=None):
+    return compile_terms(parse_query(query), text)
@@ -0,0 +1,16 @@
+from rest_framework import serializers
+
+
+class SearchQuerySerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=1000, allow_blank=True, required=False, default="")
+    cursor = serializers.CharField(max_length=200, required=False)
+    limit = serializers.IntegerField(
+        min_value=1, max_value=100, required=False, default=20
+    )
+    explain = serializers.BooleanField(required=False, default=False)
+
+
+class FacetQuerySerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=1000, allow_blank=True, required=False, default="")
+    facets = serializers.CharField(max_length=200)
+    size = serializers.IntegerField(min_value=1, max_value=50, required=False, default=10)
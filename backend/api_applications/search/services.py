@@ -0,0 +1,109 @@
+import base64
+import binascii
+import os
+
+from api_applications.shared_libs.mongo_fetch_result import (
+    _COLLECTION,
+    get_collection,
+    resolve_vulnerabilities,
+)
+
+from .filters import QueryError, compile_query
+
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "100"))
+# a query the indexes cannot answer is cut off instead of scanning on
+SEARCH_MAX_TIME_MS = int(os.getenv("SEARCH_MAX_TIME_MS", "2000"))
+
+# what a result row shows; the full document is one fetch_by_ip away
+SEARCH_PROJECTION = {
+    "ports": 1,
+    "domain": 1,
+    "last_update": 1,
+    "general.geo.country": 1,
+    "general.geo.countrycode": 1,
+    "general.geo.city": 1,
+    "general.organization": 1,
+    "general.asn": 1,
+    # CVE references, expanded with their details for the page
+    "vulnerability": 1,
+}
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(last_id.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise QueryError("Invalid cursor")
+
+
+def _plan_stages(plan):
+    """Stage names of a winning plan, outermost first."""
+    stages = []
+    while plan:
+        stage = plan.get("stage")
+        if plan.get("indexName"):
+            stage = f"{stage}({plan['indexName']})"
+        stages.append(stage)
+        inputs = plan.get("inputStages") or [plan.get("inputStage")]
+        plan = inputs[0] if inputs and inputs[0] else None
+    return stages
+
+
+def summarize_explain(explain):
+    stats = explain.get("executionStats", {})
+    return {
+        "plan": _plan_stages(explain.get("queryPlanner", {}).get("winningPlan")),
+        "returned": stats.get("nReturned"),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "time_ms": stats.get("executionTimeMillis"),
+    }
+
+
+def build_filter(query, cursor=None, text=None):
+    """Mongo filter of a DSL query and cursor; raises QueryError."""
+    mongo_filter = compile_query(query, text)
+    if cursor:
+        after = {"_id": {"$gt": decode_cursor(cursor)}}
+        mongo_filter = {"$and": [mongo_filter, after]} if mongo_filter else after
+    return mongo_filter
+
+
+def search(query, cursor=None, limit=20, explain=False, text=None):
+    """Run a DSL query and return one page of results."""
+    return search_filter(build_filter(query, cursor, text), limit, explain)
+
+
+def search_filter(mongo_filter, limit=20, explain=False):
+    """Return one page of the hosts matching a filter from build_filter.
+
+    Results are ordered by _id and paged with an opaque cursor holding the
+    last _id of the page, so a page never skips through earlier results.
+    The (field, _id) indexes in shared_libs.mongo_indexes return the hosts
+    of an equality filter already in that order.
+    """
+    limit = min(limit, SEARCH_MAX_LIMIT)
+    collection = get_collection(_COLLECTION)
+    find = (
+        collection.find(mongo_filter, SEARCH_PROJECTION)
+        .sort("_id", 1)
+        .limit(limit + 1)
+        .max_time_ms(SEARCH_MAX_TIME_MS)
+    )
+    docs = list(find)
+    next_cursor = encode_cursor(docs[limit - 1]["_id"]) if len(docs) > limit else None
+    docs = resolve_vulnerabilities(docs[:limit])
+    page = {
+        "results": [{"ip": doc.pop("_id"), **doc} for doc in docs],
+        "next": next_cursor,
+    }
+    if explain:
+        page["explain"] = {
+            "filter": repr(mongo_filter),
+            **summarize_explain(find.explain()),
+        }
+    return page
@@ -0,0 +1,8 @@
+from celery import shared_task
+
+from api_applications.search.facets import update_rollups
+
+
+@shared_task
+def update_facet_rollups_task(full=False):
+    update_rollups(full)
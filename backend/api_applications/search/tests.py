@@ -1,3 +1,297 @@
-from django.test import TestCase
+import re
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from pymongo.errors import DuplicateKeyError
+from django.test import SimpleTestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+
+from api_applications.search import facets, services
+from api_applications.shared_libs.lru import LRUCache
+from api_applications.shared_libs.mongo_indexes import SCAN_RESULTS_INDEXES
+from api_applications.shared_models import schema
+from api_applications.search.filters import QueryError, compile_query, parse_query
+
+User = get_user_model()
+
+
+class QueryParserTests(SimpleTestCase):
+
+    def test_terms(self):
+        terms = parse_query('port:22 -country:"United States" nginx')
+        self.assertEqual([(t.field, t.value, t.negate, t.phrase) for t in terms], [
+            ("port", "22", False, False),
+            ("country", "United States", True, True),
+            (None, "nginx", False, False),
+        ])
+
+    def test_fields_compile_to_indexed_paths(self):
+        query = compile_query('port:22 country:DE org:"Hetzner Online GmbH" nginx')
+        self.assertEqual(query["$and"][:3], [
+            {"ports": 22},
+            {"general.geo.countrycode": "DE"},
+            {"general.organization": "Hetzner Online GmbH"},
+        ])
+        self.assertEqual(query["$and"][3]["service_keys"].pattern, "^nginx:")
+
+    def test_country_matches_enriched_host(self):
+        # the document enrichment stores for an ip-api answer in Germany
+        geo = schema.GeoInfo(country="Germany", countrycode="DE", city="Berlin",
+                             regionname="Berlin", latlang=None)
+        host = {"general": schema.GeneralInfo(
+            geo=geo, isp=None, organization=None, asn=None).dict()}
+        for query in ("country:DE", "country:de", "country:Germany"):
+            with self.subTest(query=query):
+                (path, value), = compile_query(query).items()
+                stored = host
+                for part in path.split("."):
+                    stored = stored[part]
+                self.assertEqual(stored, value)
+
+    def test_equality_filters_read_hosts_in_id_order(self):
+        # pages are sorted by _id, which only (field, _id) indexes provide
+        indexed = {tuple(i.document["key"]) for i in SCAN_RESULTS_INDEXES}
+        for query in ("port:22", "country:DE", "country:Germany", "city:Berlin",
+                      "org:Hetzner", "nginx/1.18.0", "banner:apache"):
+            with self.subTest(query=query):
+                (path, _), = compile_query(query).items()
+                self.assertIn((path, "_id"), indexed)
+
+    def test_product_version(self):
+        self.assertEqual(compile_query("product:Apache version:2.4.29"),
+                         {"service_keys": "http_server:2.4.29"})
+        self.assertEqual(compile_query("nginx/1.18.0"),
+                         {"service_keys": "nginx:1.18.0"})
+
+    def test_net_and_asn(self):
+        query = compile_query("net:10.0.0.0/8 asn:24940")
+        self.assertEqual(query["$and"][0],
+                         {"ip_num": {"$gte": 167772160, "$lt": 184549376}})
+        self.assertTrue(query["$and"][1]["general.asn"].match("AS24940 Hetzner"))
+        self.assertFalse(query["$and"][1]["general.asn"].match("AS249401 Other"))
+
+    def test_negation(self):
+        self.assertEqual(compile_query("-port:80"), {"ports": {"$ne": 80}})
+        self.assertIsInstance(compile_query("-nginx")["service_keys"]["$not"], re.Pattern)
+        self.assertEqual(compile_query("-nginx/1.18.0"),
+                         {"service_keys": {"$ne": "nginx:1.18.0"}})
+        self.assertEqual(compile_query("nginx -nginx/1.18.0")["$and"][1],
+                         {"service_keys": {"$ne": "nginx:1.18.0"}})
+
+    def test_banner_terms(self):
+        query = compile_query('port:80 "Apache/2.4*" -banner:php')
+        self.assertEqual(query["$and"][0], {"ports": 80})
+        apache, php = query["$and"][1]["$and"]
+        self.assertEqual(apache["$and"][:2], [
+            {"banner_tokens": "apache"},
+            {"banner_tokens": re.compile("^2\\.4")},
+        ])
+        self.assertEqual(php, {"$nor": [{"banner_tokens": "php"}]})
+
+    def test_errors(self):
+        for query in ("port:ssh", "colour:red", "version:1.0", "net:nope",
+                      "after:yesterday", 'banner:"/"'):
+            with self.subTest(query=query), self.assertRaises(QueryError):
+                compile_query(query)
+
+
+class SearchServiceTests(SimpleTestCase):
+
+    def setUp(self):
+        self.collection = MagicMock()
+        patcher = patch("api_applications.search.services.get_collection",
+                        return_value=self.collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.find = self.collection.find.return_value.sort.return_value \
+            .limit.return_value.max_time_ms.return_value
+
+    def test_page_and_cursor(self):
+        self.find.__iter__.return_value = iter(
+            [{"_id": f"10.0.0.{n}", "ports": [22]} for n in range(3)])
+
+        page = services.search("port:22", limit=2)
+
+        self.assertEqual([r["ip"] for r in page["results"]], ["10.0.0.0", "10.0.0.1"])
+        self.assertEqual(services.decode_cursor(page["next"]), "10.0.0.1")
+        query, projection = self.collection.find.call_args[0]
+        self.assertEqual(query, {"ports": 22})
+        self.assertNotIn("service_type", projection)
+        self.collection.find.return_value.sort.assert_called_once_with("_id", 1)
+
+    def test_cursor_continues_after_last_id(self):
+        self.find.__iter__.return_value = iter([])
+        services.search("port:22", cursor=services.encode_cursor("10.0.0.1"))
+        self.assertEqual(self.collection.find.call_args[0][0], {"$and": [
+            {"ports": 22}, {"_id": {"$gt": "10.0.0.1"}}]})
+
+    def test_explain_summary(self):
+        self.find.__iter__.return_value = iter([])
+        self.find.explain.return_value = {
+            "queryPlanner": {"winningPlan": {
+                "stage": "LIMIT", "inputStage": {
+                    "stage": "FETCH", "inputStage": {
+                        "stage": "IXSCAN", "indexName": "ports_id"}}}},
+            "executionStats": {"nReturned": 0, "totalKeysExamined": 0,
+                               "totalDocsExamined": 0, "executionTimeMillis": 1},
+        }
+        page = services.search("port:22", explain=True)
+        self.assertEqual(page["explain"]["plan"], ["LIMIT", "FETCH", "IXSCAN(ports_id)"])
+
+
+class SearchViewTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="searcher", password="pass", email="searcher@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @patch("api_applications.search.views.QuotaService.consume", return_value=True)
+    @patch("api_applications.search.views.search_filter")
+    def test_search(self, mock_search, mock_consume):
+        mock_search.return_value = {"results": [{"ip": "1.1.1.1",
+                                                 "last_update": datetime(2024, 1, 1)}],
+                                    "next": None}
+        resp = self.client.get(reverse("search"), {"q": "port:22", "explain": "true"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data["results"][0]["ip"], "1.1.1.1")
+        # explain is only honoured in debug mode or for staff
+        self.assertFalse(mock_search.call_args[1]["explain"])
+
+    @patch("api_applications.shared_libs.mongo_fetch_result._cve_cache", LRUCache(10))
+    @patch("api_applications.shared_libs.mongo_fetch_result.get_collection")
+    @patch("api_applications.search.services.get_collection")
+    @patch("api_applications.search.views.QuotaService.consume", return_value=True)
+    def test_results_include_cve_details(self, mock_consume, mock_hosts, mock_cves):
+        mock_hosts.return_value.find.return_value.sort.return_value.limit.return_value \
+            .max_time_ms.return_value = [{"_id": "1.1.1.1", "vulnerability": {
+                "nginx": [{"cve_id": "CVE-2021-23017", "score": 7.7}]}}]
+        mock_cves.return_value.find.return_value = [
+            {"_id": "CVE-2021-23017", "description": "resolver off-by-one"}]
+
+        resp = self.client.get(reverse("search"), {"q": "port:443"})
+
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            resp.data["results"][0]["vulnerability"]["nginx"][0]["description"],
+            "resolver off-by-one")
+
+    @patch("api_applications.search.views.QuotaService.consume", return_value=True)
+    def test_bad_query(self, mock_consume):
+        resp = self.client.get(reverse("search"), {"q": "port:ssh"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("port:", resp.data["detail"])
+        # a query that cannot run costs no quota
+        mock_consume.assert_not_called()
+
+    @patch("api_applications.search.views.QuotaService.consume", return_value=True)
+    def test_unknown_facet_costs_no_quota(self, mock_consume):
+        resp = self.client.get(reverse("search_facets"),
+                               {"q": "port:22", "facets": "colour"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_consume.assert_not_called()
+
+
+class FacetTests(SimpleTestCase):
+
+    def setUp(self):
+        self.collections = {"scan_results": MagicMock(), "facet_counts": MagicMock()}
+        patcher = patch("api_applications.search.facets.get_collection",
+                        side_effect=lambda name: self.collections[name])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        rollup = self.collections["facet_counts"].find.return_value.sort.return_value
+        rollup.limit.return_value = [{"value": 22, "count": 900}]
+        self.collections["scan_results"].aggregate.return_value = [
+            {"_id": "nginx", "count": 7}]
+
+    def test_unfiltered_reads_rollup(self):
+        result = facets.facets("", ["port"])
+        self.assertEqual(result["port"], {"values": [{"value": 22, "count": 900}],
+                                          "sampled": False})
+        self.collections["facet_counts"].find.assert_called_once_with(
+            {"dim": "port", "scope": ""}, {"_id": 0, "value": 1, "count": 1})
+        self.collections["scan_results"].aggregate.assert_not_called()
+
+    def test_scope_filter_reads_scoped_rollup(self):
+        facets.facets("country:de", ["port"])
+        self.assertEqual(self.collections["facet_counts"].find.call_args[0][0],
+                         {"dim": "port", "scope": "country:DE"})
+
+    def test_country_name_is_sampled(self):
+        result = facets.facets('country:"Germany"', ["port"])
+        self.assertTrue(result["port"]["sampled"])
+        self.collections["facet_counts"].find.assert_not_called()
+
+    def test_other_filters_are_sampled(self):
+        result = facets.facets("port:22", ["product"])
+        self.assertTrue(result["product"]["sampled"])
+        pipeline = self.collections["scan_results"].aggregate.call_args[0][0]
+        self.assertEqual(pipeline[0], {"$match": {"ports": 22}})
+        self.assertEqual(pipeline[1], {"$limit": facets.FACET_SAMPLE_SIZE})
+
+    def test_unknown_facet(self):
+        with self.assertRaises(QueryError):
+            facets.facets("", ["colour"])
+
+    def test_host_keys(self):
+        host = {"ports": [22, 80], "service_keys": ["openssh:8.2p1", "nginx:1.18.0"],
+                "general": {"geo": {"countrycode": "DE"}, "organization": "Hetzner",
+                            "asn": ""}}
+        keys = facets.host_keys(host)
+        self.assertIn(("port", "", 22), keys)
+        self.assertIn(("product", "", "openssh"), keys)
+        self.assertIn(("port", "country:DE", 80), keys)
+        self.assertIn(("country", "", "DE"), keys)
+        self.assertNotIn(("country", "country:DE", "DE"), keys)
+        self.assertFalse(any(dim == "asn" for dim, _, _ in keys))
+
+    def test_apply_hosts_writes_only_the_difference(self):
+        self.collections["facet_hosts"] = MagicMock()
+        self.collections["facet_hosts"].find.return_value = [
+            {"_id": "1.1.1.1", "keys": [["port", "", 22], ["port", "", 80]]}]
+
+        changed = facets.apply_hosts([{"_id": "1.1.1.1", "ports": [22, 443]}])
+
+        self.assertEqual(changed, 2)
+        incs, deletes = [c.args[0] for c in
+                         self.collections["facet_counts"].bulk_write.call_args_list]
+        self.assertEqual(
+            sorted((op._filter["value"], op._doc["$inc"]["count"]) for op in incs),
+            [(80, -1), (443, 1)])
+        self.assertEqual([op._filter["value"] for op in deletes], [80])
+        replaced, = self.collections["facet_hosts"].bulk_write.call_args[0][0]
+        self.assertEqual(sorted(map(tuple, replaced._doc["keys"])),
+                         [("port", "", 22), ("port", "", 443)])
+
+    def test_update_reads_only_hosts_written_since_last_run(self):
+        for name in ("facet_hosts", "facet_state"):
+            self.collections[name] = MagicMock()
+        last = datetime(2024, 1, 1, 12, 0)
+        self.collections["facet_state"].find_one.return_value = {"at": last}
+        self.collections["scan_results"].find.return_value = []
+
+        facets.update_rollups()
+
+        query = self.collections["scan_results"].find.call_args[0][0]
+        since = last - timedelta(seconds=facets.FACET_WATERMARK_SLACK)
+        self.assertEqual(query, {"$or": [{"last_update": {"$gte": since}},
+                                         {"modified_at": {"$gte": since}}]})
+        self.collections["facet_counts"].delete_many.assert_not_called()
+        self.collections["facet_counts"].create_indexes.assert_not_called()
+        # the lease is released when the run ends
+        self.collections["facet_state"].delete_one.assert_called_once()
+
+    def test_update_skips_while_another_run_holds_the_lease(self):
+        self.collections["facet_state"] = MagicMock()
+        self.collections["facet_state"].find_one_and_update.side_effect = \
+            DuplicateKeyError("lease held")
+
+        self.assertIsNone(facets.update_rollups(full=True))
+
+        self.collections["scan_results"].find.assert_not_called()
+        self.collections["facet_counts"].delete_many.assert_not_called()
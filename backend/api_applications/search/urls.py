@@ -0,0 +1,8 @@
+from django.urls import path
+
+from .views import FacetView, SearchView
+
+urlpatterns = [
+    path("", SearchView.as_view(), name="search"),
+    path("facets/", FacetView.as_view(), name="search_facets"),
+]
@@ -1,3 +1,91 @@
-from django.shortcuts import render
+import logging
 
-# Create your views here.
+from django.conf import settings
+from pymongo.errors import ExecutionTimeout
+from rest_framework import permissions, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from api_applications.scan.services.quota.service import QuotaService
+
+from .facets import check_facets, facets
+from .filters import QueryError
+from .serializrs import FacetQuerySerializer, SearchQuerySerializer
+from .services import build_filter, search_filter
+
+logger = logging.getLogger(__name__)
+
+
+class SearchView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        serializer = SearchQuerySerializer(data=request.GET)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+
+        # a query that cannot run costs no quota
+        try:
+            mongo_filter = build_filter(params["q"], params.get("cursor"))
+        except QueryError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not QuotaService.consume(request.user, "query", 1):
+            return Response(
+                {"detail": "Query quota exhausted"}, status=status.HTTP_403_FORBIDDEN
+            )
+
+        try:
+            page = search_filter(
+                mongo_filter,
+                limit=params["limit"],
+                # query plans are only shown while debugging
+                explain=params["explain"] and (settings.DEBUG or request.user.is_staff),
+            )
+        except ExecutionTimeout:
+            return Response(
+                {"detail": "Query took too long, add more filters"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        except Exception as e:
+            logger.error(f"Search failed: {e}")
+            return Response(
+                {"detail": "Search failed"}, status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        return Response(page, status=status.HTTP_200_OK)
+
+
+class FacetView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        serializer = FacetQuerySerializer(data=request.GET)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+
+        dims = [d.strip() for d in params["facets"].split(",") if d.strip()]
+        try:
+            check_facets(params["q"], dims)
+        except QueryError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not QuotaService.consume(request.user, "query", 1):
+            return Response(
+                {"detail": "Query quota exhausted"}, status=status.HTTP_403_FORBIDDEN
+            )
+
+        try:
+            result = facets(params["q"], dims, params["size"])
+        except QueryError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ExecutionTimeout:
+            return Response(
+                {"detail": "Query took too long, add more filters"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        except Exception as e:
+            logger.error(f"Facets failed: {e}")
+            return Response(
+                {"detail": "Facets failed"}, status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        return Response({"facets": result}, status=status.HTTP_200_OK)
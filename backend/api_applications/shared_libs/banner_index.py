@@ -0,0 +1,65 @@
+import os
+import re
+
+# lowercased words, keeping versions like "2.4.29" whole; "-" and "_" split
+# words, so "OpenSSH_7.6p1" is found by "openssh". Banners and queries go
+# through the same tokenizer, so they always agree
+_WORD_RE = re.compile(r"[a-z0-9]+(?:\.[a-z0-9]+)*")
+
+# multikey, one entry per distinct token of a host; answers exact and
+# anchored prefix lookups
+TOKENS_FIELD = "banner_tokens"
+# the tokens of each banner joined by spaces, one banner per line; only
+# read to check the word order of phrases on hosts the index matched
+TEXT_FIELD = "banner_text"
+
+BANNER_MAX_TOKENS = int(os.getenv("BANNER_MAX_TOKENS", "1024"))
+BANNER_MAX_TOKEN_LENGTH = int(os.getenv("BANNER_MAX_TOKEN_LENGTH", "64"))
+
+PREFIX = "*"
+
+
+def tokenize(text):
+    """
+    >>> tokenize("Server: Apache/2.4.29 (Ubuntu)")
+    ['server', 'apache', '2.4.29', 'ubuntu']
+    """
+    return [w[:BANNER_MAX_TOKEN_LENGTH] for w in _WORD_RE.findall(text.lower())]
+
+
+def banner_fields(service_type):
+    """The index fields of a host's {port: banner} service_type."""
+    banners = service_type.values() if isinstance(service_type, dict) else [service_type]
+    lines = [" ".join(tokenize(b)) for b in banners if isinstance(b, str)]
+    lines = [line for line in lines if line]
+    tokens = dict.fromkeys(t for line in lines for t in line.split())
+    return {
+        TOKENS_FIELD: list(tokens)[:BANNER_MAX_TOKENS],
+        TEXT_FIELD: "\n".join(lines),
+    }
+
+
+def match(text):
+    """Mongo condition for hosts whose banners contain text.
+
+    Several words are a phrase and must appear in that order; a trailing
+    "*" makes the last word a prefix. Every word narrows the match through
+    the banner_tokens index, and only the hosts it returns have their
+    banner_text checked for the word order.
+    """
+    prefix = text.endswith(PREFIX)
+    words = tokenize(text.rstrip(PREFIX))
+    if not words:
+        raise ValueError(f"No words to search for in {text!r}")
+
+    exact = words[:-1] if prefix else words
+    conditions = [{TOKENS_FIELD: word} for word in dict.fromkeys(exact)]
+    if prefix:
+        conditions.append({TOKENS_FIELD: re.compile(f"^{re.escape(words[-1])}")})
+    if len(words) > 1:
+        phrase = " ".join(re.escape(w) for w in words)
+        end = r"\S*" if prefix else r"(?:\s|$)"
+        conditions.append({TEXT_FIELD: re.compile(rf"(?:^|\s){phrase}{end}")})
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
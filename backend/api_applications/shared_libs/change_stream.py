@@ -0,0 +1,122 @@
+import logging
+import os
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from . import monogo_connections
+
+# "broker" republishes every batch through RabbitMQ; "change_stream" lets
+# the downstream stages follow scan_results directly. Change streams need
+# MongoDB to run as a replica set (a single node is enough).
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "broker")
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "100"))
+# ms the server waits for more changes before a partial batch is handed on
+STREAM_MAX_AWAIT_MS = int(os.getenv("STREAM_MAX_AWAIT_MS", "1000"))
+TOKEN_COLLECTION = os.getenv("STREAM_TOKEN_COLLECTION", "stream_resume_tokens")
+
+# the resume token is older than the oplog, the stream cannot pick it up
+_HISTORY_LOST = 286
+
+
+def uses_change_streams():
+    return PIPELINE_MODE == "change_stream"
+
+
+def fields_changed(fields, project=None):
+    """Pipeline for inserts and updates that touch one of fields.
+
+    project limits the looked-up document to the fields the stage reads.
+    """
+    written = [{f"fullDocument.{field}": {"$exists": True}} for field in fields]
+    updated = [
+        {f"updateDescription.updatedFields.{field}": {"$exists": True}}
+        for field in fields
+    ]
+    pipeline = [{"$match": {"$or": [
+        {"operationType": {"$in": ["insert", "replace"]}, "$or": written},
+        {"operationType": "update", "$or": updated},
+    ]}}]
+    if project:
+        pipeline.append({"$project": {
+            "operationType": 1,
+            "fullDocument._id": 1,
+            **{f"fullDocument.{field}": 1 for field in project},
+        }})
+    return pipeline
+
+
+def load_token(db, name):
+    saved = db[TOKEN_COLLECTION].find_one({"_id": name})
+    return saved["token"] if saved else None
+
+
+def save_token(db, name, token):
+    db[TOKEN_COLLECTION].update_one(
+        {"_id": name}, {"$set": {"token": token}}, upsert=True)
+
+
+class StreamConsumer:
+    """Feed a stage from a change stream on scan_results.
+
+    Changes are handed to handle() in batches of up to batch_size
+    documents. The resume token is saved after handle() returns, so after
+    a crash the stream restarts at the first batch not yet handled; a batch
+    may be handled twice but never skipped.
+    """
+
+    def __init__(self, name, pipeline, handle, batch_size=STREAM_BATCH_SIZE,
+                 max_await_ms=STREAM_MAX_AWAIT_MS):
+        self.name = name
+        self.pipeline = pipeline
+        self.handle = handle
+        self.batch_size = batch_size
+        self.max_await_ms = max_await_ms
+        self._saved_token = None
+
+    def _open(self, db):
+        return db.scan_results.watch(
+            self.pipeline, full_document="updateLookup",
+            resume_after=load_token(db, self.name),
+            max_await_time_ms=self.max_await_ms)
+
+    def poll(self, db, stream):
+        """Handle one batch; return the number of documents handed on."""
+        batch = []
+        while len(batch) < self.batch_size:
+            change = stream.try_next()
+            if change is None:
+                break
+            document = change.get("fullDocument")
+            # None when the host was deleted before the lookup ran
+            if document is not None:
+                batch.append(document)
+        if batch:
+            self.handle(batch)
+        token = stream.resume_token
+        if token is not None and token != self._saved_token:
+            save_token(db, self.name, token)
+            self._saved_token = token
+        return len(batch)
+
+    def run(self):
+        while True:
+            try:
+                db = monogo_connections.connect_monogo()
+                with self._open(db) as stream:
+                    logging.info(f"[change_stream] {self.name}: watching scan_results")
+                    while stream.alive:
+                        self.poll(db, stream)
+            except OperationFailure as e:
+                if e.code != _HISTORY_LOST:
+                    logging.error(f"[change_stream] {self.name}: stream failed: {e}")
+                    time.sleep(3)
+                    continue
+                logging.error(
+                    f"[change_stream] {self.name}: resume token expired, "
+                    f"changes since it are lost; starting from now")
+                db[TOKEN_COLLECTION].delete_one({"_id": self.name})
+                self._saved_token = None
+            except PyMongoError as e:
+                logging.error(f"[change_stream] {self.name}: stream failed: {e}")
+                time.sleep(3)
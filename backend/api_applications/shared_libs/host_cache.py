@@ -0,0 +1,119 @@
+import copy
+import os
+import threading
+import time
+
+from bson import json_util
+
+from .lru import LRUCache
+from .redis_tier import RedisTier, client_from_url
+
+HOST_CACHE_SIZE = int(os.getenv("HOST_CACHE_SIZE", "10000"))
+# the local tier of another process is not reachable when a stage writes a
+# host, so its entries only live this long
+HOST_CACHE_TTL = float(os.getenv("HOST_CACHE_TTL", "30"))
+HOST_CACHE_REDIS_TTL = int(os.getenv("HOST_CACHE_REDIS_TTL", "300"))
+# opt-in: the shared tier is only used when a URL is configured
+HOST_CACHE_REDIS_URL = os.getenv("HOST_CACHE_REDIS_URL")
+
+FULL_DOCUMENT = "*"
+
+
+def projection_key(fields):
+    """Stable name of a projection; FULL_DOCUMENT when there is none."""
+    return ",".join(sorted(fields)) if fields else FULL_DOCUMENT
+
+
+class HostCache:
+    """Read-through cache of host documents keyed by (ip, projection).
+
+    The local tier is an LRU whose entries expire after ttl seconds. The
+    optional Redis tier keeps every projection of a host in one hash, so a
+    pipeline stage that writes the host drops all of them with one DEL.
+    """
+
+    def __init__(self, max_size=HOST_CACHE_SIZE, ttl=HOST_CACHE_TTL,
+                 redis_client=None, redis_ttl=HOST_CACHE_REDIS_TTL):
+        self.ttl = ttl
+        self.shared = RedisTier(redis_client, "host_cache")
+        self.redis_ttl = redis_ttl
+        self._local = LRUCache(max_size)
+        self._projections = set()
+        self._lock = threading.Lock()
+        self.hits = self.shared_hits = self.misses = 0
+
+    @staticmethod
+    def _redis_key(ip):
+        return f"host:{ip}"
+
+    def get_many(self, ips, projection):
+        """Return {ip: document} for the ips cached under projection."""
+        now = time.monotonic()
+        found = {}
+        for (ip, _), (expires, doc) in self._local.get_many(
+                [(ip, projection) for ip in ips]).items():
+            if expires > now:
+                found[ip] = copy.deepcopy(doc)
+
+        missing = [ip for ip in ips if ip not in found]
+        if missing:
+            values = self.shared.pipeline(
+                lambda pipe: [pipe.hget(self._redis_key(ip), projection) for ip in missing],
+                default=[],
+            )
+            for ip, value in zip(missing, values):
+                if value is not None:
+                    doc = json_util.loads(value)
+                    self._put_local(ip, projection, doc)
+                    found[ip] = doc
+                    self.shared_hits += 1
+        self.hits += len(ips) - len(missing)
+        self.misses += len(ips) - len(found)
+        return found
+
+    def _put_local(self, ip, projection, doc):
+        with self._lock:
+            self._projections.add(projection)
+        self._local.put((ip, projection), (time.monotonic() + self.ttl, copy.deepcopy(doc)))
+
+    def put_many(self, docs, projection):
+        for ip, doc in docs.items():
+            self._put_local(ip, projection, doc)
+        if not docs:
+            return
+
+        def commands(pipe):
+            for ip, doc in docs.items():
+                pipe.hset(self._redis_key(ip), projection, json_util.dumps(doc))
+                pipe.expire(self._redis_key(ip), self.redis_ttl)
+
+        self.shared.pipeline(commands)
+
+    def invalidate(self, ips):
+        """Drop every cached projection of ips, locally and in Redis."""
+        ips = list(ips)
+        with self._lock:
+            projections = list(self._projections)
+        for ip in ips:
+            for projection in projections:
+                self._local.pop((ip, projection))
+        if ips:
+            self.shared.run(
+                lambda client: client.delete(*(self._redis_key(ip) for ip in ips)))
+
+    def clear(self):
+        self._local.clear()
+        self.hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            "size": len(self._local),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+        }
+
+
+cache = HostCache(redis_client=client_from_url(HOST_CACHE_REDIS_URL, "host_cache"))
@@ -0,0 +1,43 @@
+import ipaddress
+
+# numeric copy of the IPv4 _id; strings sort lexicographically, so only
+# this field lets a network be read as one contiguous index range
+IP_FIELD = "ip_num"
+
+
+def ip_to_int(ip):
+    """Integer value of an IPv4 address, or None for anything else."""
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    return int(addr) if addr.version == 4 else None
+
+
+def cidr_range(cidr):
+    """Return [start, end) of an IPv4 network as integers."""
+    net = ipaddress.ip_network(cidr, strict=False)
+    if net.version != 4:
+        raise ValueError(f"{cidr} is not an IPv4 network")
+    start = int(net.network_address)
+    return start, start + net.num_addresses
+
+
+def cidr_query(cidr, field=IP_FIELD):
+    """Mongo filter matching the hosts inside cidr: {field: {$gte, $lt}}."""
+    start, end = cidr_range(cidr)
+    return {field: {"$gte": start, "$lt": end}}
+
+
+def networks_query(cidrs, field=IP_FIELD):
+    """Filter for hosts inside any of cidrs; overlapping networks are merged."""
+    ranges = []
+    for start, end in sorted(cidr_range(c) for c in cidrs):
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    clauses = [{field: {"$gte": start, "$lt": end}} for start, end in ranges]
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"$or": clauses}
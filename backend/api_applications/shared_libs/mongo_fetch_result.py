@@ -1,12 +1,19 @@
 import logging
 import os
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
 from dotenv import load_dotenv
+from .host_cache import cache as host_cache, projection_key
+from .lru import LRUCache
 from .monogo_connections import connect_monogo
 
 load_dotenv()
 
-_COLLECTION = os.getenv("MONGO_COLLECTION")
+_COLLECTION = os.getenv("MONGO_COLLECTION", "scan_results")
+_CVE_COLLECTION = os.getenv("MONGO_CVE_COLLECTION", "cves")
+CVE_CACHE_SIZE = int(os.getenv("CVE_CACHE_SIZE", "20000"))
+
+# CVE details rarely change and are shared by many hosts
+_cve_cache = LRUCache(CVE_CACHE_SIZE)
 
 
 def get_collection(name):
@@ -17,9 +24,82 @@ def get_collection(name):
         raise Exception("connect_mongo() returned None (DB connection failed)")
 
 
-def fetch_by_ip(ip: str) -> Optional[dict[str, Any]]:
-    try:
-        collection = get_collection(_COLLECTION)
-        return collection.find_one({"_id": ip})
-    except Exception as e:
-        logging.info(f"[mongo_fetch_result] ERROR: {e}")
+def fetch_cves(cve_ids: Iterable[str]) -> dict[str, dict[str, Any]]:
+    """Return {cve_id: details}, from the LRU or one $in query for the rest."""
+    ids = list(dict.fromkeys(cve_ids))
+    found = _cve_cache.get_many(ids)
+    missing = [cve_id for cve_id in ids if cve_id not in found]
+    if missing:
+        try:
+            collection = get_collection(_CVE_COLLECTION)
+            for doc in collection.find({"_id": {"$in": missing}}):
+                details = {"cve_id": doc.pop("_id"), **doc}
+                found[details["cve_id"]] = details
+                _cve_cache.put(details["cve_id"], details)
+        except Exception as e:
+            logging.info(f"[mongo_fetch_result] ERROR: {e}")
+    return found
+
+
+def resolve_vulnerabilities(hosts: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Expand the CVE references of host documents into full details.
+
+    Hosts only store {cve_id, score}; the details of every host in the
+    list are fetched together and merged into the references in place.
+    """
+    refs = [
+        ref
+        for host in hosts
+        for matches in (host.get("vulnerability") or {}).values()
+        for ref in matches
+    ]
+    details = fetch_cves(ref["cve_id"] for ref in refs)
+    for ref in refs:
+        ref.update({k: v for k, v in details.get(ref["cve_id"], {}).items()
+                    if k not in ref})
+    return hosts
+
+
+def fetch_many_by_ip(
+    ips: Iterable[str],
+    fields: Optional[Iterable[str]] = None,
+    resolve_cves: bool = False,
+) -> dict[str, dict[str, Any]]:
+    """Return {ip: document} for the ips that exist.
+
+    fields limits the documents to those fields (_id is always included).
+    Cached documents are served from host_cache; the rest are read with
+    one $in query and cached under the same projection. resolve_cves
+    expands the CVE references of the documents with their details.
+    """
+    ips = list(dict.fromkeys(ips))
+    fields = list(fields) if fields else None
+    projection = projection_key(fields)
+    found = host_cache.get_many(ips, projection)
+    missing = [ip for ip in ips if ip not in found]
+    if missing:
+        try:
+            collection = get_collection(_COLLECTION)
+            fetched = {
+                doc["_id"]: doc
+                for doc in collection.find(
+                    {"_id": {"$in": missing}},
+                    dict.fromkeys(fields, 1) if fields else None,
+                )
+            }
+            host_cache.put_many(fetched, projection)
+            found.update(fetched)
+        except Exception as e:
+            logging.info(f"[mongo_fetch_result] ERROR: {e}")
+    if resolve_cves:
+        # host_cache hands out copies, so the cached references stay bare
+        resolve_vulnerabilities(list(found.values()))
+    return found
+
+
+def fetch_by_ip(
+    ip: str,
+    fields: Optional[Iterable[str]] = None,
+    resolve_cves: bool = False,
+) -> Optional[dict[str, Any]]:
+    return fetch_many_by_ip([ip], fields, resolve_cves).get(ip)
@@ -0,0 +1,88 @@
+import logging
+
+from pymongo import ASCENDING, IndexModel
+
+# every index scan_results queries rely on; `manage.py mongo_indexes`
+# creates the missing ones and the scanners warn at startup
+#
+# Search pages are sorted by _id, so each searchable field is indexed as
+# (field, _id): an equality match then reads its hosts already in _id
+# order and a page stops after `limit` keys, with no in-memory sort. Every
+# other query on the field uses the same index through its prefix.
+SCAN_RESULTS_INDEXES = [
+    # multikey: one entry per open port
+    IndexModel([("ports", ASCENDING), ("_id", ASCENDING)], name="ports_id"),
+    IndexModel([("last_update", ASCENDING)], name="last_update_1"),
+    # hosts the write buffer changed since a point in time
+    IndexModel([("modified_at", ASCENDING)], name="modified_at_1"),
+    # country: searches by ISO code, which is what users type
+    IndexModel(
+        [("general.geo.countrycode", ASCENDING), ("_id", ASCENDING)],
+        name="geo_countrycode_id",
+    ),
+    IndexModel(
+        [("general.geo.country", ASCENDING), ("_id", ASCENDING)],
+        name="geo_country_id",
+    ),
+    IndexModel([("general.geo.city", ASCENDING), ("_id", ASCENDING)], name="geo_city_id"),
+    IndexModel([("general.asn", ASCENDING), ("_id", ASCENDING)], name="asn_id"),
+    IndexModel(
+        [("general.organization", ASCENDING), ("_id", ASCENDING)],
+        name="organization_id",
+    ),
+    IndexModel([("ip_num", ASCENDING)], name="ip_num_1"),
+    IndexModel([("service_keys", ASCENDING), ("_id", ASCENDING)], name="service_keys_id"),
+    # banner search: one entry per distinct banner word of a host
+    IndexModel([("banner_tokens", ASCENDING), ("_id", ASCENDING)], name="banner_tokens_id"),
+    # only hosts with no open ports, which the rescan reads by network
+    IndexModel(
+        [("ip_num", ASCENDING)],
+        name="down_hosts",
+        partialFilterExpression={"ports": {"$eq": []}},
+    ),
+]
+
+
+def declared_names(indexes=SCAN_RESULTS_INDEXES):
+    return [index.document["name"] for index in indexes]
+
+
+def missing_indexes(collection, indexes=SCAN_RESULTS_INDEXES):
+    existing = set(collection.index_information())
+    return [name for name in declared_names(indexes) if name not in existing]
+
+
+def ensure_indexes(collection, indexes=SCAN_RESULTS_INDEXES):
+    """Create the declared indexes that do not exist yet.
+
+    Since MongoDB 4.2 index builds only lock the collection briefly at the
+    start and end, so reads and writes carry on while they run.
+    """
+    missing = set(missing_indexes(collection, indexes))
+    models = [index for index in indexes if index.document["name"] in missing]
+    if not models:
+        return []
+    return collection.create_indexes(models)
+
+
+def index_usage(collection):
+    """{name: ops} from $indexStats; counters reset when mongod restarts."""
+    return {
+        stat["name"]: stat["accesses"]["ops"]
+        for stat in collection.aggregate([{"$indexStats": {}}])
+    }
+
+
+def check_indexes(collection, indexes=SCAN_RESULTS_INDEXES):
+    """Log the declared indexes that are missing; return their names."""
+    try:
+        missing = missing_indexes(collection, indexes)
+    except Exception as e:
+        logging.error(f"[mongo_indexes] Could not check indexes: {e}")
+        return []
+    if missing:
+        logging.warning(
+            f"[mongo_indexes] {collection.name} is missing indexes {missing}; "
+            "run `manage.py mongo_indexes` to create them"
+        )
+    return missing
@@ -0,0 +1,49 @@
+import logging
+
+try:
+    import redis
+except ImportError:  # the shared tier is optional
+    redis = None
+
+
+def client_from_url(url, name):
+    """Redis client for url, or None when redis is not installed or no url is set."""
+    if redis is None or not url:
+        return None
+    try:
+        return redis.Redis.from_url(url, socket_timeout=1)
+    except Exception as e:
+        logging.warning(f"[{name}] shared tier disabled: {e}")
+        return None
+
+
+class RedisTier:
+    """Optional Redis tier a cache shares between processes.
+
+    Every call goes through run(); the first error turns the tier off for
+    the life of the process, so a broken Redis does not cost a timeout on
+    every lookup.
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def run(self, operation, default=None):
+        """Return operation(client), or default when the tier is off or fails."""
+        if self.client is None:
+            return default
+        try:
+            return operation(self.client)
+        except Exception as e:
+            logging.warning(f"[{self.name}] shared tier disabled: {e}")
+            self.client = None
+            return default
+
+    def pipeline(self, commands, default=None):
+        """Queue commands(pipe) and send them in one round trip."""
+        def execute(client):
+            pipe = client.pipeline(transaction=False)
+            commands(pipe)
+            return pipe.execute()
+        return self.run(execute, default)
@@ -0,0 +1,534 @@
+import os
+import re
+import sys
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from pymongo.errors import BulkWriteError
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+
+sys.path.append(parent_dir)
+
+from shared_libs import banner_index
+from shared_libs import change_stream
+from shared_libs import host_cache
+from shared_libs import ip_ranges
+from shared_libs import lru
+from shared_libs import mongo_indexes
+from shared_libs import redis_tier
+from shared_libs import write_buffer
+from shared_libs import mongo_fetch_result
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = lru.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual(cache.get_many(["a", "b", "c"]), {"a": 1, "c": 3})
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+
+class TestIPRanges(unittest.TestCase):
+
+    def test_cidr_becomes_half_open_range(self):
+        self.assertEqual(
+            ip_ranges.cidr_query("203.0.113.0/24"),
+            {"ip_num": {"$gte": 3405803776, "$lt": 3405804032}},
+        )
+        # host bits are ignored, a single address is a one-wide range
+        self.assertEqual(ip_ranges.cidr_range("203.0.113.7/24"), (3405803776, 3405804032))
+        self.assertEqual(ip_ranges.cidr_range("10.0.0.1"), (167772161, 167772162))
+
+    def test_overlapping_networks_merge(self):
+        query = ip_ranges.networks_query(["10.0.1.0/24", "10.0.0.0/23", "192.168.0.0/16"])
+        self.assertEqual(query, {"$or": [
+            {"ip_num": {"$gte": 167772160, "$lt": 167772672}},
+            {"ip_num": {"$gte": 3232235520, "$lt": 3232301056}},
+        ]})
+
+    def test_non_ipv4(self):
+        self.assertIsNone(ip_ranges.ip_to_int("2001:db8::1"))
+        self.assertIsNone(ip_ranges.ip_to_int("example.com"))
+        self.assertEqual(ip_ranges.ip_to_int("0.0.1.0"), 256)
+        with self.assertRaises(ValueError):
+            ip_ranges.cidr_range("2001:db8::/32")
+
+
+class TestResolveVulnerabilities(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch("shared_libs.mongo_fetch_result._cve_cache", lru.LRUCache(10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.collection = MagicMock()
+        self.collection.find.side_effect = lambda query: [
+            {"_id": cve_id, "description": f"about {cve_id}", "score": 5.0}
+            for cve_id in query["_id"]["$in"]
+        ]
+        patcher = patch("shared_libs.mongo_fetch_result.get_collection",
+                        return_value=self.collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hosts(self):
+        return [
+            {"_id": "1.1.1.1", "vulnerability": {
+                "OpenSSH": [{"cve_id": "CVE-1", "score": 7.0},
+                            {"cve_id": "CVE-2", "score": 5.0}]}},
+            {"_id": "2.2.2.2", "vulnerability": {
+                "nginx": [{"cve_id": "CVE-2", "score": 5.0}]}},
+            {"_id": "3.3.3.3", "vulnerability": ""},
+        ]
+
+    def test_one_query_for_all_hosts(self):
+        hosts = mongo_fetch_result.resolve_vulnerabilities(self.hosts())
+
+        self.collection.find.assert_called_once_with(
+            {"_id": {"$in": ["CVE-1", "CVE-2"]}})
+        ref = hosts[0]["vulnerability"]["OpenSSH"][0]
+        # the score stored on the host wins over the CVE document
+        self.assertEqual(ref, {"cve_id": "CVE-1", "score": 7.0,
+                               "description": "about CVE-1"})
+        self.assertEqual(hosts[1]["vulnerability"]["nginx"][0]["description"],
+                         "about CVE-2")
+
+    def test_cached_details_skip_the_query(self):
+        mongo_fetch_result.resolve_vulnerabilities(self.hosts())
+        hosts = mongo_fetch_result.resolve_vulnerabilities(self.hosts())
+
+        self.collection.find.assert_called_once()
+        self.assertEqual(hosts[1]["vulnerability"]["nginx"][0]["description"],
+                         "about CVE-2")
+
+    def test_fetch_resolves_copies_of_cached_hosts(self):
+        cache = host_cache.HostCache(max_size=10, ttl=60)
+        hosts = {host["_id"]: host for host in self.hosts()}
+        cves = self.collection.find.side_effect
+        # hosts are read with a projection argument, CVEs without one
+        self.collection.find.side_effect = lambda query, *projection: (
+            [hosts[ip] for ip in query["_id"]["$in"]] if projection else cves(query))
+        with patch("shared_libs.mongo_fetch_result.host_cache", cache):
+            host = mongo_fetch_result.fetch_by_ip("1.1.1.1", resolve_cves=True)
+            bare = mongo_fetch_result.fetch_by_ip("1.1.1.1")
+
+        self.assertEqual(host["vulnerability"]["OpenSSH"][0]["description"], "about CVE-1")
+        self.assertEqual(bare["vulnerability"]["OpenSSH"][0],
+                         {"cve_id": "CVE-1", "score": 7.0})
+
+
+class TestMongoIndexes(unittest.TestCase):
+
+    def test_creates_only_missing_indexes(self):
+        collection = MagicMock()
+        collection.index_information.return_value = {
+            "_id_": {}, "ports_id": {}, "ip_num_1": {}}
+        collection.create_indexes.side_effect = lambda models: [
+            m.document["name"] for m in models]
+
+        created = mongo_indexes.ensure_indexes(collection)
+
+        self.assertNotIn("ports_id", created)
+        self.assertIn("down_hosts", created)
+        self.assertEqual(len(created), len(mongo_indexes.SCAN_RESULTS_INDEXES) - 2)
+
+    def test_down_hosts_index_is_partial(self):
+        down = next(i for i in mongo_indexes.SCAN_RESULTS_INDEXES
+                    if i.document["name"] == "down_hosts")
+        self.assertEqual(down.document["partialFilterExpression"], {"ports": {"$eq": []}})
+
+    def test_index_usage(self):
+        collection = MagicMock()
+        collection.aggregate.return_value = [
+            {"name": "ports_id", "accesses": {"ops": 4}},
+            {"name": "asn_id", "accesses": {"ops": 0}},
+        ]
+        self.assertEqual(mongo_indexes.index_usage(collection),
+                         {"ports_id": 4, "asn_id": 0})
+        collection.aggregate.assert_called_once_with([{"$indexStats": {}}])
+
+    def test_check_logs_missing(self):
+        collection = MagicMock()
+        collection.index_information.return_value = {"_id_": {}}
+        with self.assertLogs(level="WARNING"):
+            missing = mongo_indexes.check_indexes(collection)
+        self.assertEqual(missing, mongo_indexes.declared_names())
+
+
+class TestBannerIndex(unittest.TestCase):
+
+    BANNERS = {
+        "22": "SSH:\nSSH-2.0-OpenSSH_7.6p1 Ubuntu-4ubuntu0.3",
+        "80": "HTTP:\nServer: Apache/2.4.29 (Ubuntu)\nX-Powered-By: PHP/7.4.3",
+    }
+
+    def matches(self, text):
+        # evaluate the condition the way Mongo would on one document
+        fields = banner_index.banner_fields(self.BANNERS)
+        condition = banner_index.match(text)
+        for c in condition.get("$and", [condition]):
+            (field, value), = c.items()
+            if isinstance(value, re.Pattern):
+                values = fields[field] if isinstance(fields[field], list) else [fields[field]]
+                if not any(value.search(v) for v in values):
+                    return False
+            elif value not in fields[field]:
+                return False
+        return True
+
+    def test_fields(self):
+        fields = banner_index.banner_fields(self.BANNERS)
+        self.assertIn("2.4.29", fields["banner_tokens"])
+        self.assertEqual(len(fields["banner_tokens"]), len(set(fields["banner_tokens"])))
+        self.assertEqual(fields["banner_text"].splitlines()[1],
+                         "http server apache 2.4.29 ubuntu x powered by php 7.4.3")
+        self.assertEqual(banner_index.banner_fields(""),
+                         {"banner_tokens": [], "banner_text": ""})
+
+    def test_word_and_phrase(self):
+        self.assertEqual(banner_index.match("Apache"), {"banner_tokens": "apache"})
+        self.assertTrue(self.matches('Apache/2.4.29'))
+        self.assertTrue(self.matches("X-Powered-By: PHP"))
+        self.assertFalse(self.matches("PHP X-Powered-By"))
+        self.assertFalse(self.matches("Apache/2.4"))
+
+    def test_prefix(self):
+        self.assertEqual(banner_index.match("open*"),
+                         {"banner_tokens": re.compile("^open")})
+        self.assertTrue(self.matches("Apache/2.4*"))
+        self.assertTrue(self.matches("openssh*"))
+        self.assertFalse(self.matches("nginx/1*"))
+
+    def test_phrase_stays_within_one_banner(self):
+        self.assertFalse(self.matches("4ubuntu0.3 http"))
+
+    def test_no_words(self):
+        with self.assertRaises(ValueError):
+            banner_index.match("/*")
+
+
+class TestWriteBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = MagicMock()
+        self.buffer = write_buffer.WriteBuffer(
+            lambda: self.collection, max_size=10, max_latency=60)
+
+    def written(self):
+        operations = self.collection.bulk_write.call_args[0][0]
+        for op in operations:
+            self.assertEqual(op._doc["$currentDate"], {write_buffer.MODIFIED_FIELD: True})
+        return {
+            op._filter["_id"]: {k: v for k, v in op._doc.items() if k != "$currentDate"}
+            for op in operations
+        }
+
+    def test_merges_updates_per_host(self):
+        self.buffer.add("1.1.1.1", {"ports": [22]}, {"service_type": ""})
+        self.buffer.add("1.1.1.1", {"service_type": {"22": "SSH"}})
+        self.buffer.add("2.2.2.2", {"domain": "b.example"})
+        self.collection.bulk_write.assert_not_called()
+
+        self.assertEqual(self.buffer.flush(), 2)
+
+        self.collection.bulk_write.assert_called_once()
+        self.assertEqual(self.collection.bulk_write.call_args[1], {"ordered": False})
+        self.assertEqual(self.written()["1.1.1.1"],
+                         {"$set": {"ports": [22], "service_type": {"22": "SSH"}}})
+        stats = self.buffer.stats()
+        self.assertEqual((stats["staged"], stats["written"]), (3, 2))
+        self.assertEqual(stats["merge_ratio"], 1.5)
+        self.assertEqual(stats["last_flush_size"], 2)
+
+    def test_later_unset_wins(self):
+        self.buffer.add("1.1.1.1", {"general": {"asn": "AS1"}})
+        self.buffer.add("1.1.1.1", unset_fields={"general": ""})
+        self.buffer.flush()
+        self.assertEqual(self.written()["1.1.1.1"], {"$unset": {"general": ""}})
+
+    def test_flushes_when_full(self):
+        self.buffer.add_many({f"10.0.0.{i}": ({"ports": []}, {}) for i in range(10)})
+        self.collection.bulk_write.assert_called_once()
+        self.assertEqual(self.buffer.stats()["pending"], 0)
+
+    def test_conflicting_path_flushes_first(self):
+        self.buffer.add("1.1.1.1", {"general": {"asn": "AS1"}})
+        self.buffer.add("1.1.1.1", {"general.asn": "AS2"})
+        self.assertEqual(self.written()["1.1.1.1"], {"$set": {"general": {"asn": "AS1"}}})
+        self.buffer.flush()
+        self.assertEqual(self.written()["1.1.1.1"], {"$set": {"general.asn": "AS2"}})
+
+    def test_flushes_after_latency(self):
+        buffer = write_buffer.WriteBuffer(
+            lambda: self.collection, max_size=10, max_latency=0.05)
+        buffer.add("1.1.1.1", {"ports": [80]})
+        for _ in range(50):
+            if self.collection.bulk_write.called:
+                break
+            time.sleep(0.01)
+        buffer.close()
+        self.collection.bulk_write.assert_called_once()
+        self.assertGreaterEqual(buffer.stats()["last_flush_latency"], 0.05)
+
+    def test_failed_flush_is_retried_under_newer_values(self):
+        self.collection.bulk_write.side_effect = Exception("down")
+        self.buffer.add("1.1.1.1", {"ports": [80], "general": {"asn": "AS1"},
+                                    "domain": "a.example"})
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(self.buffer.stats()["errors"], 1)
+        self.assertEqual(self.buffer.stats()["pending"], 1)
+
+        self.buffer.add("1.1.1.1", {"ports": [443], "general.asn": "AS2"})
+        self.collection.bulk_write.side_effect = None
+        self.assertEqual(self.buffer.flush(), 1)
+        # the newer port and ASN win; the failed domain is written again
+        self.assertEqual(self.written()["1.1.1.1"], {"$set": {
+            "ports": [443], "general.asn": "AS2", "domain": "a.example"}})
+
+    def test_only_failed_operations_are_retried(self):
+        self.buffer.add("1.1.1.1", {"ports": [80]})
+        self.buffer.add("2.2.2.2", {"ports": [22]})
+        self.collection.bulk_write.side_effect = BulkWriteError(
+            {"writeErrors": [{"index": 1, "errmsg": "boom"}]})
+        self.buffer.flush()
+
+        self.collection.bulk_write.side_effect = None
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(list(self.written()), ["2.2.2.2"])
+
+    def test_dropped_after_max_retries(self):
+        buffer = write_buffer.WriteBuffer(
+            lambda: self.collection, max_size=10, max_latency=60, max_retries=2)
+        self.collection.bulk_write.side_effect = Exception("down")
+        buffer.add("1.1.1.1", {"ports": [80]})
+        for _ in range(3):
+            buffer.flush()
+        self.assertEqual(self.collection.bulk_write.call_count, 3)
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(self.collection.bulk_write.call_count, 3)
+        self.assertEqual(buffer.stats()["dropped"], 1)
+
+
+class FakeStream:
+
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.resume_token = None
+
+    def try_next(self):
+        if not self.changes:
+            return None
+        change = self.changes.pop(0)
+        self.resume_token = change["_id"]
+        return change
+
+
+class TestChangeStream(unittest.TestCase):
+
+    def test_fields_changed_pipeline(self):
+        pipeline = change_stream.fields_changed(["ports"], project=["ports"])
+        insert, update = pipeline[0]["$match"]["$or"]
+        self.assertEqual(insert["$or"], [{"fullDocument.ports": {"$exists": True}}])
+        self.assertEqual(update["$or"], [
+            {"updateDescription.updatedFields.ports": {"$exists": True}}])
+        self.assertEqual(pipeline[1]["$project"]["fullDocument._id"], 1)
+
+    def test_token_saved_after_batch_is_handled(self):
+        db = MagicMock()
+        tokens = db[change_stream.TOKEN_COLLECTION]
+        handled = []
+
+        def handle(batch):
+            tokens.update_one.assert_not_called()
+            handled.append(batch)
+
+        stream = FakeStream([
+            {"_id": {"_data": "1"}, "fullDocument": {"_id": "1.1.1.1", "ports": [22]}},
+            {"_id": {"_data": "2"}, "fullDocument": None},
+            {"_id": {"_data": "3"}, "fullDocument": {"_id": "2.2.2.2", "ports": [80]}},
+        ])
+        consumer = change_stream.StreamConsumer("banner", [], handle, batch_size=10)
+
+        self.assertEqual(consumer.poll(db, stream), 2)
+        self.assertEqual([d["_id"] for d in handled[0]], ["1.1.1.1", "2.2.2.2"])
+        tokens.update_one.assert_called_once_with(
+            {"_id": "banner"}, {"$set": {"token": {"_data": "3"}}}, upsert=True)
+
+        # nothing new: no handle call and the same token is not rewritten
+        self.assertEqual(consumer.poll(db, stream), 0)
+        self.assertEqual(len(handled), 1)
+        tokens.update_one.assert_called_once()
+
+    def test_batches_are_bounded(self):
+        handled = []
+        stream = FakeStream(
+            {"_id": {"_data": str(n)}, "fullDocument": {"_id": n}} for n in range(5))
+        consumer = change_stream.StreamConsumer(
+            "banner", [], handled.append, batch_size=2)
+        while consumer.poll(MagicMock(), stream):
+            pass
+        self.assertEqual([len(b) for b in handled], [2, 2, 1])
+
+
+@unittest.skipUnless(os.getenv("MONGO_REPLICA_SET_URI"),
+                     "needs a replica set, e.g. a single-node mongod --replSet rs0")
+class TestChangeStreamReplicaSet(unittest.TestCase):
+
+    def setUp(self):
+        from pymongo import MongoClient
+
+        self.client = MongoClient(os.getenv("MONGO_REPLICA_SET_URI"))
+        self.db = self.client["change_stream_test"]
+        self.addCleanup(self.client.drop_database, "change_stream_test")
+
+    def test_resumes_after_last_handled_batch(self):
+        pipeline = change_stream.fields_changed(["ports"], project=["ports"])
+        handled = []
+        consumer = change_stream.StreamConsumer(
+            "banner", pipeline, handled.extend, max_await_ms=200)
+
+        with consumer._open(self.db) as stream:
+            self.db.scan_results.insert_one({"_id": "1.1.1.1", "ports": [22]})
+            self.db.scan_results.update_one({"_id": "1.1.1.1"}, {"$set": {"domain": "x"}})
+            while not handled:
+                consumer.poll(self.db, stream)
+
+        # written while the consumer was down, picked up from the token
+        self.db.scan_results.update_one({"_id": "1.1.1.1"}, {"$set": {"ports": [22, 80]}})
+        with consumer._open(self.db) as stream:
+            while len(handled) < 2:
+                consumer.poll(self.db, stream)
+
+        self.assertEqual(handled, [{"_id": "1.1.1.1", "ports": [22]},
+                                   {"_id": "1.1.1.1", "ports": [22, 80]}])
+
+
+class FakeRedis:
+
+    def __init__(self):
+        self.hashes = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+
+
+class FakePipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name, args))
+
+    def execute(self):
+        results = []
+        for name, args in self.calls:
+            if name == "hget":
+                results.append(self.client.hashes.get(args[0], {}).get(args[1]))
+            elif name == "hset":
+                self.client.hashes.setdefault(args[0], {})[args[1]] = args[2]
+                results.append(1)
+            else:
+                results.append(True)
+        return results
+
+
+class TestRedisTier(unittest.TestCase):
+
+    def test_first_error_disables_the_tier(self):
+        client = MagicMock()
+        client.get.side_effect = ConnectionError("down")
+        tier = redis_tier.RedisTier(client, "test")
+        self.assertEqual(tier.run(lambda c: c.get("k"), default="x"), "x")
+        self.assertIsNone(tier.client)
+        self.assertIsNone(tier.run(lambda c: c.get("k")))
+        self.assertEqual(client.get.call_count, 1)
+
+    def test_pipeline_returns_results(self):
+        tier = redis_tier.RedisTier(FakeRedis(), "test")
+        self.assertEqual(tier.pipeline(lambda pipe: pipe.hset("h", "f", "v")), [1])
+
+
+class TestHostCache(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.cache = host_cache.HostCache(max_size=10, ttl=60, redis_client=self.redis)
+        patcher = patch("shared_libs.mongo_fetch_result.host_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.collection = MagicMock()
+        self.collection.find.side_effect = lambda query, projection: [
+            {"_id": ip, "ports": [22], "domain": f"{ip}.example"}
+            for ip in query["_id"]["$in"] if ip != "9.9.9.9"
+        ]
+        patcher = patch("shared_libs.mongo_fetch_result.get_collection",
+                        return_value=self.collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read_through_once(self):
+        first = mongo_fetch_result.fetch_many_by_ip(["1.1.1.1", "2.2.2.2", "9.9.9.9"])
+        second = mongo_fetch_result.fetch_many_by_ip(["2.2.2.2", "1.1.1.1"])
+
+        self.assertEqual(set(first), {"1.1.1.1", "2.2.2.2"})
+        self.assertEqual(first["1.1.1.1"], second["1.1.1.1"])
+        self.collection.find.assert_called_once()
+        self.assertEqual(self.cache.stats()["hits"], 2)
+
+    def test_projection_is_passed_and_cached_separately(self):
+        mongo_fetch_result.fetch_by_ip("1.1.1.1", fields=["ports"])
+        self.assertEqual(self.collection.find.call_args[0][1], {"ports": 1})
+        mongo_fetch_result.fetch_by_ip("1.1.1.1")
+        self.assertIsNone(self.collection.find.call_args[0][1])
+        self.assertEqual(self.collection.find.call_count, 2)
+
+    def test_cached_document_is_not_shared(self):
+        mongo_fetch_result.fetch_by_ip("1.1.1.1")["ports"].append(80)
+        self.assertEqual(mongo_fetch_result.fetch_by_ip("1.1.1.1")["ports"], [22])
+
+    def test_invalidate_drops_every_projection(self):
+        mongo_fetch_result.fetch_by_ip("1.1.1.1", fields=["ports"])
+        mongo_fetch_result.fetch_by_ip("1.1.1.1")
+        self.cache.invalidate(["1.1.1.1"])
+
+        self.assertEqual(self.redis.hashes, {})
+        self.assertEqual(self.cache.get_many(["1.1.1.1"], "ports"), {})
+        self.assertEqual(self.cache.get_many(["1.1.1.1"], host_cache.FULL_DOCUMENT), {})
+
+    def test_shared_tier_serves_other_processes(self):
+        mongo_fetch_result.fetch_by_ip("1.1.1.1")
+        other = host_cache.HostCache(max_size=10, ttl=60, redis_client=self.redis)
+        self.assertEqual(other.get_many(["1.1.1.1"], host_cache.FULL_DOCUMENT)["1.1.1.1"]["domain"],
+                         "1.1.1.1.example")
+        self.assertEqual(other.stats()["shared_hits"], 1)
+
+    def test_expired_local_entry_is_refetched(self):
+        self.cache.ttl = 0
+        self.cache.shared.client = None
+        mongo_fetch_result.fetch_by_ip("1.1.1.1")
+        mongo_fetch_result.fetch_by_ip("1.1.1.1")
+        self.assertEqual(self.collection.find.call_count, 2)
+
+    def test_write_buffer_flush_invalidates(self):
+        mongo_fetch_result.fetch_by_ip("1.1.1.1")
+        buffer = write_buffer.WriteBuffer(lambda: MagicMock(), max_latency=60)
+        with patch("shared_libs.write_buffer.host_cache.cache", self.cache):
+            buffer.add("1.1.1.1", {"domain": "new.example"})
+            buffer.flush()
+        self.assertNotIn("host:1.1.1.1", self.redis.hashes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,246 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from . import host_cache, monogo_connections
+
+WRITE_BUFFER_MAX_SIZE = int(os.getenv("WRITE_BUFFER_MAX_SIZE", "1000"))
+# seconds an update may wait before it is written; 0 writes every batch
+# through as soon as it is staged
+WRITE_BUFFER_MAX_LATENCY = float(os.getenv("WRITE_BUFFER_MAX_LATENCY", "2"))
+# stamped by Mongo on every host the buffer writes, so readers can pick up
+# what changed since a point in time
+MODIFIED_FIELD = "modified_at"
+# flushes an update may fail before it is dropped
+WRITE_BUFFER_MAX_RETRIES = int(os.getenv("WRITE_BUFFER_MAX_RETRIES", "5"))
+
+
+def _conflicts(path, other):
+    # Mongo rejects one update that sets both "a" and "a.b"
+    return path == other or path.startswith(other + ".") or other.startswith(path + ".")
+
+
+class _Pending:
+    __slots__ = ("set", "unset", "staged_at", "attempts")
+
+    def __init__(self, staged_at):
+        self.set = {}
+        self.unset = {}
+        self.staged_at = staged_at
+        self.attempts = 0
+
+    def conflicts(self, fields):
+        staged = list(self.set) + list(self.unset)
+        return any(
+            _conflicts(path, other)
+            for path in fields for other in staged if path != other
+        )
+
+    def merge(self, set_fields, unset_fields):
+        # the later stage wins a field, whether it sets or unsets it; an
+        # overlapping path is only left here when flushing it first failed
+        incoming = list(set_fields) + list(unset_fields)
+        for path in list(self.set) + list(self.unset):
+            if any(_conflicts(path, other) for other in incoming if path != other):
+                self.set.pop(path, None)
+                self.unset.pop(path, None)
+        for path in set_fields:
+            self.unset.pop(path, None)
+        for path in unset_fields:
+            self.set.pop(path, None)
+        self.set.update(set_fields)
+        self.unset.update(unset_fields)
+
+    def merge_older(self, older):
+        """Put the fields of a failed write back under the newer ones.
+
+        A field staged again since, or one whose path overlaps it, keeps
+        the newer value.
+        """
+        staged = list(self.set) + list(self.unset)
+        for fields, target in ((older.set, self.set), (older.unset, self.unset)):
+            for path, value in fields.items():
+                if not any(_conflicts(path, other) for other in staged):
+                    target[path] = value
+        self.staged_at = min(self.staged_at, older.staged_at)
+        self.attempts = max(self.attempts, older.attempts)
+
+    def update(self):
+        update = {"$currentDate": {MODIFIED_FIELD: True}}
+        if self.set:
+            update["$set"] = self.set
+        if self.unset:
+            update["$unset"] = self.unset
+        return update
+
+
+class WriteBuffer:
+    """Write-behind buffer of per-host updates.
+
+    Updates for the same _id are merged into one $set/$unset and written
+    as a single unordered bulk_write once max_size hosts are pending or the
+    oldest update is max_latency seconds old, whichever comes first. The
+    updates of a failed flush are staged again, so the next flush retries
+    them.
+    """
+
+    def __init__(self, get_collection, max_size=WRITE_BUFFER_MAX_SIZE,
+                 max_latency=WRITE_BUFFER_MAX_LATENCY,
+                 max_retries=WRITE_BUFFER_MAX_RETRIES):
+        self.get_collection = get_collection
+        self.max_size = max_size
+        self.max_latency = max_latency
+        self.max_retries = max_retries
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.staged = self.flushes = self.written = self.errors = self.dropped = 0
+        self.last_flush_size = 0
+        self.last_flush_latency = self.max_flush_latency = 0.0
+
+    def add(self, _id, set_fields=None, unset_fields=None):
+        self.add_many({_id: (set_fields or {}, unset_fields or {})})
+
+    def add_many(self, updates):
+        """Stage {_id: ($set fields, $unset fields)} and flush if due."""
+        flush_first = False
+        with self._lock:
+            for _id, (set_fields, unset_fields) in updates.items():
+                pending = self._pending.get(_id)
+                if pending is not None and pending.conflicts(
+                        list(set_fields) + list(unset_fields)):
+                    flush_first = True
+                    break
+        if flush_first:
+            self.flush()
+
+        with self._lock:
+            now = time.monotonic()
+            for _id, (set_fields, unset_fields) in updates.items():
+                pending = self._pending.get(_id)
+                if pending is None:
+                    pending = self._pending[_id] = _Pending(now)
+                pending.merge(set_fields, unset_fields)
+                self.staged += 1
+            due = len(self._pending) >= self.max_size or self.max_latency <= 0
+        if due:
+            self.flush()
+        else:
+            self._ensure_thread()
+
+    def flush(self):
+        """Write everything pending in one bulk_write; return the host count."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            oldest = min(p.staged_at for p in pending.values())
+            operations = [
+                UpdateOne({"_id": _id}, p.update(), upsert=True)
+                for _id, p in pending.items()
+            ]
+            try:
+                self.get_collection().bulk_write(operations, ordered=False)
+                host_cache.cache.invalidate(pending)
+            except Exception as e:
+                self.errors += 1
+                ids = list(pending)
+                failed = ids
+                if isinstance(e, BulkWriteError):
+                    # unordered: every operation without an error was written
+                    failed = [ids[err["index"]] for err in e.details.get("writeErrors", [])]
+                    host_cache.cache.invalidate(set(ids) - set(failed))
+                logging.error(
+                    f"[write_buffer] Failed to flush {len(failed)} of "
+                    f"{len(operations)} updates: {e}")
+                self._requeue({_id: pending[_id] for _id in failed})
+                return 0
+
+            latency = time.monotonic() - oldest
+            self.flushes += 1
+            self.written += len(operations)
+            self.last_flush_size = len(operations)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            logging.info(
+                f"[write_buffer] Flushed {len(operations)} hosts after "
+                f"{latency:.2f}s, merge ratio {self.merge_ratio():.2f}")
+            return len(operations)
+
+    def _requeue(self, failed):
+        """Stage failed updates again, up to WRITE_BUFFER_MAX_RETRIES times."""
+        dropped = 0
+        with self._lock:
+            now = time.monotonic()
+            for _id, older in failed.items():
+                older.attempts += 1
+                # wait a full max_latency before the next attempt
+                older.staged_at = now
+                if older.attempts > self.max_retries:
+                    dropped += 1
+                    continue
+                newer = self._pending.get(_id)
+                if newer is None:
+                    self._pending[_id] = older
+                else:
+                    newer.merge_older(older)
+        self.dropped += dropped
+        if dropped:
+            logging.error(
+                f"[write_buffer] Dropped {dropped} updates after "
+                f"{self.max_retries} failed flushes")
+        if len(failed) > dropped:
+            self._ensure_thread()
+
+    def merge_ratio(self):
+        """Updates staged per host document written."""
+        return self.staged / self.written if self.written else 0.0
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "staged": self.staged,
+            "written": self.written,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "last_flush_size": self.last_flush_size,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+            "merge_ratio": self.merge_ratio(),
+        }
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="WriteBufferThread", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(max(self.max_latency / 4, 0.1)):
+            with self._lock:
+                oldest = min(
+                    (p.staged_at for p in self._pending.values()), default=None)
+            if oldest is not None and time.monotonic() - oldest >= self.max_latency:
+                self.flush()
+
+    def close(self):
+        self._stopped.set()
+        self.flush()
+
+
+def _scan_results():
+    return monogo_connections.connect_monogo().scan_results
+
+
+buffer = WriteBuffer(_scan_results)
+atexit.register(buffer.close)
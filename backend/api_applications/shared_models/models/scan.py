@@ -2,6 +2,24 @@ from django.db import models
 from django.conf import settings
 
 
+class ScanJob(models.Model):
+    """A bulk submission; its scans are polled through it."""
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="scan_jobs",
+    )
+    target_count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"ScanJob {self.pk} - {self.target_count} targets - {self.user.username}"
+
+
 class Scan(models.Model):
     SCAN_STATUS_CHOICES = [
         ("pending", "Pending"),
@@ -34,6 +52,14 @@ class Scan(models.Model):
     isp = models.CharField(max_length=255, blank=True, null=True)
     asn = models.CharField(max_length=100, blank=True, null=True)
 
+    job = models.ForeignKey(
+        ScanJob,
+        on_delete=models.SET_NULL,
+        related_name="scans",
+        null=True,
+        blank=True,
+    )
+
     mongo_object_id = models.CharField(
         max_length=24,
         blank=True,
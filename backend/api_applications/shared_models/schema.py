@@ -14,6 +14,7 @@ class FingerPrintInfo(BaseModel):
 
 class GeoInfo(BaseModel):
     country: Optional[str]
+    countrycode: Optional[str] = None  # ISO 3166-1 alpha-2
     city: Optional[str]
     regionname: Optional[str]
     latlang: Optional[list]
@@ -26,23 +27,35 @@ class GeneralInfo(BaseModel):
     asn: Optional[str]
 
 
-class VulnerabilityInfo(BaseModel):
-    cv_id: str
+class VulnerabilityRef(BaseModel):
+    cve_id: str
+    score: Optional[float] = None
+
+
+class CVEInfo(BaseModel):
+    # one document per CVE in the cves collection
+    id: str = Field(alias="_id")
     description: str
     published: str
     assigner: str
+    score: Optional[float] = None
+
+    class Config:
+        allow_population_by_field_name = True
+        populate_by_name = True
 
 
 class ScanResult(BaseModel):
     id: str = Field(alias="_id")
+    ip_num: Optional[int] = None  # numeric _id for CIDR range queries
     ports: List[int]
     last_update: datetime
     finger_print: Optional[FingerPrintInfo] = None
     general: Optional[GeneralInfo] = None
     domain: Optional[str] = None
     service_type: Optional[Dict[int, str]] = None  # port(int): str
-    vulnerability: Optional[Dict[str, List[VulnerabilityInfo]]] = (
-        None  # sercicename(str) : list (contains dict ---> cv_id : VulnerabilityInfo model  )
+    vulnerability: Optional[Dict[str, List[VulnerabilityRef]]] = (
+        None  # servicename(str) : list of CVE references, details live in CVEInfo
     )
 
     class Config:
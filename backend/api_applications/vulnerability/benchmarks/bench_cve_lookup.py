@@ -0,0 +1,84 @@
+"""Compare description matching with CPE range matching on real banners.
+
+Run from api_applications with one or more NVD 1.1 feeds, e.g. the yearly
+feeds the labelled CVEs were published in:
+
+    python -m vulnerability.benchmarks.bench_cve_lookup \
+        cve_data/nvdcve-1.1-2011.json.gz ... cve_data/nvdcve-1.1-2023.json.gz
+
+Precision only counts CVEs the corpus labels, so it is not diluted by CVEs
+nobody has checked by hand.
+"""
+import argparse
+import json
+import os
+import time
+
+from vulnerability import cve_index, cve_lookup, nvd_stream
+
+BANNERS = os.path.join(os.path.dirname(__file__), "banners.json")
+
+
+def load_items(feeds):
+    for feed in feeds:
+        yield from nvd_stream.iter_cve_items(feed)
+
+
+def score(found, sample):
+    labelled = set(sample["affected"]) | set(sample["not_affected"])
+    tp = len(found & set(sample["affected"]))
+    reported = len(found & labelled)
+    return tp, reported, len(sample["affected"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("feeds", nargs="+")
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    index = cve_index.CVEIndex.from_items(load_items(args.feeds))
+    print(f"index: {len(index)} CVEs built in {time.perf_counter() - started:.2f}s")
+
+    with open(BANNERS) as f:
+        corpus = json.load(f)
+
+    matchers = {
+        "description": lambda s, v: {
+            index.entries[i]["cve_id"] for i in index.match_description(s, v)
+        },
+        "cpe": lambda s, v: {r["cve_id"] for r in index.search(s, v)},
+    }
+    pairs = []
+    for sample in corpus:
+        services = cve_lookup.get_service({sample["port"]: sample["banner"]})
+        pairs.append([s for s in services if s[0] and s[1]])
+
+    for name, match in matchers.items():
+        tp = reported = expected = 0
+        for sample, services in zip(corpus, pairs):
+            found = set()
+            for service, version in services:
+                found |= match(service, version)
+            t, r, e = score(found, sample)
+            tp, reported, expected = tp + t, reported + r, expected + e
+
+        lookups = [p for services in pairs for p in services]
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            for service, version in lookups:
+                match(service, version)
+        elapsed = time.perf_counter() - started
+        per_lookup = elapsed / max(1, args.repeat * len(lookups)) * 1e6
+
+        precision = tp / reported if reported else 0.0
+        recall = tp / expected if expected else 0.0
+        print(
+            f"{name:12} precision={precision:.2f} recall={recall:.2f} "
+            f"lookup={per_lookup:.1f}us"
+        )
+
+
+if __name__ == "__main__":
+    main()
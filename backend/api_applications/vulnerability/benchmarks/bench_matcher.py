@@ -0,0 +1,49 @@
+"""Hosts matched per second by the worker pool at different pool sizes.
+
+Run from api_applications against a built CVE store:
+
+    python -m vulnerability.benchmarks.bench_matcher \
+        vulnerability/cve_data/cve_index.sqlite3 --workers 1 2 4 8
+
+Hosts cycle the banners in banners.json. Each pool size starts from cold
+workers, so the first batch also pays for spawning them.
+"""
+import argparse
+import json
+import os
+import time
+
+from vulnerability import cve_lookup, matcher, vul_cache
+from vulnerability.benchmarks import bench_service_engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("store")
+    parser.add_argument("--hosts", type=int, default=20000)
+    parser.add_argument("--ports", type=int, default=3)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    with open(bench_service_engine.BANNERS) as f:
+        corpus = json.load(f)
+    targets = bench_service_engine.make_targets(corpus, args.hosts, args.ports)
+    cve_lookup.swap_index(args.store)
+
+    # a warm match cache would hide the matching cost being measured;
+    # spawned workers read the size from the environment
+    os.environ["VUL_CACHE_SIZE"] = "0"
+    vul_cache.cache = vul_cache.VulCache(max_size=0)
+    for workers in args.workers:
+        pool = matcher.MatchPool(workers=workers, min_batch=2)
+        started = time.perf_counter()
+        for start in range(0, len(targets), args.batch):
+            pool.match(targets[start:start + args.batch])
+        elapsed = time.perf_counter() - started
+        pool.close()
+        print(f"workers={workers:<3} {len(targets) / elapsed:,.0f} hosts/s")
+
+
+if __name__ == "__main__":
+    main()
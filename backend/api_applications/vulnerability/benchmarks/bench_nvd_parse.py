@@ -0,0 +1,55 @@
+"""Compare peak RSS and parse time of json.load and the streaming parser.
+
+Run from api_applications with an NVD 1.1 feed, ideally a large yearly one:
+
+    python -m vulnerability.benchmarks.bench_nvd_parse \
+        cve_data/nvdcve-1.1-2022.json.gz
+
+Each parser runs in its own process so the peak RSS of one does not hide
+the other's.
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import resource
+import time
+
+from vulnerability import nvd_stream
+
+
+def parse_json_load(feed):
+    with gzip.open(feed, "rt", encoding="utf-8") as f:
+        return sum(1 for _ in json.load(f)["CVE_Items"])
+
+
+def parse_stream(feed):
+    return sum(1 for _ in nvd_stream.iter_cve_items(feed))
+
+
+def run(parser, feed, queue):
+    started = time.perf_counter()
+    count = parser(feed)
+    elapsed = time.perf_counter() - started
+    # ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put((count, elapsed, peak))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("feed")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    for name, func in (("json.load", parse_json_load), ("stream", parse_stream)):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run, args=(func, args.feed, queue))
+        proc.start()
+        count, elapsed, peak = queue.get()
+        proc.join()
+        print(f"{name:10} items={count} time={elapsed:.2f}s peak_rss={peak:.0f}MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Banner throughput of the service engine with and without the prefilter.
+
+Run from api_applications:
+
+    python -m vulnerability.benchmarks.bench_service_engine --hosts 20000
+
+Hosts are built by cycling the labelled banners in banners.json across
+--ports ports each, and every batch goes through extract_batch the way the
+consumer calls it.
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+
+from vulnerability import service_engine
+
+BANNERS = os.path.join(os.path.dirname(__file__), "banners.json")
+
+
+def make_targets(corpus, hosts, ports):
+    banners = itertools.cycle(corpus)
+    return [
+        {
+            "_id": f"10.0.{n // 256}.{n % 256}",
+            "service_type": {
+                str(sample["port"] + p): sample["banner"]
+                for p, sample in enumerate(itertools.islice(banners, ports))
+            },
+        }
+        for n in range(hosts)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=20000)
+    parser.add_argument("--ports", type=int, default=3)
+    parser.add_argument("--batch", type=int, default=100)
+    args = parser.parse_args()
+
+    with open(BANNERS) as f:
+        corpus = json.load(f)
+    targets = make_targets(corpus, args.hosts, args.ports)
+    banners = args.hosts * args.ports
+
+    for name, engine in [
+        ("prefilter", service_engine.ServiceEngine()),
+        ("all rules", service_engine.ServiceEngine(prefilter=False)),
+    ]:
+        started = time.perf_counter()
+        named = 0
+        for start in range(0, len(targets), args.batch):
+            batch = engine.extract_batch(targets[start:start + args.batch])
+            named += sum(
+                1 for ports in batch.values()
+                for services in ports.values() if services
+            )
+        elapsed = time.perf_counter() - started
+        print(
+            f"{name:10} {banners / elapsed:,.0f} banners/s "
+            f"({elapsed * 1e6 / banners:.1f}us each, {named} named)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import re
+from bisect import bisect_right
+
+_SEGMENT_RE = re.compile(r"\d+|[a-z]+")
+# "-" is CPE's "not applicable", which names no version at all, so it is
+# not read as every version
+_ANY = ("*", "")
+
+# tags that name a build before the release they precede, lowest first;
+# other letters ("p1", OpenSSL's "1.1.1a") come after it
+_PRE_RELEASE = {"dev": 0, "alpha": 1, "beta": 2, "pre": 3, "preview": 3, "rc": 4}
+# closes every parsed version: above a pre-release tag, below anything
+# that extends the version
+_END = (1,)
+
+# banner names that differ from the CPE product they are published under
+SERVICE_ALIASES = {
+    "apache": "http_server",
+    "apache_httpd": "http_server",
+    "httpd": "http_server",
+    "microsoft_iis": "internet_information_services",
+    "iis": "internet_information_services",
+    "microsoft_httpapi": "internet_information_services",
+    "dropbear": "dropbear_ssh",
+    "dropbear_sshd": "dropbear_ssh",
+    "exchange": "exchange_server",
+}
+
+
+def parse_version(version):
+    """Turn a version string into a tuple that sorts the way versions do.
+
+    Numeric runs compare as numbers and sort after letter runs, so
+    8.2 < 8.2p1 < 8.3 and 1.10 > 1.9. Pre-release tags sort before the
+    end of the version, so 1.0-beta < 1.0-rc1 < 1.0.
+    """
+    if version is None:
+        return None
+    parts = _SEGMENT_RE.findall(str(version).lower())
+    if not any(p.isdigit() for p in parts):
+        return None
+    segments = []
+    for p in parts:
+        if p.isdigit():
+            segments.append((3, int(p)))
+        elif p in _PRE_RELEASE:
+            segments.append((0, _PRE_RELEASE[p]))
+        else:
+            segments.append((2, p))
+    return (*segments, _END)
+
+
+def normalize_product(name):
+    if name is None:
+        return None
+    key = re.sub(r"[\s\-/]+", "_", str(name).strip().lower()).strip("_")
+    return SERVICE_ALIASES.get(key, key)
+
+
+def format_cpe(vendor, product, version=None):
+    """Build an application cpe:2.3 URI; an unknown version becomes *."""
+    return f"cpe:2.3:a:{vendor}:{product}:{version or '*'}:*:*:*:*:*:*:*"
+
+
+def service_key(product, version):
+    """Key a host's service is indexed under for re-evaluation.
+
+    "product:version" with the product normalized the way CPE ranges are
+    stored, so a feed delta's products map straight onto key prefixes.
+    """
+    return f"{normalize_product(product)}:{str(version).lower()}"
+
+
+def split_cpe(uri):
+    """Return (vendor, product, version) from a cpe:2.3 URI."""
+    parts = uri.split(":")
+    if len(parts) < 6:
+        return None, None, None
+    return parts[3], parts[4], parts[5]
+
+
+class VersionRange:
+    """One vulnerable version interval for a product.
+
+    A bound of None is open; an exact CPE version has start == end, both
+    inclusive.
+    """
+
+    __slots__ = ("start", "start_incl", "end", "end_incl", "cve")
+
+    def __init__(self, cve, start=None, start_incl=True, end=None, end_incl=True):
+        self.cve = cve
+        self.start = start
+        self.start_incl = start_incl
+        self.end = end
+        self.end_incl = end_incl
+
+    @property
+    def sort_key(self):
+        return self.start or ()
+
+    def contains(self, version):
+        if self.start is not None:
+            if version < self.start or (version == self.start and not self.start_incl):
+                return False
+        if self.end is not None:
+            if version > self.end or (version == self.end and not self.end_incl):
+                return False
+        return True
+
+
+class ProductRanges:
+    """Vulnerable versions of one product.
+
+    Exact versions sit in a dict. Ranges are sorted by lower bound, so a
+    lookup bisects to the last one starting at or below the version and
+    walks down from there. Each bounded range also records the highest
+    end among it and the ones before it, and the walk stops as soon as
+    that is below the version. Ranges without an upper bound contain
+    every version from their start, so they are only bisected.
+    """
+
+    __slots__ = ("exact", "ranges", "starts", "max_ends", "open", "open_starts")
+
+    def __init__(self):
+        self.exact = {}
+        self.ranges = []
+        self.starts = []
+        self.max_ends = []
+        self.open = []
+        self.open_starts = []
+
+    def add(self, rng):
+        if rng.start is not None and rng.start == rng.end:
+            self.exact.setdefault(rng.start, []).append(rng.cve)
+        elif rng.end is None:
+            self.open.append(rng)
+        else:
+            self.ranges.append(rng)
+
+    def finalize(self):
+        self.ranges.sort(key=lambda r: r.sort_key)
+        self.starts = [r.sort_key for r in self.ranges]
+        self.max_ends, reach = [], ()
+        for rng in self.ranges:
+            reach = max(reach, rng.end)
+            self.max_ends.append(reach)
+        self.open.sort(key=lambda r: r.sort_key)
+        self.open_starts = [r.sort_key for r in self.open]
+        return self
+
+    def match(self, parsed):
+        hits = set(self.exact.get(parsed, ()))
+        i = bisect_right(self.starts, parsed) - 1
+        while i >= 0 and self.max_ends[i] >= parsed:
+            if self.ranges[i].contains(parsed):
+                hits.add(self.ranges[i].cve)
+            i -= 1
+        # only an exclusive start equal to the version can still miss
+        hi = bisect_right(self.open_starts, parsed)
+        hits.update(r.cve for r in self.open[:hi] if r.contains(parsed))
+        return hits
+
+
+def iter_cpe_matches(nodes):
+    for node in nodes or ():
+        yield from node.get("cpe_match", ())
+        yield from iter_cpe_matches(node.get("children"))
+
+
+def compile_ranges(item, cve):
+    """Yield (product, VersionRange) for every vulnerable CPE match of a feed item.
+
+    A match whose version or bounds do not parse ("beta", vendor build
+    strings) is skipped rather than widened to every version.
+    """
+    nodes = item.get("configurations", {}).get("nodes", [])
+    for match in iter_cpe_matches(nodes):
+        if not match.get("vulnerable", True):
+            continue
+        _, product, version = split_cpe(match.get("cpe23Uri", ""))
+        if not product:
+            continue
+        bounds = {
+            k: parse_version(match[k])
+            for k in (
+                "versionStartIncluding",
+                "versionStartExcluding",
+                "versionEndIncluding",
+                "versionEndExcluding",
+            )
+            if match.get(k)
+        }
+        if None in bounds.values():
+            continue
+        if bounds:
+            start = bounds.get("versionStartIncluding") or bounds.get("versionStartExcluding")
+            end = bounds.get("versionEndIncluding") or bounds.get("versionEndExcluding")
+            yield product, VersionRange(
+                cve,
+                start,
+                "versionStartExcluding" not in bounds,
+                end,
+                "versionEndExcluding" not in bounds,
+            )
+        elif version in _ANY:
+            yield product, VersionRange(cve)
+        else:
+            exact = parse_version(version)
+            if exact is not None:
+                yield product, VersionRange(cve, exact, True, exact, True)
@@ -0,0 +1,133 @@
+import re
+from contextlib import contextmanager
+
+from . import cpe, nvd_stream
+
+_WORD_RE = re.compile(r"[a-z0-9][a-z0-9+]*")
+_VERSION_RE = re.compile(r"\d+(?:\.\d+)+[a-z0-9\-]*")
+
+
+def product_tokens(name):
+    """Split a service/product name into the tokens the index is keyed on."""
+    words = _WORD_RE.findall(str(name).lower().replace("_", " "))
+    return [w for w in words if not w.isdigit()]
+
+
+def description_versions(text):
+    return frozenset(v.rstrip(".-") for v in _VERSION_RE.findall(text.lower()))
+
+
+def cvss_score(item):
+    """CVSS v3 base score of a feed item, or the v2 one for older CVEs."""
+    impact = item.get("impact", {})
+    for metric, key in (("baseMetricV3", "cvssV3"), ("baseMetricV2", "cvssV2")):
+        score = impact.get(metric, {}).get(key, {}).get("baseScore")
+        if score is not None:
+            return score
+    return None
+
+
+class CVEIndex:
+    """In-memory inverted index over an NVD feed.
+
+    Workers read the same structure from the file cve_store builds; this
+    one is for building small indexes in tests and benchmarks.
+
+    CPE configuration nodes are compiled into per-product version ranges:
+    exact versions sit in a dict and ranges are kept sorted by lower bound,
+    so a lookup parses the version once and bisects. Products the feed has
+    no CPE data for fall back to description matching, where every word maps
+    to the CVEs that mention it and each CVE keeps the version strings its
+    description mentions.
+    """
+
+    def __init__(self, version=None):
+        self.version = version
+        self.entries = []
+        self.versions = []
+        self.postings = {}
+        self.products = {}
+
+    def add(self, item):
+        meta = item["cve"]["CVE_data_meta"]
+        descs = item["cve"]["description"].get("description_data", [])
+        text = " ".join(d.get("value", "") for d in descs)
+        idx = len(self.entries)
+        self.entries.append(
+            {
+                "cve_id": meta["ID"],
+                "description": descs[0].get("value", "") if descs else "",
+                "published": item.get("publishedDate", ""),
+                "assigner": meta.get("ASSIGNER", ""),
+                "score": cvss_score(item),
+            }
+        )
+        self.versions.append(description_versions(text))
+        for token in set(product_tokens(text)):
+            self.postings.setdefault(token, []).append(idx)
+        for product, rng in cpe.compile_ranges(item, idx):
+            product = cpe.normalize_product(product)
+            self.products.setdefault(product, cpe.ProductRanges()).add(rng)
+
+    def finalize(self):
+        """Sort the range lists; call once after the last add()."""
+        for ranges in self.products.values():
+            ranges.finalize()
+        return self
+
+    @classmethod
+    def from_items(cls, items, version=None):
+        index = cls(version)
+        for item in items:
+            index.add(item)
+        return index.finalize()
+
+    @classmethod
+    def from_feed(cls, filename, version=None):
+        return cls.from_items(nvd_stream.iter_cve_items(filename), version)
+
+    def _candidates(self, service_name):
+        tokens = product_tokens(service_name)
+        if not tokens:
+            return []
+        lists = sorted(
+            (self.postings.get(t, ()) for t in tokens), key=len)
+        if len(lists) == 1:
+            return lists[0]
+        rest = [set(p) for p in lists[1:]]
+        return [i for i in lists[0] if all(i in p for p in rest)]
+
+    def match_cpe(self, product, parsed):
+        return sorted(self.products[product].match(parsed))
+
+    def match_description(self, service_name, version):
+        version_lc = str(version).lower()
+        return [
+            i
+            for i in self._candidates(service_name)
+            if version_lc in self.versions[i]
+        ]
+
+    def search(self, service_name, version):
+        if service_name is None or version is None:
+            return []
+        parsed = cpe.parse_version(version)
+        product = cpe.normalize_product(service_name)
+        if parsed is not None and product in self.products:
+            hits = self.match_cpe(product, parsed)
+        else:
+            hits = self.match_description(service_name, version)
+        return [self.entries[i] for i in hits]
+
+    def details(self, cve_ids):
+        wanted = set(cve_ids)
+        return {e["cve_id"]: e for e in self.entries if e["cve_id"] in wanted}
+
+    @contextmanager
+    def snapshot(self):
+        # an in-memory index never changes under a batch
+        yield self
+
+    def __len__(self):
+        return len(self.entries)
+
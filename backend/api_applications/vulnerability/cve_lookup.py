@@ -1,115 +1,149 @@
 import gzip
-import json
+import hashlib
+import logging
 import os
-import re
 import shutil
 
 import requests
 
+from . import cve_store, service_engine, vul_cache
+
+NVD_FEED_URL = "https://nvd.nist.gov/feeds/json/cve/1.1/nvdcve-1.1-{name}.json.gz"
+NVD_META_URL = "https://nvd.nist.gov/feeds/json/cve/1.1/nvdcve-1.1-{name}.meta"
+# first year to bootstrap the full CVE history from; unset keeps only the
+# recent window of the modified feed
+NVD_FIRST_YEAR = os.getenv("NVD_FIRST_YEAR")
 
 
 def ensure_cve_file_exists():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     data_dir = os.path.join(script_dir, "cve_data")
-    file_path = os.path.join(data_dir, "nvdcve-1.1-modified.json.gz")
+    file_path = os.path.join(data_dir, cve_store.INDEX_FILENAME)
 
     
     os.makedirs(data_dir, exist_ok=True)
 
     if not os.path.exists(file_path):
-        print("[INFO] CVE file not found. Downloading...")
-        download_and_replace_nvd(data_dir)
+        print("[INFO] CVE store not found. Downloading...")
+        bootstrap_nvd(data_dir)
         print("[INFO] Download completed.")
 
     return file_path
 
 
+_index = None
+
+
+def swap_index(path=None):
+    """Point lookups at the newest store generation.
+
+    Called by the consumer between batches, so a whole batch is matched
+    against one version while the refresher merges the next.
+    """
+    global _index
+    _index = cve_store.get_index(path or ensure_cve_file_exists())
+    return _index
+
+
+def current_index():
+    index = _index
+    return index if index is not None else swap_index()
+
+
 def search_cve_by_service_version(data):
     service_name = data[0]
     version = data[1]
-    filename = ensure_cve_file_exists()
-    with gzip.open(filename, "rt", encoding="utf-8") as f:
-        file = json.load(f)
-    results = []
-    service_name_lc = service_name.lower()
-    version_lc = str(version).lower()
-    for item in file["CVE_Items"]:
-        descs = item["cve"]["description"].get("description_data", [])
-        for desc_obj in descs:
-            desc_text = desc_obj.get("value", "").lower()
-            if service_name_lc in desc_text and version_lc in desc_text:
-                results.append(
-                    {
-                        "cve_id": item["cve"]["CVE_data_meta"]["ID"],
-                        "description": desc_obj.get("value", ""),
-                        "published": item.get("publishedDate", ""),
-                        "assigner": item["cve"]["CVE_data_meta"].get("ASSIGNER", ""),
-                    }
-                )
-                break
-    return results
+    index = current_index()
+    return vul_cache.cache.get_or_compute(
+        service_name,
+        version,
+        index.version,
+        lambda: index.search(service_name, version),
+    )
+
+
+def parse_meta(text):
+    return dict(
+        line.strip().split(":", 1) for line in text.splitlines() if ":" in line
+    )
+
+
+def verify_feed(file_path, meta):
+    """Check a downloaded feed against the size and sha256 in its .meta.
+
+    NVD hashes the uncompressed JSON, so the file is hashed while it is
+    decompressed in chunks.
+    """
+    digest, size = hashlib.sha256(), 0
+    with gzip.open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    expected = meta.get("sha256", "").lower()
+    if not expected or digest.hexdigest() != expected:
+        raise ValueError(f"{file_path} does not match its sha256")
+    if "size" in meta and int(meta["size"]) != size:
+        raise ValueError(f"{file_path} is {size} bytes, expected {meta['size']}")
+
+
+def download_nvd_feed(name, target_dir):
+    file_path = os.path.join(target_dir, f"nvdcve-1.1-{name}.json.gz")
+    tmp_path = f"{file_path}.tmp"
+    meta = requests.get(NVD_META_URL.format(name=name), timeout=30)
+    meta.raise_for_status()
+    with requests.get(NVD_FEED_URL.format(name=name), stream=True, timeout=60) as r:
+        r.raise_for_status()
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(r.raw, f)
+    try:
+        verify_feed(tmp_path, parse_meta(meta.text))
+    except Exception:
+        # a truncated or tampered download never reaches the store
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, file_path)
+    logging.info(f"[cve_lookup] Downloaded and verified {file_path}")
+    return file_path
+
+
+def bootstrap_nvd(target_dir):
+    """Build the local CVE store from the yearly feeds plus the modified one."""
+    if NVD_FIRST_YEAR:
+        from datetime import date
+
+        for year in range(int(NVD_FIRST_YEAR), date.today().year + 1):
+            download_nvd_feed(year, target_dir)
+    download_nvd_feed("modified", target_dir)
+    return cve_store.ingest_directory(target_dir)
 
 
 def download_and_replace_nvd(target_dir=None):
-    file_path = os.path.join(target_dir, f"nvdcve-1.1-modified.json.gz")
-    url = f"https://nvd.nist.gov/feeds/json/cve/1.1/nvdcve-1.1-modified.json.gz"
-    with requests.get(url, stream=True) as r:
-        with open(file_path, "wb") as f:
-            shutil.copyfileobj(r.raw, f)
+    file_path = download_nvd_feed("modified", target_dir)
+    # merge only the records that changed since the last refresh
+    return cve_store.ingest_feed(file_path)
+
+
+def service_pairs(port_services):
+    """Distinct (service, version) pairs across the ports of one host."""
+    return list(dict.fromkeys(
+        (s.service, s.version)
+        for services in port_services.values()
+        for s in services
+    ))
 
 
 def get_service(data):
-    results = {}
-    for port in data:
-        banner = data[port]
-
-        results = []
-
-        m = re.match(r"SSH-\d+\.\d+-(\S+)", banner)
-        if m:
-            parts = m.group(1).split("_")
-            service = parts[0]
-            version = parts[1] if len(parts) > 1 else None
-            results.append((service, version))
-
-        m = re.match(r"220\s+([A-Za-z0-9\-]+)\s*([\d\.]+)?", banner)
-        if m:
-            service, version = m.group(1), m.group(2)
-            results.append((service, version))
-
-        m = re.search(
-            r"(Postfix|Exim|Sendmail|Exchange|MailEnable)[^\d]*([\d\.]+)?", banner, re.I
-        )
-        if m:
-            service = m.group(1)
-            version = m.group(2) if m.group(2) else None
-            results.append((service, version))
-
-        http_like = re.findall(
-            r"(Server|X-Powered-By):\s*([A-Za-z0-9._ \-]+)/?([\d\.]+)?", banner, re.I
-        )
-        for _, name, ver in http_like:
-            service = name.strip()
-            version = ver.strip() if ver else None
-            results.append((service, version))
-
-        generic = re.findall(
-            r"([A-Za-z0-9\-_]{3,})[ \/\-_]v?(\d+\.\d+(\.\d+)*)", banner
-        )
-        for tup in generic:
-            service = tup[0]
-            version = tup[1]
-            results.append((service, version))
-
-        results = list(set(results))
-
-        return results if results else [(None, None)]
+    pairs = service_pairs(service_engine.engine.extract_ports(data))
+    return pairs if pairs else [(None, None)]
+
+
+def match_services(pairs):
+    return {
+        service: search_cve_by_service_version((service, version))
+        for service, version in pairs
+        if service is not None
+    }
 
 
 def get_vul(data):
-    temp = get_service(data)
-    result = {}
-    if temp is not None:
-        for service in temp:
-            result[service[0]] = search_cve_by_service_version(service)
-        return result
+    return match_services(get_service(data))
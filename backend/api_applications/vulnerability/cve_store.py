@@ -0,0 +1,398 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from . import cpe, cve_index, nvd_stream
+
+INDEX_FILENAME = "cve_index.sqlite3"
+MMAP_SIZE = int(os.getenv("CVE_INDEX_MMAP_SIZE", str(1 << 30)))
+# page cache the builder may use, so ingesting a feed stays within a fixed
+# memory budget however large the feed is
+BUILD_CACHE_KB = int(os.getenv("CVE_INDEX_BUILD_CACHE_KB", "65536"))
+# readers further behind than this many deltas drop their whole range cache
+CHANGE_HISTORY = int(os.getenv("CVE_INDEX_CHANGE_HISTORY", "100"))
+# ids bound per IN (...) query; SQLite builds before 3.32 allow 999
+SQL_CHUNK = 500
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE cves (
+    idx INTEGER PRIMARY KEY,
+    cve_id TEXT NOT NULL UNIQUE,
+    description TEXT,
+    published TEXT,
+    assigner TEXT,
+    last_modified TEXT,
+    score REAL
+);
+CREATE TABLE ranges (
+    product TEXT NOT NULL,
+    cve INTEGER NOT NULL,
+    start TEXT,
+    start_incl INTEGER,
+    end TEXT,
+    end_incl INTEGER
+);
+CREATE INDEX ranges_product ON ranges (product);
+CREATE INDEX ranges_cve ON ranges (cve);
+CREATE TABLE changes (generation INTEGER NOT NULL, product TEXT NOT NULL);
+CREATE INDEX changes_generation ON changes (generation);
+CREATE VIRTUAL TABLE descriptions USING fts5(
+    body, versions UNINDEXED, tokenize = "unicode61 tokenchars '+'"
+);
+"""
+
+
+def encode_version(parsed):
+    return None if parsed is None else json.dumps(parsed)
+
+
+def decode_version(value):
+    return None if value is None else tuple(tuple(p) for p in json.loads(value))
+
+
+def feed_version(filename):
+    st = os.stat(filename)
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+def index_path(feed_path):
+    return os.path.join(os.path.dirname(feed_path), INDEX_FILENAME)
+
+
+def _meta(conn):
+    return dict(conn.execute("SELECT key, value FROM meta"))
+
+
+def _set_meta(conn, **values):
+    conn.executemany(
+        "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+        [(k, str(v)) for k, v in values.items()],
+    )
+
+
+def apply_items(conn, items):
+    """Merge feed items into the store by CVE ID and lastModifiedDate.
+
+    Items that are not newer than the stored copy are skipped; a changed
+    CVE has its ranges and description rows replaced. Returns
+    (changed CVE IDs, {product: ProductRanges}) where the ranges are the
+    old and new ranges of the changed CVEs, so callers can tell which
+    versions of a product the delta affects.
+    """
+    changed, products = [], {}
+
+    def touch(product, rng):
+        products.setdefault(product, cpe.ProductRanges()).add(rng)
+
+    for item in items:
+        meta = item["cve"]["CVE_data_meta"]
+        last_modified = item.get("lastModifiedDate", "")
+        row = conn.execute(
+            "SELECT idx, last_modified FROM cves WHERE cve_id = ?", (meta["ID"],)
+        ).fetchone()
+        if row is not None:
+            idx, stored = row
+            if stored and last_modified and stored >= last_modified:
+                continue
+            for product, start, start_incl, end, end_incl in conn.execute(
+                "SELECT product, start, start_incl, end, end_incl FROM ranges"
+                " WHERE cve = ?",
+                (idx,),
+            ):
+                touch(product, cpe.VersionRange(
+                    idx, decode_version(start), bool(start_incl),
+                    decode_version(end), bool(end_incl)))
+            conn.execute("DELETE FROM ranges WHERE cve = ?", (idx,))
+            conn.execute("DELETE FROM descriptions WHERE rowid = ?", (idx,))
+        else:
+            idx = None
+
+        descs = item["cve"]["description"].get("description_data", [])
+        text = " ".join(d.get("value", "") for d in descs)
+        cursor = conn.execute(
+            "INSERT OR REPLACE INTO cves VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                idx,
+                meta["ID"],
+                descs[0].get("value", "") if descs else "",
+                item.get("publishedDate", ""),
+                meta.get("ASSIGNER", ""),
+                last_modified,
+                cve_index.cvss_score(item),
+            ),
+        )
+        idx = cursor.lastrowid if idx is None else idx
+        conn.execute(
+            "INSERT INTO descriptions (rowid, body, versions) VALUES (?, ?, ?)",
+            (idx, text, " ".join(cve_index.description_versions(text))),
+        )
+        rows = []
+        for product, rng in cpe.compile_ranges(item, idx):
+            product = cpe.normalize_product(product)
+            touch(product, rng)
+            rows.append((
+                product,
+                idx,
+                encode_version(rng.start),
+                rng.start_incl,
+                encode_version(rng.end),
+                rng.end_incl,
+            ))
+        conn.executemany("INSERT INTO ranges VALUES (?, ?, ?, ?, ?, ?)", rows)
+        changed.append(meta["ID"])
+    for ranges in products.values():
+        ranges.finalize()
+    return changed, products
+
+
+def build_index_file(items, path, version):
+    """Write a fresh store for the given items to path.
+
+    The file is built next to the target and moved into place with
+    os.replace, so readers either keep the old file or open the new one.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute(f"PRAGMA cache_size=-{BUILD_CACHE_KB}")
+        conn.executescript(SCHEMA)
+        changed, products = apply_items(conn, items)
+        _set_meta(conn, feed_version=version, generation=0)
+        conn.commit()
+        # WAL lets merges commit while readers hold a batch snapshot
+        conn.execute("PRAGMA journal_mode=WAL")
+    finally:
+        conn.close()
+    os.replace(tmp, path)
+    logging.info(f"[cve_store] Wrote {len(changed)} CVEs to {path}")
+    return changed, products
+
+
+def merge_feed(items, path, version):
+    """Apply a delta feed to the store at path in one transaction.
+
+    Cost is proportional to the number of changed CVEs. Readers see either
+    the state before or after the commit and only recompile the products
+    recorded for the new generation. Returns (changed IDs, products) as
+    apply_items does.
+    """
+    conn = sqlite3.connect(path, timeout=60)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA cache_size=-{BUILD_CACHE_KB}")
+        with conn:
+            generation = int(_meta(conn).get("generation", 0)) + 1
+            changed, products = apply_items(conn, items)
+            conn.executemany(
+                "INSERT INTO changes VALUES (?, ?)",
+                [(generation, p) for p in products],
+            )
+            conn.execute(
+                "DELETE FROM changes WHERE generation <= ?",
+                (generation - CHANGE_HISTORY,),
+            )
+            _set_meta(conn, feed_version=version, generation=generation)
+    finally:
+        conn.close()
+    logging.info(
+        f"[cve_store] Merged {len(changed)} changed CVEs touching "
+        f"{len(products)} products into {path}"
+    )
+    return changed, products
+
+
+def ingest_feed(feed_path, path=None):
+    """Bring the store up to date with one downloaded feed file."""
+    path = path or index_path(feed_path)
+    version = feed_version(feed_path)
+    items = nvd_stream.iter_cve_items(feed_path)
+    if not os.path.exists(path):
+        return build_index_file(items, path, version)
+    return merge_feed(items, path, version)
+
+
+def ingest_directory(feed_dir, path=None):
+    """Load every nvdcve-1.1-*.json.gz in feed_dir, yearly feeds first.
+
+    Used to bootstrap the full history; the modified feed sorts last so
+    its newer records win.
+    """
+    feeds = sorted(
+        (f for f in os.listdir(feed_dir)
+         if f.startswith("nvdcve-1.1-") and f.endswith(".json.gz")),
+        key=lambda f: (f.endswith("-modified.json.gz"), f),
+    )
+    path = path or os.path.join(feed_dir, INDEX_FILENAME)
+    for feed in feeds:
+        ingest_feed(os.path.join(feed_dir, feed), path)
+    return path
+
+
+class CVEIndexFile:
+    """Read-only view of the store built by build_index_file.
+
+    The file is opened with mmap so every worker on the host shares the same
+    pages through the OS page cache. Products are compiled into
+    ProductRanges the first time they are looked up; refresh() drops only
+    the products a merged delta touched.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.inode = os.stat(path).st_ino
+        # not mode=ro: a WAL reader needs to map the shared-memory index
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA query_only=ON")
+        self._conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        self._products = {}
+        self._data_version = None
+        self.generation = None
+        self.refresh()
+
+    def close(self):
+        self._conn.close()
+
+    @contextmanager
+    def snapshot(self):
+        """Hold one read transaction so a batch sees a single generation.
+
+        Merges still commit underneath; the next refresh() picks them up.
+        """
+        self._conn.execute("BEGIN")
+        try:
+            yield self
+        finally:
+            self._conn.rollback()
+
+    @property
+    def version(self):
+        return f"{self.feed_version}-{self.generation}"
+
+    def refresh(self):
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return self
+        meta = _meta(self._conn)
+        generation = int(meta.get("generation", 0))
+        if self.generation is not None and generation != self.generation:
+            oldest = self._conn.execute(
+                "SELECT MIN(generation) FROM changes").fetchone()[0]
+            if oldest is None or oldest > self.generation + 1:
+                self._products.clear()
+            else:
+                for (product,) in self._conn.execute(
+                    "SELECT DISTINCT product FROM changes WHERE generation > ?",
+                    (self.generation,),
+                ):
+                    self._products.pop(product, None)
+        self.feed_version = meta.get("feed_version")
+        self.generation = generation
+        self._count = self._conn.execute("SELECT COUNT(*) FROM cves").fetchone()[0]
+        self._data_version = data_version
+        return self
+
+    def _product(self, product):
+        if product not in self._products:
+            rows = self._conn.execute(
+                "SELECT cve, start, start_incl, end, end_incl FROM ranges"
+                " WHERE product = ?",
+                (product,),
+            ).fetchall()
+            ranges = None
+            if rows:
+                ranges = cpe.ProductRanges()
+                for cve, start, start_incl, end, end_incl in rows:
+                    ranges.add(
+                        cpe.VersionRange(
+                            cve,
+                            decode_version(start),
+                            bool(start_incl),
+                            decode_version(end),
+                            bool(end_incl),
+                        )
+                    )
+                ranges.finalize()
+            self._products[product] = ranges
+        return self._products[product]
+
+    def match_description(self, service_name, version):
+        tokens = cve_index.product_tokens(service_name)
+        if not tokens:
+            return []
+        query = " ".join(f'"{t}"' for t in tokens)
+        version_lc = str(version).lower()
+        rows = self._conn.execute(
+            "SELECT rowid, versions FROM descriptions WHERE descriptions MATCH ?",
+            (query,),
+        )
+        return [idx for idx, versions in rows if version_lc in versions.split()]
+
+    def _cve_rows(self, column, values):
+        """Yield the entries whose column is in values, in column order.
+
+        The values are bound in chunks of SQL_CHUNK to stay under SQLite's
+        bound-parameter limit.
+        """
+        values = sorted(values)
+        for start in range(0, len(values), SQL_CHUNK):
+            chunk = values[start:start + SQL_CHUNK]
+            rows = self._conn.execute(
+                "SELECT cve_id, description, published, assigner, score FROM cves"
+                f" WHERE {column} IN ({','.join('?' * len(chunk))}) ORDER BY {column}",
+                chunk,
+            )
+            for c, d, p, a, score in rows:
+                yield {"cve_id": c, "description": d, "published": p,
+                       "assigner": a, "score": score}
+
+    def entries(self, idxs):
+        return list(self._cve_rows("idx", idxs))
+
+    def details(self, cve_ids):
+        """Return {cve_id: entry} for the given IDs."""
+        return {entry["cve_id"]: entry for entry in self._cve_rows("cve_id", set(cve_ids))}
+
+    def search(self, service_name, version):
+        if service_name is None or version is None:
+            return []
+        parsed = cpe.parse_version(version)
+        ranges = self._product(cpe.normalize_product(service_name))
+        if parsed is not None and ranges is not None:
+            hits = ranges.match(parsed)
+        else:
+            hits = self.match_description(service_name, version)
+        return self.entries(hits)
+
+    def __len__(self):
+        return self._count
+
+
+_lock = threading.Lock()
+_index = None
+
+
+def get_index(path):
+    """Return the process-wide reader for the store at path.
+
+    The refresher keeps the store up to date; the reader picks up merged
+    deltas, which costs one PRAGMA when nothing changed, and reopens the
+    file if a full rebuild swapped it out.
+    """
+    global _index
+    with _lock:
+        if (
+            _index is None
+            or _index.path != path
+            or _index.inode != os.stat(path).st_ino
+        ):
+            _index = CVEIndexFile(path)
+            logging.info(f"[cve_store] Opened {path} with {len(_index)} CVEs")
+        return _index.refresh()
@@ -1,71 +1,283 @@
 import logging
-from pymongo import UpdateOne
+import os
+import re
+from datetime import datetime
+from pymongo import UpdateMany, UpdateOne
 
-from shared_libs import monogo_connections
+from shared_libs import (
+    change_stream, host_cache, mongo_indexes, monogo_connections, write_buffer,
+)
 
-from . import cve_lookup,threat_intelligence
+from . import cpe, cve_lookup, matcher, threat_intelligence, vuln_producer
 
+THREAT_SWEEP_CHUNK_SIZE = int(os.getenv("THREAT_SWEEP_CHUNK_SIZE", "1000"))
+REEVALUATE_BATCH_SIZE = int(os.getenv("REEVALUATE_BATCH_SIZE", "500"))
+# stamped on hosts to re-evaluate when the stage follows a change stream
+REQUEUED_FIELD = "vuln_requeued_at"
 
-def update_vulnerability(results):
 
+def check_indexes():
     try:
         db = monogo_connections.connect_monogo()
-        try:
-            operations = []
-            for i in results:
-                vul = cve_lookup.get_vul(i["service_type"])
-                if vul:
-                    logging.info(f"Updating vuls, result is: {vul}")
-                    logging.info(f"getting vuls of : {i}")
+        return mongo_indexes.check_indexes(db.scan_results)
+    except Exception as e:
+        logging.error(f"Operation do not complete in check indexes : {e}")
+        return []
 
-                operations.append(
-                    UpdateOne(
-                        {"_id": i["_id"]},
-                        {
-                            "$set": {"vulnerability": vul}
 
-                        },
-                        upsert=True,
-                    )
-                )
-            if operations:
-                result = db.scan_results.bulk_write(operations, ordered=False)
-                logging.info(
-                    f"Flushed {operations}\n updates in one batch to db")
+def vulnerability_fields(results, cves=None):
+    """Return {_id: fields} with the services and CVE matches of each host.
+
+    Matching runs on the worker pool. Hosts only keep the ID and score of
+    each CVE; the IDs are collected into cves for save_cves.
+    """
+    fields = {}
+    for _id, services, matches in matcher.pool.match(results):
+        if matches:
+            logging.info(f"getting vuls of : {_id}")
+        port_services = {}
+        for port, service, version, cpe_uri in services:
+            port_services.setdefault(port, []).append(
+                {"service": service, "version": version, "cpe": cpe_uri})
+        refs = {}
+        for service, found in matches:
+            refs[service] = [{"cve_id": c, "score": score} for c, score in found]
+            if cves is not None:
+                cves.update(c for c, _ in found)
+        fields[_id] = {
+            "vulnerability": refs,
+            "services": port_services,
+            "service_keys": sorted({
+                cpe.service_key(service, version)
+                for _, service, version, _ in services
+                if service and version
+            }),
+        }
+    return fields
+
+
+_saved_cves = set()
+_saved_version = None
+
+
+def save_cves(db, cve_ids):
+    """Upsert CVE details into the cves collection, keyed by CVE ID.
+
+    A CVE is written once per store version; later batches that match it
+    again skip the write. Details are read from the store in one query.
+    """
+    global _saved_version
+    index = cve_lookup.current_index()
+    if index.version != _saved_version:
+        _saved_cves.clear()
+        _saved_version = index.version
+    missing = [cve_id for cve_id in cve_ids if cve_id not in _saved_cves]
+    operations = [
+        UpdateOne(
+            {"_id": cve_id},
+            {"$set": {k: v for k, v in details.items() if k != "cve_id"}},
+            upsert=True,
+        )
+        for cve_id, details in index.details(missing).items()
+    ]
+    if operations:
+        db.cves.bulk_write(operations, ordered=False)
+        _saved_cves.update(missing)
+    return len(operations)
+
 
+def threat_fields(results):
+    """Return {_id: fields} with the blacklist flag of each host."""
+    blacklisted = threat_intelligence.check_batch([i["_id"] for i in results])
+    return {
+        i["_id"]: {"threat_inteligence": blacklisted[i["_id"]]}
+        for i in results
+    }
+
+
+def update_results(results):
+    """Hand every field the stage computed for a batch to the write buffer.
+
+    The vulnerability and threat fields of a host are merged into one $set.
+    A stage that fails is logged and the fields of the other one are still
+    written.
+    """
+    fields, cves = {}, set()
+    stages = (
+        ("vuls", lambda batch: vulnerability_fields(batch, cves)),
+        ("threat", threat_fields),
+    )
+    for name, stage in stages:
+        try:
+            for _id, values in stage(results).items():
+                fields.setdefault(_id, {}).update(values)
         except Exception as e:
-            logging.error(f"Operation do not complete in vuls : {e}")
+            logging.error(f"Operation do not complete in {name} : {e}")
+
+    try:
+        if fields:
+            # details first, so no host references a CVE that is not stored
+            if cves:
+                save_cves(monogo_connections.connect_monogo(), cves)
+            write_buffer.buffer.add_many(
+                {_id: (values, {}) for _id, values in fields.items()})
+    except Exception as e:
+        logging.error(f"Operation do not complete in update results : {e}")
+
 
+def _stamp_hosts(keys):
+    try:
+        db = monogo_connections.connect_monogo()
+        result = db.scan_results.update_many(
+            _key_query(keys), {"$set": {REQUEUED_FIELD: datetime.now()}})
+        logging.info(
+            f"Re-evaluation: {result.modified_count} hosts stamped for "
+            f"{len(keys)} service keys")
+        return result.modified_count
     except Exception as e:
-        logging.error(f"Operation do not complete in vuls : {e}")
+        logging.error(f"Operation do not complete in re-evaluation : {e}")
+        return 0
 
 
-def update_threat(results):
+def sweep_threat_intel(added, removed):
+    """Apply a blacklist delta to the hosts already stored in scan_results.
 
+    Only hosts whose flag actually changes are written. A removed entry is
+    unflagged only when no remaining entry (e.g. a CIDR) still covers it.
+    Returns the number of hosts changed.
+    """
     try:
         db = monogo_connections.connect_monogo()
-        try:
-            operations = []
-            for i in results:
-                logging.info(f"the ip is {i}")
-                
-                operations.append(
-                    UpdateOne(
-                        {"_id": i["_id"]},
-                        {
-                            "$set": {"threat_inteligence": threat_intelligence.is_ip_blacklisted(i['_id'])}
+        blacklist = threat_intelligence.get_blacklist()
+        flag_ips = list(threat_intelligence.expand_entries(added))
+        candidates = list(threat_intelligence.expand_entries(removed))
+        still_listed = blacklist.check_batch(candidates)
+        unflag_ips = [ip for ip in candidates if not still_listed[ip]]
 
-                        },
-                        upsert=True,
+        operations = []
+        for ips, query, flag in (
+            (flag_ips, {"$ne": True}, True),
+            (unflag_ips, True, False),
+        ):
+            for start in range(0, len(ips), THREAT_SWEEP_CHUNK_SIZE):
+                chunk = ips[start:start + THREAT_SWEEP_CHUNK_SIZE]
+                operations.append(
+                    UpdateMany(
+                        {"_id": {"$in": chunk}, "threat_inteligence": query},
+                        {"$set": {"threat_inteligence": flag}},
                     )
                 )
-            if operations:
-                result = db.scan_results.bulk_write(operations, ordered=False)
-                logging.info(
-                    f"Flushed {operations}\n updates in one batch to db")
+        if not operations:
+            return 0
+        result = db.scan_results.bulk_write(operations, ordered=False)
+        host_cache.cache.invalidate(flag_ips + unflag_ips)
+        logging.info(
+            f"Threat sweep: {len(flag_ips)} added, {len(unflag_ips)} removed, "
+            f"{result.modified_count} hosts changed"
+        )
+        return result.modified_count
 
-        except Exception as e:
-            logging.error(f"Operation do not complete in threat : {e}")
+    except Exception as e:
+        logging.error(f"Operation do not complete in threat sweep : {e}")
+        return 0
+
+
+def refresh_threat_intel():
+    added, removed = threat_intelligence.fetch_and_save()
+    if added or removed:
+        threat_intelligence.reload_blacklist()
+    return sweep_threat_intel(added, removed)
+
+
+def _product_query(products):
+    prefixes = [re.compile(f"^{re.escape(p)}:") for p in sorted(products)]
+    return {"service_keys": {"$in": prefixes}}
+
+
+def _key_query(keys):
+    return {"service_keys": {"$in": sorted(keys)}}
+
+
+def affected_keys(products):
+    """Return the stored service_keys whose CVEs a delta can change.
+
+    products maps each changed product to the old and new ranges of the
+    changed CVEs. Only the distinct keys of those products are read, and a
+    version neither range matches is left out. Versions that cannot be
+    parsed are kept, since they are matched by description instead.
+    """
+    db = monogo_connections.connect_monogo()
+    keys = []
+    for key in db.scan_results.distinct("service_keys", _product_query(products)):
+        product, _, version = key.partition(":")
+        if product not in products:
+            continue
+        parsed = cpe.parse_version(version)
+        if parsed is None or products[product].match(parsed):
+            keys.append(key)
+    return keys
+
+
+def hosts_for_keys(keys):
+    """Yield {_id, service_type} of every host running one of keys.
+
+    An exact $in on service_keys is answered from its index, so only the
+    hosts running an affected version are visited.
+    """
+    db = monogo_connections.connect_monogo()
+    cursor = db.scan_results.find(
+        _key_query(keys),
+        {"service_type": 1},
+        batch_size=REEVALUATE_BATCH_SIZE,
+    )
+    for host in cursor:
+        yield {"_id": host["_id"], "service_type": host.get("service_type") or {}}
+
+
+def reevaluate_products(products):
+    """Queue the hosts whose CVEs a delta changed.
+
+    products is {product: ProductRanges} as returned by the CVE store; only
+    hosts running a version the old or new ranges match are picked. They
+    go through the vulnerability stage again as ordinary vuln_tasks
+    batches, so the consumer picks them up against the new store
+    generation. In change stream mode the hosts are stamped instead and
+    the stream hands them to the stage. Returns the hosts queued.
+    """
+    if not products:
+        return 0
+    try:
+        keys = affected_keys(products)
+    except Exception as e:
+        logging.error(f"Operation do not complete in re-evaluation : {e}")
+        return 0
+    if not keys:
+        logging.info(f"Re-evaluation: no stored versions of {len(products)} products affected")
+        return 0
+    if change_stream.uses_change_streams():
+        return _stamp_hosts(keys)
+    sizes = []
+
+    def batches():
+        # streamed, so the affected hosts are never all held in memory
+        batch = []
+        for host in hosts_for_keys(keys):
+            batch.append(host)
+            if len(batch) == REEVALUATE_BATCH_SIZE:
+                sizes.append(len(batch))
+                yield batch
+                batch = []
+        if batch:
+            sizes.append(len(batch))
+            yield batch
+
+    try:
+        vuln_producer.send_vuln_batches(batches())
+        queued = sum(sizes)
+        logging.info(
+            f"Re-evaluation: {queued} hosts queued for {len(keys)} service keys")
+        return queued
 
     except Exception as e:
-        logging.error(f"Operation do not complete in threat : {e}")
+        logging.error(f"Operation do not complete in re-evaluation : {e}")
+        return 0
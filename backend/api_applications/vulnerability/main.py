@@ -1,28 +1,33 @@
 import logging
-import os
 
-import schedule
+from shared_libs import change_stream
 
 from . import cve_lookup
-from . import vulnerability_counsumer
+from . import db_operations
+from . import refresher
 from . import threat_intelligence
+from . import vulnerability_counsumer
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
 
 def main():
+    # make sure there is reference data before the first batch
+    cve_lookup.ensure_cve_file_exists()
+    threat_intelligence.ensure_blacklist_file_exists()
+    db_operations.check_indexes()
+
+    refresher.Refresher().start()
+    if change_stream.uses_change_streams():
+        change_stream.StreamConsumer(
+            "vulnerability",
+            change_stream.fields_changed(
+                ["service_type", db_operations.REQUEUED_FIELD],
+                project=["service_type"]),
+            vulnerability_counsumer.process_targets,
+        ).run()
     while True:
-
-        try:
-            schedule.every(1.5).hours.do(
-                cve_lookup.download_and_replace_nvd,
-                os.path.join(os.path.dirname(__file__), "cve_data"),
-            )
-            schedule.every(2).hours.do(threat_intelligence.fetch_and_save)
-
-        except Exception as e:
-            logging.error("Failed to download or replace CVE file.")
         vulnerability_counsumer.get_batches()
 
 
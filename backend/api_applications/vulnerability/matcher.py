@@ -0,0 +1,118 @@
+import logging
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from . import cve_lookup, service_engine, vul_cache
+
+MATCH_WORKERS = int(os.getenv("VUL_MATCH_WORKERS", str(os.cpu_count() or 1)))
+MATCH_CHUNK_SIZE = int(os.getenv("VUL_MATCH_CHUNK_SIZE", "16"))
+# smaller batches are matched inline, the pool round trip would cost more
+MATCH_MIN_BATCH = int(os.getenv("VUL_MATCH_MIN_BATCH", "32"))
+# spawn, not fork: the consumer process already runs the refresher thread
+MATCH_START_METHOD = os.getenv("VUL_MATCH_START_METHOD", "spawn")
+
+_store_path = None
+
+
+def match_host(target):
+    """Match one host and return it as plain tuples.
+
+    (_id, ((port, service, version, cpe), ...),
+     ((service, ((cve_id, score), ...)), ...))
+    """
+    port_services = service_engine.engine.extract_ports(target.get("service_type"))
+    matches = cve_lookup.match_services(cve_lookup.service_pairs(port_services))
+    return (
+        target["_id"],
+        tuple(
+            (port, *service)
+            for port, services in port_services.items()
+            for service in services
+        ),
+        tuple(
+            (service, tuple((m["cve_id"], m.get("score")) for m in found))
+            for service, found in matches.items()
+        ),
+    )
+
+
+def _init_worker(store_path):
+    global _store_path
+    _store_path = store_path
+
+
+def _match_chunk(targets):
+    # each worker opens the store itself; pages are shared through mmap and
+    # only the targets and the result tuples cross the process boundary
+    index = cve_lookup.swap_index(_store_path)
+    before = vul_cache.cache.counters()
+    with index.snapshot():
+        rows = [match_host(target) for target in targets]
+    # the worker's cache is not visible to the parent, so its counts travel
+    # back with the rows
+    after = vul_cache.cache.counters()
+    return rows, {name: after[name] - before[name] for name in after}
+
+
+class MatchPool:
+    """Spreads the matching of a batch over worker processes."""
+
+    def __init__(self, workers=MATCH_WORKERS, chunk_size=MATCH_CHUNK_SIZE,
+                 min_batch=MATCH_MIN_BATCH, start_method=MATCH_START_METHOD):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.min_batch = min_batch
+        self.start_method = start_method
+        self._executor = None
+        self._store_path = None
+        self._worker_counters = Counter()
+
+    def _get_executor(self, store_path):
+        if self._executor is not None and self._store_path != store_path:
+            self.close()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(self.start_method),
+                initializer=_init_worker,
+                initargs=(store_path,),
+            )
+            self._store_path = store_path
+        return self._executor
+
+    def match(self, targets):
+        """Return match_host() tuples for every target, in order."""
+        if self.workers <= 1 or len(targets) < self.min_batch:
+            return [match_host(target) for target in targets]
+
+        store_path = cve_lookup.current_index().path
+        chunks = [
+            targets[start:start + self.chunk_size]
+            for start in range(0, len(targets), self.chunk_size)
+        ]
+        try:
+            executor = self._get_executor(store_path)
+            matched = []
+            for rows, counters in executor.map(_match_chunk, chunks):
+                matched.extend(rows)
+                self._worker_counters.update(counters)
+            return matched
+        except BrokenProcessPool as e:
+            logging.error(f"[matcher] Worker pool died, matching inline: {e}")
+            self.close()
+            return [match_host(target) for target in targets]
+
+    def cache_stats(self):
+        """vul_cache stats of this process plus the lookups of the workers."""
+        return vul_cache.cache.stats(self._worker_counters)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+pool = MatchPool()
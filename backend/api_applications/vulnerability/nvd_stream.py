@@ -0,0 +1,52 @@
+import gzip
+import json
+import os
+
+CHUNK_SIZE = int(os.getenv("NVD_STREAM_CHUNK_SIZE", str(1 << 16)))
+
+_WHITESPACE = " \t\n\r,"
+
+
+def iter_cve_items(filename, chunk_size=CHUNK_SIZE):
+    """Yield the entries of an NVD feed's CVE_Items array one at a time.
+
+    The gzip stream is read in chunks and each item is decoded with
+    raw_decode as soon as it is complete, so memory holds one chunk plus
+    the current item no matter how large the feed is.
+    """
+    decoder = json.JSONDecoder()
+    with gzip.open(filename, "rt", encoding="utf-8") as f:
+        buf = ""
+        while True:
+            pos = buf.find('"CVE_Items"')
+            if pos != -1:
+                start = buf.find("[", pos)
+                if start != -1:
+                    break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            # keep a tail so a key split across chunks is still found
+            buf = buf[-16:] + chunk if pos == -1 else buf + chunk
+
+        buf, pos, eof = buf[start + 1:], 0, False
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            if pos < len(buf):
+                try:
+                    item, pos = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                else:
+                    yield item
+                    continue
+            elif eof:
+                raise ValueError(f"{filename} ended inside CVE_Items")
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
@@ -0,0 +1,56 @@
+import logging
+import os
+import threading
+
+import schedule
+
+from . import cve_lookup, db_operations
+
+CVE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cve_data")
+CVE_REFRESH_HOURS = float(os.getenv("CVE_REFRESH_HOURS", "1.5"))
+THREAT_REFRESH_HOURS = float(os.getenv("THREAT_REFRESH_HOURS", "2"))
+REFRESH_POLL_SECONDS = float(os.getenv("REFRESH_POLL_SECONDS", "30"))
+
+
+def refresh_cve_data():
+    try:
+        changed, products = cve_lookup.download_and_replace_nvd(CVE_DATA_DIR)
+        logging.info(
+            f"[refresher] CVE store updated: {len(changed)} CVEs, "
+            f"{len(products)} products"
+        )
+        db_operations.reevaluate_products(products)
+    except Exception as e:
+        # the consumer keeps matching against the previous generation
+        logging.error(f"[refresher] CVE refresh failed: {e}")
+
+
+def refresh_threat_data():
+    try:
+        db_operations.refresh_threat_intel()
+    except Exception as e:
+        logging.error(f"[refresher] Threat-intel refresh failed: {e}")
+
+
+class Refresher(threading.Thread):
+    """Runs the reference data jobs next to the consumer.
+
+    Downloads are verified and merged here, off the hot path; the consumer
+    only swaps to the new store generation and blacklist between batches.
+    """
+
+    def __init__(self, poll_seconds=REFRESH_POLL_SECONDS):
+        super().__init__(name="refresher", daemon=True)
+        self.poll_seconds = poll_seconds
+        self.scheduler = schedule.Scheduler()
+        self.scheduler.every(CVE_REFRESH_HOURS).hours.do(refresh_cve_data)
+        self.scheduler.every(THREAT_REFRESH_HOURS).hours.do(refresh_threat_data)
+        self._stopped = threading.Event()
+
+    def run(self):
+        logging.info("[refresher] Started")
+        while not self._stopped.wait(self.poll_seconds):
+            self.scheduler.run_pending()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,168 @@
+import re
+from collections import namedtuple
+
+from . import cpe
+
+VERSION = r"(\d+(?:\.\w+)*)"
+
+# banner_grabbing prefixes every banner with the protocol it spoke
+_PROTOCOL_RE = re.compile(r"^(SSH|FTP|SMTP|HTTPS?|Generic)\b")
+_PROTOCOL_GROUPS = {"HTTPS": "HTTP"}
+
+Service = namedtuple("Service", "service version cpe")
+
+
+class Rule:
+    """A keyword-gated pattern that names one product.
+
+    The regex only runs when the literal keyword occurs in the lowercased
+    banner; group 1, when present, is the version.
+    """
+
+    __slots__ = ("keyword", "pattern", "service", "vendor", "product")
+
+    def __init__(self, keyword, pattern, service, vendor=None, product=None):
+        self.keyword = keyword
+        self.pattern = re.compile(pattern, re.I)
+        self.service = service
+        self.vendor = vendor
+        self.product = product
+
+    def match(self, banner):
+        m = self.pattern.search(banner)
+        if m is None:
+            return None
+        version = m.group(1) if m.groups() else None
+        return Service(
+            self.service,
+            version,
+            cpe.format_cpe(self.vendor, self.product, version) if self.vendor else None,
+        )
+
+
+RULES = {
+    "SSH": [
+        Rule("openssh", rf"openssh[_-]{VERSION}", "OpenSSH", "openbsd", "openssh"),
+        Rule("dropbear", rf"dropbear(?:_sshd?)?[_-]{VERSION}", "dropbear",
+             "dropbear_ssh_project", "dropbear_ssh"),
+    ],
+    "FTP": [
+        Rule("vsftpd", rf"vsftpd\s+{VERSION}", "vsFTPd", "beasts", "vsftpd"),
+        Rule("proftpd", rf"proftpd\s+{VERSION}", "ProFTPD", "proftpd", "proftpd"),
+        Rule("pure-ftpd", r"pure-ftpd", "Pure-FTPd", "pureftpd", "pure-ftpd"),
+        Rule("filezilla", rf"filezilla server(?: version)?\s+{VERSION}",
+             "FileZilla Server", "filezilla-project", "filezilla_server"),
+    ],
+    "SMTP": [
+        Rule("exim", rf"\bexim\s+{VERSION}", "Exim", "exim", "exim"),
+        Rule("postfix", rf"\bpostfix(?:\s+{VERSION})?", "Postfix", "postfix", "postfix"),
+        Rule("sendmail", rf"\bsendmail\s+{VERSION}", "Sendmail", "sendmail", "sendmail"),
+        Rule("microsoft esmtp", rf"microsoft esmtp mail service(?:.*?version:?\s+{VERSION})?",
+             "Exchange", "microsoft", "exchange_server"),
+        Rule("mailenable", rf"mailenable\D*{VERSION}?", "MailEnable",
+             "mailenable", "mailenable"),
+    ],
+    "HTTP": [
+        Rule("apache/", rf"\bapache/{VERSION}", "Apache", "apache", "http_server"),
+        Rule("nginx", rf"\bnginx(?:/{VERSION})?", "nginx", "f5", "nginx"),
+        Rule("openresty", rf"openresty(?:/{VERSION})?", "openresty",
+             "openresty", "openresty"),
+        Rule("lighttpd", rf"lighttpd(?:/{VERSION})?", "lighttpd", "lighttpd", "lighttpd"),
+        Rule("microsoft-iis", rf"microsoft-iis(?:/{VERSION})?", "Microsoft-IIS",
+             "microsoft", "internet_information_services"),
+        Rule("microsoft-httpapi", rf"microsoft-httpapi(?:/{VERSION})?",
+             "Microsoft-HTTPAPI"),
+        Rule("php/", rf"\bphp/{VERSION}", "PHP", "php", "php"),
+        Rule("openssl/", rf"\bopenssl/{VERSION}", "OpenSSL", "openssl", "openssl"),
+        Rule("apache-coyote", rf"apache-coyote(?:/{VERSION})?", "Apache-Coyote"),
+    ],
+}
+
+# tried only when no keyword rule named anything, so unknown products still
+# get a (service, version) for the description match
+FALLBACK_RULES = [
+    re.compile(r"SSH-\d+\.\d+-([^\s_]+)(?:_(\S+))?"),
+    re.compile(r"(?:Server|X-Powered-By):\s*([A-Za-z][\w.\-]*)(?:/(\d[\w.]*))?", re.I),
+]
+GENERIC_RE = re.compile(r"([A-Za-z][A-Za-z0-9\-_]{2,})[ /\-_]v?(\d+\.\d+(?:\.\d+)*)")
+# protocol names the generic pattern would otherwise report as products
+GENERIC_IGNORE = {"http", "https", "ssh", "esmtp", "smtp", "ftp", "utf-8"}
+
+
+class ServiceEngine:
+    """Turns banners into (service, version, cpe) per port.
+
+    Rules are compiled once and grouped by the protocol banner_grabbing
+    tagged the banner with. Each group has one alternation of its literal
+    keywords; a single scan of the banner finds which keywords occur and
+    only their rules run.
+    """
+
+    def __init__(self, rules=RULES, prefilter=True):
+        self.prefilter = prefilter
+        self.groups = {}
+        every = []
+        for protocol, group in rules.items():
+            self.groups[protocol] = self._compile(group)
+            every.extend(group)
+        self.any_protocol = self._compile(every)
+
+    @staticmethod
+    def _compile(rules):
+        by_keyword = {}
+        for rule in rules:
+            by_keyword.setdefault(rule.keyword, []).append(rule)
+        # longest first, so a keyword that contains another still wins
+        keywords = sorted(by_keyword, key=len, reverse=True)
+        scan = re.compile("|".join(re.escape(k) for k in keywords))
+        return scan, by_keyword, rules
+
+    def _group(self, banner):
+        m = _PROTOCOL_RE.match(banner)
+        protocol = m.group(1) if m else None
+        return self.groups.get(_PROTOCOL_GROUPS.get(protocol, protocol), self.any_protocol)
+
+    def extract(self, banner):
+        """Return the distinct Services named in one banner."""
+        if not banner:
+            return []
+        scan, by_keyword, rules = self._group(banner)
+        if self.prefilter:
+            keywords = dict.fromkeys(m.group(0) for m in scan.finditer(banner.lower()))
+            candidates = [rule for k in keywords for rule in by_keyword[k]]
+        else:
+            candidates = rules
+
+        found = [s for s in (rule.match(banner) for rule in candidates) if s]
+        if not found:
+            found = self._fallback(banner)
+        return list(dict.fromkeys(found))
+
+    @staticmethod
+    def _fallback(banner):
+        found = []
+        for pattern in FALLBACK_RULES:
+            for m in pattern.finditer(banner):
+                found.append(Service(m.group(1).strip(), m.group(2), None))
+        if not found:
+            for m in GENERIC_RE.finditer(banner):
+                if m.group(1).lower() not in GENERIC_IGNORE:
+                    found.append(Service(m.group(1), m.group(2), None))
+        return found
+
+    def extract_ports(self, service_type):
+        """{port: banner} -> {port: [Service]} for every port of a host."""
+        return {
+            str(port): self.extract(banner)
+            for port, banner in (service_type or {}).items()
+        }
+
+    def extract_batch(self, targets):
+        """Extract every port of every target in one pass, keyed by _id."""
+        return {
+            target["_id"]: self.extract_ports(target.get("service_type"))
+            for target in targets
+        }
+
+
+engine = ServiceEngine()
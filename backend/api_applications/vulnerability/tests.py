@@ -1,7 +1,39 @@
+import os
+import sys
 import unittest
 from unittest.mock import MagicMock, patch, mock_open
-import cve_lookup
-import threat_intelligence
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+
+sys.path.append(parent_dir)
+
+from vulnerability import cpe
+from vulnerability import db_operations
+from vulnerability import nvd_stream
+from vulnerability import cve_index
+from vulnerability import cve_lookup
+from vulnerability import cve_store
+from vulnerability import matcher
+from vulnerability import refresher
+from vulnerability import service_engine
+from vulnerability import threat_intelligence
+from vulnerability import vul_cache
+
+
+def make_cve_item(cve_id, description, published="2021-01-01T00:00Z", cpe_match=None):
+    item = {
+        "cve": {
+            "CVE_data_meta": {"ID": cve_id, "ASSIGNER": "testassigner"},
+            "description": {"description_data": [{"value": description}]},
+        },
+        "publishedDate": published,
+    }
+    if cpe_match:
+        item["configurations"] = {
+            "nodes": [{"operator": "OR", "children": [], "cpe_match": cpe_match}]
+        }
+    return item
 
 
 class TestVulnerabilityModule(unittest.TestCase):
@@ -31,32 +63,33 @@ class TestVulnerabilityModule(unittest.TestCase):
         result = cve_lookup.get_service(banners)
         self.assertEqual(result, [(None, None)])
 
-    @patch("gzip.open")
-    @patch("os.path.join", return_value="fakepath")
-    def test_search_cve_by_service_version_returns_results(self, mock_join, mock_gzip_open):
-        fake_cve_data = {
-            "CVE_Items": [
-                {
-                    "cve": {
-                        "CVE_data_meta": {"ID": "CVE-2021-0001", "ASSIGNER": "testassigner"},
-                        "description": {
-                            "description_data": [
-                                {"value": "apache 2.4.29 remote vulnerability"}
-                            ]
-                        }
-                    },
-                    "publishedDate": "2021-01-01T00:00Z"
-                }
-            ]
-        }
-        mock_gzip_open.return_value.__enter__.return_value = MagicMock()
-        with patch("json.load", return_value=fake_cve_data):
-            results = cve_lookup.search_cve_by_service_version(
-                ("Apache", "2.4.29"))
+    @patch("vulnerability.vul_cache.cache", vul_cache.VulCache())
+    @patch("vulnerability.cve_lookup._index", None)
+    @patch("vulnerability.cve_lookup.ensure_cve_file_exists", return_value="fakepath")
+    @patch("vulnerability.cve_store.get_index")
+    def test_search_cve_by_service_version_returns_results(self, mock_get_index, mock_ensure):
+        mock_get_index.return_value = cve_index.CVEIndex.from_items(
+            [make_cve_item("CVE-2021-0001", "apache 2.4.29 remote vulnerability")], "v1"
+        )
+        results = cve_lookup.search_cve_by_service_version(("Apache", "2.4.29"))
         self.assertTrue(any(r["cve_id"] == "CVE-2021-0001" for r in results))
+        mock_get_index.assert_called_once_with("fakepath")
 
-    @patch("cve_lookup.get_service")
-    @patch("cve_lookup.search_cve_by_service_version")
+    @patch("vulnerability.vul_cache.cache", vul_cache.VulCache())
+    @patch("vulnerability.cve_lookup._index", None)
+    @patch("vulnerability.cve_lookup.ensure_cve_file_exists", return_value="fakepath")
+    @patch("vulnerability.cve_store.get_index")
+    def test_names_with_different_description_matches_are_cached_apart(
+            self, mock_get_index, mock_ensure):
+        mock_get_index.return_value = cve_index.CVEIndex.from_items(
+            [make_cve_item("CVE-2021-0001", "apache 2.4.29 remote vulnerability")], "v1"
+        )
+        self.assertEqual(cve_lookup.search_cve_by_service_version(("apache_httpd", "2.4.29")), [])
+        results = cve_lookup.search_cve_by_service_version(("apache", "2.4.29"))
+        self.assertEqual([r["cve_id"] for r in results], ["CVE-2021-0001"])
+
+    @patch("vulnerability.cve_lookup.get_service")
+    @patch("vulnerability.cve_lookup.search_cve_by_service_version")
     def test_get_vul_with_service(self, mock_search_cve, mock_get_service):
         mock_get_service.return_value = [("Apache", "2.4.29")]
         mock_search_cve.return_value = [
@@ -80,16 +113,642 @@ class TestVulnerabilityModule(unittest.TestCase):
                         "vsFTPd", "Postfix", "Nginx"]))
 
 
+class TestServiceEngine(unittest.TestCase):
+
+    def test_every_port_is_parsed(self):
+        ports = service_engine.engine.extract_ports({
+            22: "SSH:\nSSH-2.0-OpenSSH_8.2p1 Ubuntu-4ubuntu0.5",
+            80: "HTTP:\n['HTTP/1.1 200 OK', 'Server: Apache/2.4.29 (Ubuntu)', "
+                "'X-Powered-By: PHP/7.2.24']",
+            21: "FTP:\n220 (vsFTPd 2.3.4)",
+        })
+        self.assertEqual(ports["22"], [("OpenSSH", "8.2p1",
+                                        "cpe:2.3:a:openbsd:openssh:8.2p1:*:*:*:*:*:*:*")])
+        self.assertEqual([s.service for s in ports["80"]], ["Apache", "PHP"])
+        self.assertEqual(ports["80"][0].cpe,
+                         "cpe:2.3:a:apache:http_server:2.4.29:*:*:*:*:*:*:*")
+        self.assertEqual(ports["21"][0][:2], ("vsFTPd", "2.3.4"))
+
+    def test_prefilter_skips_rules_without_keyword(self):
+        match = service_engine.Rule.match
+        with patch.object(service_engine.Rule, "match", autospec=True,
+                          side_effect=match) as mock_match:
+            service_engine.engine.extract("HTTP:\n['Server: Apache/2.4.29 (Ubuntu)']")
+        ran = [call.args[0].service for call in mock_match.call_args_list]
+        self.assertEqual(ran, ["Apache"])
+
+    def test_protocol_limits_rule_group(self):
+        # an SMTP keyword in an HTTP banner is not an SMTP service
+        services = service_engine.engine.extract(
+            "HTTP:\n['Server: nginx/1.18.0', 'X-Mailer: Exim 4.87']")
+        self.assertEqual([s.service for s in services], ["nginx"])
+
+    def test_unknown_product_falls_back_to_header(self):
+        services = service_engine.engine.extract(
+            "HTTP:\n['HTTP/1.1 200 OK', 'Server: Caddy/2.6.4']")
+        self.assertEqual(services, [("Caddy", "2.6.4", None)])
+
+    def test_extract_batch_keys_by_host(self):
+        batch = service_engine.engine.extract_batch([
+            {"_id": "1.1.1.1", "service_type": {"22": "SSH:\nSSH-2.0-dropbear_2019.78"}},
+            {"_id": "2.2.2.2", "service_type": None},
+        ])
+        self.assertEqual(batch["1.1.1.1"]["22"][0][:2], ("dropbear", "2019.78"))
+        self.assertEqual(batch["2.2.2.2"], {})
+
+    @patch("vulnerability.cve_lookup.search_cve_by_service_version", return_value=[])
+    def test_vulnerability_fields_store_services(self, mock_search):
+        fields = db_operations.vulnerability_fields([{
+            "_id": "1.1.1.1",
+            "service_type": {"21": "FTP:\n220 (vsFTPd 2.3.4)",
+                             "25": "SMTP:\n220 mx ESMTP Exim 4.87"},
+        }])
+        searched = sorted(c.args[0] for c in mock_search.call_args_list)
+        self.assertEqual(searched, [("Exim", "4.87"), ("vsFTPd", "2.3.4")])
+        self.assertEqual(fields["1.1.1.1"]["services"]["25"][0]["cpe"],
+                         "cpe:2.3:a:exim:exim:4.87:*:*:*:*:*:*:*")
+
+
+class TestMatchPool(unittest.TestCase):
+
+    FIXTURES = os.path.join(current_dir, "fixtures", "nvd")
+
+    def setUp(self):
+        import gzip
+        import shutil
+        import tempfile
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name in os.listdir(self.FIXTURES):
+            with open(os.path.join(self.FIXTURES, name), "rb") as src, \
+                    gzip.open(os.path.join(tmp.name, name + ".gz"), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        path = cve_store.ingest_directory(tmp.name)
+        for target, value in [("vulnerability.cve_store._index", None),
+                              ("vulnerability.vul_cache.cache", vul_cache.VulCache())]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch("vulnerability.cve_lookup._index", cve_store.get_index(path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.targets = [
+            {"_id": f"10.0.0.{n}", "service_type": {
+                "22": "SSH:\nSSH-2.0-OpenSSH_8.2p1 Ubuntu-4ubuntu0.5",
+                "21": "FTP:\n220 (vsFTPd 2.3.4)" if n % 2 else "FTP:\n220 (vsFTPd 3.0.3)",
+            }}
+            for n in range(5)
+        ]
+
+    def test_match_host_returns_tuples(self):
+        _id, services, matches = matcher.match_host(self.targets[1])
+        self.assertEqual(_id, "10.0.0.1")
+        self.assertIn(("21", "vsFTPd", "2.3.4", "cpe:2.3:a:beasts:vsftpd:2.3.4:*:*:*:*:*:*:*"),
+                      services)
+        self.assertEqual(dict(matches), {
+            "OpenSSH": (("CVE-2021-41617", 7.0), ("CVE-2023-38408", 9.8)),
+            "vsFTPd": (("CVE-2011-2523", 10.0),),
+        })
+
+    def test_small_batches_stay_inline(self):
+        pool = matcher.MatchPool(workers=4, min_batch=10)
+        with patch.object(pool, "_get_executor") as get_executor:
+            rows = pool.match(self.targets)
+        get_executor.assert_not_called()
+        self.assertEqual([r[0] for r in rows], [t["_id"] for t in self.targets])
+
+    def test_workers_match_like_inline(self):
+        pool = matcher.MatchPool(workers=2, chunk_size=2, min_batch=1)
+        self.addCleanup(pool.close)
+        expected = [matcher.match_host(t) for t in self.targets]
+        self.assertEqual(pool.match(self.targets), expected)
+
+    def test_worker_cache_lookups_are_counted(self):
+        pool = matcher.MatchPool(workers=2, chunk_size=2, min_batch=1)
+        self.addCleanup(pool.close)
+        pool.match(self.targets)
+        stats = pool.cache_stats()
+        # two services per host, all looked up in the workers
+        self.assertEqual(stats["hits"] + stats["shared_hits"] + stats["misses"], 10)
+        self.assertGreater(stats["hit_rate"], 0)
+
+    def test_broken_pool_falls_back_inline(self):
+        from concurrent.futures.process import BrokenProcessPool
+
+        pool = matcher.MatchPool(workers=2, min_batch=1)
+        executor = MagicMock()
+        executor.map.side_effect = BrokenProcessPool("worker killed")
+        with patch.object(pool, "_get_executor", return_value=executor):
+            rows = pool.match(self.targets)
+        self.assertEqual(len(rows), 5)
+
+
+class TestReevaluation(unittest.TestCase):
+
+    def test_service_keys_written_with_matches(self):
+        with patch("vulnerability.cve_lookup.search_cve_by_service_version",
+                   return_value=[]):
+            fields = db_operations.vulnerability_fields([{
+                "_id": "1.1.1.1",
+                "service_type": {
+                    "80": "HTTP:\n['Server: Apache/2.4.29 (Ubuntu)']",
+                    "21": "FTP:\n220---------- Welcome to Pure-FTPd [TLS] ---",
+                },
+            }])
+        # Pure-FTPd has no version to match on, so it is not indexed
+        self.assertEqual(fields["1.1.1.1"]["service_keys"], ["http_server:2.4.29"])
+
+    @staticmethod
+    def openssh_delta():
+        # one changed CVE affecting OpenSSH 8.0 up to, not including, 8.9
+        ranges = cpe.ProductRanges()
+        ranges.add(cpe.VersionRange(
+            1, cpe.parse_version("8.0"), True, cpe.parse_version("8.9"), False))
+        return {"openssh": ranges.finalize()}
+
+    @patch("vulnerability.db_operations.monogo_connections.connect_monogo")
+    def test_only_affected_versions_are_selected(self, mock_connect):
+        distinct = mock_connect.return_value.scan_results.distinct
+        distinct.return_value = [
+            "openssh:7.4", "openssh:8.2p1", "openssh:9.3", "openssh:unknown",
+            "http_server:2.4.29",
+        ]
+
+        keys = db_operations.affected_keys(self.openssh_delta())
+
+        field, query = distinct.call_args[0]
+        self.assertEqual(field, "service_keys")
+        self.assertEqual([p.pattern for p in query["service_keys"]["$in"]], ["^openssh:"])
+        # unparsable versions are matched by description, so they are kept
+        self.assertEqual(keys, ["openssh:8.2p1", "openssh:unknown"])
+
+    @patch("vulnerability.db_operations.monogo_connections.connect_monogo")
+    def test_hosts_looked_up_by_exact_keys(self, mock_connect):
+        find = mock_connect.return_value.scan_results.find
+        find.return_value = [{"_id": "1.1.1.1", "service_type": {"22": "x"}},
+                             {"_id": "2.2.2.2"}]
+
+        hosts = list(db_operations.hosts_for_keys(["openssh:8.2p1", "dropbear_ssh:2019.78"]))
+
+        self.assertEqual(find.call_args[0][0], {"service_keys": {"$in": [
+            "dropbear_ssh:2019.78", "openssh:8.2p1"]}})
+        self.assertEqual(hosts, [{"_id": "1.1.1.1", "service_type": {"22": "x"}},
+                                 {"_id": "2.2.2.2", "service_type": {}}])
+
+    @patch("vulnerability.db_operations.REEVALUATE_BATCH_SIZE", 2)
+    @patch("vulnerability.db_operations.affected_keys", return_value=["openssh:8.2p1"])
+    @patch("vulnerability.db_operations.hosts_for_keys")
+    def test_affected_hosts_queued_in_batches(self, mock_hosts, mock_keys):
+        mock_hosts.return_value = iter(
+            {"_id": f"10.0.0.{n}", "service_type": {}} for n in range(5))
+        sent = []
+        with patch("vulnerability.db_operations.vuln_producer.send_vuln_batches",
+                   side_effect=lambda batches: sent.extend(batches)):
+            queued = db_operations.reevaluate_products(self.openssh_delta())
+        self.assertEqual(queued, 5)
+        self.assertEqual([len(b) for b in sent], [2, 2, 1])
+        mock_hosts.assert_called_once_with(["openssh:8.2p1"])
+
+    @patch("vulnerability.db_operations.vuln_producer.send_vuln_batches")
+    @patch("vulnerability.db_operations.affected_keys", return_value=[])
+    def test_unaffected_versions_queue_nothing(self, mock_keys, mock_send):
+        self.assertEqual(db_operations.reevaluate_products(self.openssh_delta()), 0)
+        mock_send.assert_not_called()
+
+    @patch("vulnerability.db_operations.change_stream.PIPELINE_MODE", "change_stream")
+    @patch("vulnerability.db_operations.vuln_producer.send_vuln_batches")
+    @patch("vulnerability.db_operations.affected_keys", return_value=["openssh:8.2p1"])
+    @patch("vulnerability.db_operations.monogo_connections.connect_monogo")
+    def test_change_stream_mode_stamps_hosts(self, mock_connect, mock_keys, mock_send):
+        update_many = mock_connect.return_value.scan_results.update_many
+        update_many.return_value.modified_count = 3
+
+        self.assertEqual(db_operations.reevaluate_products(self.openssh_delta()), 3)
+
+        query, update = update_many.call_args[0]
+        self.assertEqual(query, {"service_keys": {"$in": ["openssh:8.2p1"]}})
+        self.assertIn(db_operations.REQUEUED_FIELD, update["$set"])
+        mock_send.assert_not_called()
+
+    @patch("vulnerability.db_operations.vuln_producer.send_vuln_batches")
+    def test_no_products_queue_nothing(self, mock_send):
+        self.assertEqual(db_operations.reevaluate_products({}), 0)
+        mock_send.assert_not_called()
+
+    @patch("vulnerability.refresher.db_operations.reevaluate_products")
+    @patch("vulnerability.refresher.cve_lookup.download_and_replace_nvd",
+           return_value=(["CVE-2023-38408"], {"openssh"}))
+    def test_refresh_reevaluates_delta_products(self, mock_download, mock_reevaluate):
+        refresher.refresh_cve_data()
+        mock_reevaluate.assert_called_once_with({"openssh"})
+
+
+class TestUpdateResults(unittest.TestCase):
+
+    targets = [
+        {"_id": "1.1.1.1", "service_type": {"21": "FTP:\n220 (vsFTPd 2.3.4)"}},
+        {"_id": "2.2.2.2", "service_type": {}},
+    ]
+
+    details = {"CVE-2011-2523": {
+        "cve_id": "CVE-2011-2523", "description": "backdoor",
+        "published": "2011-07-07T00:00Z", "assigner": "cve@mitre.org", "score": 10.0}}
+
+    def setUp(self):
+        index = MagicMock(version="v1")
+        index.details.side_effect = lambda ids: {
+            i: self.details[i] for i in ids if i in self.details}
+        patcher = patch("vulnerability.db_operations.cve_lookup.current_index",
+                        return_value=index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        buffer = db_operations.write_buffer.WriteBuffer(
+            db_operations.write_buffer._scan_results, max_latency=60)
+        patcher = patch("vulnerability.db_operations.write_buffer.buffer", buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        db_operations._saved_cves.clear()
+
+    @patch("vulnerability.db_operations.threat_intelligence.check_batch",
+           return_value={"1.1.1.1": False, "2.2.2.2": True})
+    @patch("vulnerability.cve_lookup.search_cve_by_service_version",
+           return_value=[{"cve_id": "CVE-2011-2523", "description": "backdoor",
+                          "published": "2011-07-07T00:00Z", "assigner": "cve@mitre.org",
+                          "score": 10.0}])
+    @patch("vulnerability.db_operations.monogo_connections.connect_monogo")
+    def test_one_merged_set_per_host(self, mock_connect, mock_search, mock_check):
+        db_operations.update_results(self.targets)
+        db_operations.write_buffer.buffer.flush()
+
+        bulk_write = mock_connect.return_value.scan_results.bulk_write
+        bulk_write.assert_called_once()
+        operations = bulk_write.call_args[0][0]
+        self.assertEqual(bulk_write.call_args[1], {"ordered": False})
+        self.assertEqual([op._filter["_id"] for op in operations],
+                         ["1.1.1.1", "2.2.2.2"])
+        first = operations[0]._doc["$set"]
+        self.assertEqual(set(first), {"vulnerability", "services", "service_keys",
+                                      "threat_inteligence"})
+        self.assertEqual(first["vulnerability"],
+                         {"vsFTPd": [{"cve_id": "CVE-2011-2523", "score": 10.0}]})
+        self.assertTrue(operations[1]._doc["$set"]["threat_inteligence"])
+
+    @patch("vulnerability.cve_lookup.search_cve_by_service_version",
+           return_value=[{"cve_id": "CVE-2011-2523", "description": "backdoor",
+                          "published": "2011-07-07T00:00Z", "assigner": "cve@mitre.org",
+                          "score": 10.0}])
+    @patch("vulnerability.db_operations.monogo_connections.connect_monogo")
+    def test_cve_details_written_once_per_version(self, mock_connect, mock_search):
+        cves = mock_connect.return_value.cves
+        with patch("vulnerability.db_operations.threat_intelligence.check_batch",
+                   side_effect=lambda ips: dict.fromkeys(ips, False)):
+            db_operations.update_results(self.targets)
+            db_operations.update_results(self.targets)
+
+        cves.bulk_write.assert_called_once()
+        op = cves.bulk_write.call_args[0][0][0]
+        self.assertEqual(op._filter, {"_id": "CVE-2011-2523"})
+        self.assertEqual(op._doc["$set"], {"description": "backdoor",
+                                           "published": "2011-07-07T00:00Z",
+                                           "assigner": "cve@mitre.org", "score": 10.0})
+
+    @patch("vulnerability.db_operations.threat_intelligence.check_batch",
+           side_effect=Exception("no blacklist"))
+    @patch("vulnerability.cve_lookup.search_cve_by_service_version", return_value=[])
+    @patch("vulnerability.db_operations.monogo_connections.connect_monogo")
+    def test_failed_stage_keeps_the_other(self, mock_connect, mock_search, mock_check):
+        db_operations.update_results(self.targets)
+        db_operations.write_buffer.buffer.flush()
+
+        operations = mock_connect.return_value.scan_results.bulk_write.call_args[0][0]
+        self.assertEqual(len(operations), 2)
+        self.assertNotIn("threat_inteligence", operations[0]._doc["$set"])
+
+
+class TestCVEIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = cve_index.CVEIndex.from_items([
+            make_cve_item("CVE-2020-0001", "OpenSSH 8.2p1 allows remote attackers"),
+            make_cve_item("CVE-2020-0002", "nginx 1.18.0 has an off-by-one"),
+            make_cve_item("CVE-2020-0003", "Microsoft IIS 10.0 request smuggling"),
+            make_cve_item("CVE-2020-0004", "Apache HTTP Server 2.4.29 mod_proxy"),
+        ])
+
+    def test_search_filters_by_version(self):
+        ids = [r["cve_id"] for r in self.index.search("OpenSSH", "8.2p1")]
+        self.assertEqual(ids, ["CVE-2020-0001"])
+        self.assertEqual(self.index.search("OpenSSH", "7.4"), [])
+
+    def test_search_multi_token_product(self):
+        ids = [r["cve_id"] for r in self.index.search("Microsoft-IIS", "10.0")]
+        self.assertEqual(ids, ["CVE-2020-0003"])
+
+    def test_search_without_version_matches_nothing(self):
+        self.assertEqual(self.index.search("nginx", None), [])
+        self.assertEqual(self.index.search(None, None), [])
+
+
+class TestCPEMatching(unittest.TestCase):
+
+    def setUp(self):
+        self.index = cve_index.CVEIndex.from_items([
+            make_cve_item(
+                "CVE-2021-41617", "sshd in OpenSSH 6.2 through 8.x before 8.8",
+                cpe_match=[{
+                    "vulnerable": True,
+                    "cpe23Uri": "cpe:2.3:a:openbsd:openssh:*:*:*:*:*:*:*:*",
+                    "versionStartIncluding": "6.2",
+                    "versionEndExcluding": "8.8",
+                }],
+            ),
+            make_cve_item(
+                "CVE-2021-23017", "A security issue in nginx resolver",
+                cpe_match=[{
+                    "vulnerable": True,
+                    "cpe23Uri": "cpe:2.3:a:f5:nginx:*:*:*:*:*:*:*:*",
+                    "versionStartIncluding": "0.6.18",
+                    "versionEndExcluding": "1.20.1",
+                }],
+            ),
+            make_cve_item(
+                "CVE-2011-2523", "vsftpd 2.3.4 contains a backdoor",
+                cpe_match=[{
+                    "vulnerable": True,
+                    "cpe23Uri": "cpe:2.3:a:vsftpd_project:vsftpd:2.3.4:*:*:*:*:*:*:*",
+                }],
+            ),
+            make_cve_item(
+                "CVE-2019-0211", "Apache HTTP Server 2.4.17 to 2.4.38",
+                cpe_match=[{
+                    "vulnerable": True,
+                    "cpe23Uri": "cpe:2.3:a:apache:http_server:*:*:*:*:*:*:*:*",
+                    "versionStartIncluding": "2.4.17",
+                    "versionEndIncluding": "2.4.38",
+                }],
+            ),
+        ])
+
+    def ids(self, service, version):
+        return [r["cve_id"] for r in self.index.search(service, version)]
+
+    def test_parse_version_ordering(self):
+        self.assertLess(cpe.parse_version("8.2"), cpe.parse_version("8.2p1"))
+        self.assertLess(cpe.parse_version("8.2p1"), cpe.parse_version("8.3"))
+        self.assertLess(cpe.parse_version("1.9"), cpe.parse_version("1.10"))
+        self.assertLess(cpe.parse_version("1.0-beta"), cpe.parse_version("1.0-rc1"))
+        self.assertLess(cpe.parse_version("1.0-rc1"), cpe.parse_version("1.0"))
+        self.assertLess(cpe.parse_version("1.0"), cpe.parse_version("1.0a"))
+
+    def test_range_ending_at_release_excludes_it(self):
+        ranges = cpe.ProductRanges()
+        ranges.add(cpe.VersionRange(1, None, True, cpe.parse_version("2.0"), False))
+        ranges.finalize()
+        self.assertEqual(ranges.match(cpe.parse_version("2.0-rc2")), {1})
+        self.assertEqual(ranges.match(cpe.parse_version("2.0")), set())
+
+    def test_range_match_agrees_with_a_linear_scan(self):
+        import random
+
+        rand = random.Random(7)
+        version = lambda: cpe.parse_version(f"{rand.randint(0, 9)}.{rand.randint(0, 9)}")
+        ranges, product = [], cpe.ProductRanges()
+        for cve in range(300):
+            start, end = sorted([version(), version()])
+            rng = cpe.VersionRange(
+                cve, rand.choice([start, None]), rand.random() < 0.5,
+                rand.choice([end, end, None]), rand.random() < 0.5)
+            if rng.start is not None and rng.start == rng.end:
+                # what compile_ranges makes of an exact CPE version
+                rng.start_incl = rng.end_incl = True
+            ranges.append(rng)
+            product.add(rng)
+        product.finalize()
+        for _ in range(200):
+            parsed = version()
+            expected = {r.cve for r in ranges if r.contains(parsed)}
+            self.assertEqual(product.match(parsed), expected)
+
+    def test_unparsable_versions_do_not_match_everything(self):
+        item = make_cve_item("CVE-2000-0001", "beta build", cpe_match=[
+            {"vulnerable": True,
+             "cpe23Uri": "cpe:2.3:a:openbsd:openssh:beta:*:*:*:*:*:*:*"},
+            {"vulnerable": True,
+             "cpe23Uri": "cpe:2.3:a:openbsd:openssh:-:*:*:*:*:*:*:*"},
+            {"vulnerable": True,
+             "cpe23Uri": "cpe:2.3:a:openbsd:openssh:*:*:*:*:*:*:*:*",
+             "versionEndExcluding": "vendor-build"},
+        ])
+        self.assertEqual(list(cpe.compile_ranges(item, 0)), [])
+        index = cve_index.CVEIndex.from_items([item])
+        self.assertEqual(index.search("OpenSSH", "9.9p1"), [])
+
+    def test_range_bounds(self):
+        self.assertEqual(self.ids("OpenSSH", "8.2p1"), ["CVE-2021-41617"])
+        self.assertEqual(self.ids("OpenSSH", "6.2"), ["CVE-2021-41617"])
+        self.assertEqual(self.ids("OpenSSH", "8.8"), [])
+        self.assertEqual(self.ids("OpenSSH", "6.1"), [])
+        self.assertEqual(self.ids("nginx", "1.18.0"), ["CVE-2021-23017"])
+        self.assertEqual(self.ids("nginx", "1.20.1"), [])
+
+    def test_exact_version(self):
+        self.assertEqual(self.ids("vsFTPd", "2.3.4"), ["CVE-2011-2523"])
+        self.assertEqual(self.ids("vsFTPd", "3.0.3"), [])
+
+    def test_alias_and_inclusive_end(self):
+        self.assertEqual(self.ids("Apache", "2.4.38"), ["CVE-2019-0211"])
+        self.assertEqual(self.ids("Apache", "2.4.39"), [])
+
+    def test_version_none_matches_nothing(self):
+        self.assertEqual(self.ids("OpenSSH", None), [])
+        self.assertEqual(self.ids("OpenSSH", "none"), [])
+
+
+class TestCVEStore(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.items = [
+            make_cve_item(
+                "CVE-2021-41617", "sshd in OpenSSH 6.2 through 8.x before 8.8",
+                cpe_match=[{
+                    "vulnerable": True,
+                    "cpe23Uri": "cpe:2.3:a:openbsd:openssh:*:*:*:*:*:*:*:*",
+                    "versionStartIncluding": "6.2",
+                    "versionEndExcluding": "8.8",
+                }],
+            ),
+            make_cve_item("CVE-2020-0002", "nginx 1.18.0 has an off-by-one"),
+        ]
+        patcher = patch("vulnerability.cve_store._index", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_file_matches_in_memory_index(self):
+        path = os.path.join(self.tmp.name, "index.sqlite3")
+        cve_store.build_index_file(self.items, path, "v1")
+        on_disk = cve_store.CVEIndexFile(path)
+        in_memory = cve_index.CVEIndex.from_items(self.items)
+        for service, version in [("OpenSSH", "8.2p1"), ("OpenSSH", "9.0"),
+                                 ("nginx", "1.18.0"), ("nginx", "1.19.0")]:
+            self.assertEqual(on_disk.search(service, version),
+                             in_memory.search(service, version))
+        self.assertEqual(on_disk.feed_version, "v1")
+        self.assertEqual(len(on_disk), 2)
+        on_disk.close()
+
+    def test_get_index_picks_up_merged_delta(self):
+        path = os.path.join(self.tmp.name, "index.sqlite3")
+        cve_store.build_index_file(self.items, path, "v1")
+        reader = cve_store.get_index(path)
+        self.assertIs(cve_store.get_index(path), reader)
+        self.assertEqual(len(reader.search("OpenSSH", "8.8")), 0)
+        version = reader.version
+
+        updated = make_cve_item(
+            "CVE-2021-41617", "sshd in OpenSSH 6.2 through 8.x before 8.9",
+            cpe_match=[{
+                "vulnerable": True,
+                "cpe23Uri": "cpe:2.3:a:openbsd:openssh:*:*:*:*:*:*:*:*",
+                "versionStartIncluding": "6.2",
+                "versionEndExcluding": "8.9",
+            }],
+        )
+        updated["lastModifiedDate"] = "2023-01-01T00:00Z"
+        changed, products = cve_store.merge_feed([updated], path, "v2")
+        self.assertEqual(changed, ["CVE-2021-41617"])
+        self.assertEqual(set(products), {"openssh"})
+        # the new range reaches 8.8, so hosts on it are affected by the delta
+        self.assertTrue(products["openssh"].match(cpe.parse_version("8.8")))
+        self.assertFalse(products["openssh"].match(cpe.parse_version("9.1")))
+
+        self.assertIs(cve_store.get_index(path), reader)
+        self.assertNotEqual(reader.version, version)
+        self.assertEqual(len(reader.search("OpenSSH", "8.8")), 1)
+        self.assertEqual(len(reader), 2)
+
+    def test_snapshot_holds_generation_while_merge_commits(self):
+        path = os.path.join(self.tmp.name, "index.sqlite3")
+        cve_store.build_index_file(self.items, path, "v1")
+        reader = cve_store.get_index(path)
+        added = make_cve_item("CVE-2023-0003", "nginx 1.18.0 leaks memory")
+        added["lastModifiedDate"] = "2023-01-01T00:00Z"
+
+        with reader.snapshot():
+            self.assertEqual(len(reader.search("nginx", "1.18.0")), 1)
+            cve_store.merge_feed([added], path, "v2")
+            self.assertEqual(len(reader.search("nginx", "1.18.0")), 1)
+
+        self.assertEqual(len(cve_store.get_index(path).search("nginx", "1.18.0")), 2)
+
+
+class TestNVDIngestion(unittest.TestCase):
+
+    FIXTURES = os.path.join(current_dir, "fixtures", "nvd")
+
+    def setUp(self):
+        import gzip
+        import shutil
+        import tempfile
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for name in os.listdir(self.FIXTURES):
+            with open(os.path.join(self.FIXTURES, name), "rb") as src, \
+                    gzip.open(os.path.join(self.tmp.name, name + ".gz"), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        self.modified = os.path.join(self.tmp.name, "nvdcve-1.1-modified.json.gz")
+
+    def ids(self, index, service, version):
+        return [r["cve_id"] for r in index.search(service, version)]
+
+    def test_bootstrap_from_directory(self):
+        path = cve_store.ingest_directory(self.tmp.name)
+        index = cve_store.CVEIndexFile(path)
+        self.assertEqual(len(index), 4)
+        scores = {r["cve_id"]: r["score"] for r in index.search("OpenSSH", "8.2p1")}
+        self.assertEqual(scores, {"CVE-2021-41617": 7.0, "CVE-2023-38408": 9.8})
+        # v2 only
+        self.assertEqual(index.search("vsFTPd", "2.3.4")[0]["score"], 10.0)
+        self.assertEqual(self.ids(index, "OpenSSH", "8.2p1"),
+                         ["CVE-2021-41617", "CVE-2023-38408"])
+        self.assertEqual(self.ids(index, "dropbear", "2019.78"), ["CVE-2021-41617"])
+        self.assertEqual(self.ids(index, "vsFTPd", "2.3.4"), ["CVE-2011-2523"])
+        index.close()
+
+    @patch("vulnerability.cve_store.SQL_CHUNK", 3)
+    def test_lookups_bind_ids_in_chunks(self):
+        index = cve_store.CVEIndexFile(cve_store.ingest_directory(self.tmp.name))
+        idxs = [idx for (idx,) in index._conn.execute("SELECT idx FROM cves")]
+        entries = index.entries(reversed(idxs))
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(sorted(index.details(e["cve_id"] for e in entries)),
+                         sorted(e["cve_id"] for e in entries))
+        index.close()
+
+    def test_delta_only_applies_newer_records(self):
+        yearly = os.path.join(self.tmp.name, "nvdcve-1.1-2021.json.gz")
+        path = os.path.join(self.tmp.name, cve_store.INDEX_FILENAME)
+        cve_store.ingest_feed(yearly, path)
+
+        changed, products = cve_store.ingest_feed(self.modified, path)
+        # CVE-2021-23017 has the same lastModifiedDate and is skipped
+        self.assertEqual(sorted(changed), ["CVE-2021-41617", "CVE-2023-38408"])
+        self.assertEqual(set(products), {"openssh", "dropbear_ssh"})
+
+        changed, products = cve_store.ingest_feed(self.modified, path)
+        self.assertEqual((changed, products), ([], {}))
+
+
+class TestNVDStream(unittest.TestCase):
+
+    def write_gz(self, text):
+        import gzip
+        import tempfile
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "feed.json.gz")
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def test_matches_json_load_across_chunk_boundaries(self):
+        import json
+
+        fixture = os.path.join(current_dir, "fixtures", "nvd", "nvdcve-1.1-2021.json")
+        with open(fixture) as f:
+            text = f.read()
+        path = self.write_gz(text)
+        expected = json.loads(text)["CVE_Items"]
+        for chunk_size in (1, 7, 64, 1 << 16):
+            self.assertEqual(
+                list(nvd_stream.iter_cve_items(path, chunk_size)), expected)
+
+    def test_empty_items(self):
+        path = self.write_gz('{"CVE_data_type": "CVE", "CVE_Items" : [ ]}')
+        self.assertEqual(list(nvd_stream.iter_cve_items(path, 3)), [])
+
+    def test_truncated_feed_raises(self):
+        path = self.write_gz('{"CVE_Items": [{"cve": {}}, {"cve": ')
+        with self.assertRaises(ValueError):
+            list(nvd_stream.iter_cve_items(path, 4))
+
+
 class TestThreatIntelligence(unittest.TestCase):
 
-    @patch("threat_intelligence.fetch_and_save")
+    @patch("vulnerability.threat_intelligence.fetch_and_save")
     @patch("os.path.exists", return_value=True)
     def test_ensure_blacklist_file_exists_when_present(self, mock_exists, mock_fetch):
         path = threat_intelligence.ensure_blacklist_file_exists()
         self.assertTrue(path.endswith("blacklist_ips.txt"))
         mock_fetch.assert_not_called()
 
-    @patch("threat_intelligence.fetch_and_save")
+    @patch("vulnerability.threat_intelligence.fetch_and_save")
     @patch("os.makedirs")
     @patch(
         "os.path.exists",
@@ -101,22 +760,78 @@ class TestThreatIntelligence(unittest.TestCase):
         mock_fetch.assert_called_once()
         self.assertTrue(path.endswith("blacklist_ips.txt"))
 
-    @patch("threat_intelligence.open", new_callable=mock_open, read_data="1.2.3.4\n5.6.7.8\n")
-    @patch("threat_intelligence.ensure_blacklist_file_exists", return_value="fakepath")
-    @patch("os.path.exists", return_value=True)
-    def test_is_ip_blacklisted_true(self, mock_exists, mock_ensure, mock_file):
-        self.assertTrue(threat_intelligence.is_ip_blacklisted("1.2.3.4"))
+    def write_blacklist(self, text):
+        import tempfile
 
-    @patch("threat_intelligence.open", new_callable=mock_open, read_data="1.2.3.4\n")
-    @patch("threat_intelligence.ensure_blacklist_file_exists", return_value="fakepath")
-    @patch("os.path.exists", return_value=True)
-    def test_is_ip_blacklisted_false(self, mock_exists, mock_ensure, mock_file):
-        self.assertFalse(threat_intelligence.is_ip_blacklisted("8.8.8.8"))
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "blacklist_ips.txt")
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_is_ip_blacklisted_true(self):
+        path = self.write_blacklist("1.2.3.4\n5.6.7.8\n")
+        with patch("vulnerability.threat_intelligence.ensure_blacklist_file_exists",
+                   return_value=path), \
+                patch("vulnerability.threat_intelligence._blacklist", None):
+            self.assertTrue(threat_intelligence.is_ip_blacklisted("1.2.3.4"))
+
+    def test_is_ip_blacklisted_false(self):
+        path = self.write_blacklist("1.2.3.4\n")
+        with patch("vulnerability.threat_intelligence.ensure_blacklist_file_exists",
+                   return_value=path), \
+                patch("vulnerability.threat_intelligence._blacklist", None):
+            self.assertFalse(threat_intelligence.is_ip_blacklisted("8.8.8.8"))
+
+    def test_check_batch_ips_and_cidrs(self):
+        path = self.write_blacklist(
+            "# comment\n1.2.3.4\n10.0.0.0/24\n10.0.0.128/25\n10.0.1.0/24\n"
+            "2001:db8::/32\nnot-an-ip\n"
+        )
+        blacklist = threat_intelligence.Blacklist(path).refresh()
+        self.assertEqual(len(blacklist.starts), 1)
+        result = blacklist.check_batch(
+            ["10.0.1.255", "1.2.3.4", "10.0.2.0", "9.255.255.255",
+             "10.0.0.7", "2001:db8::1", "2001:db9::1", "bogus"]
+        )
+        self.assertEqual(result, {
+            "10.0.1.255": True, "1.2.3.4": True, "10.0.2.0": False,
+            "9.255.255.255": False, "10.0.0.7": True, "2001:db8::1": True,
+            "2001:db9::1": False, "bogus": False,
+        })
+
+    def test_reloads_only_when_mtime_changes(self):
+        path = self.write_blacklist("1.2.3.4\n")
+        blacklist = threat_intelligence.Blacklist(path).refresh()
+        with patch.object(blacklist, "load", wraps=blacklist.load) as load:
+            blacklist.refresh()
+            load.assert_not_called()
+            with open(path, "w") as f:
+                f.write("5.6.7.8\n")
+            os.utime(path, ns=(1, 1))
+            blacklist.refresh()
+            load.assert_called_once()
+        self.assertIn("5.6.7.8", blacklist)
+        self.assertNotIn("1.2.3.4", blacklist)
+
+    def test_check_batch_picks_up_a_replaced_file(self):
+        path = self.write_blacklist("1.2.3.4\n")
+        with patch("vulnerability.threat_intelligence._blacklist",
+                   threat_intelligence.Blacklist(path).refresh()):
+            self.assertEqual(threat_intelligence.check_batch(["5.6.7.8"]),
+                             {"5.6.7.8": False})
+            with open(path, "w") as f:
+                f.write("5.6.7.8\n")
+            os.utime(path, ns=(1, 1))
+            self.assertEqual(threat_intelligence.check_batch(["5.6.7.8"]),
+                             {"5.6.7.8": True})
 
     @patch("requests.get")
-    @patch("threat_intelligence.open", new_callable=mock_open)
+    @patch("os.replace")
+    @patch("vulnerability.threat_intelligence.open", new_callable=mock_open)
     @patch("os.makedirs")
-    def test_fetch_and_save_downloads_and_saves(self, mock_makedirs, mock_file, mock_get):
+    def test_fetch_and_save_downloads_and_saves(self, mock_makedirs, mock_file, mock_replace, mock_get):
         mock_get.side_effect = [
             type("Resp", (), {
                 "text": "1.1.1.1\n#comment\n",
@@ -133,6 +848,144 @@ class TestThreatIntelligence(unittest.TestCase):
         self.assertIn("1.1.1.1", written_data)
         self.assertIn("2.2.2.2", written_data)
 
+    @patch("requests.get")
+    @patch("os.replace")
+    @patch("vulnerability.threat_intelligence.read_entries", return_value={"1.1.1.1", "3.3.3.3"})
+    @patch("vulnerability.threat_intelligence.open", new_callable=mock_open)
+    @patch("os.makedirs")
+    def test_fetch_and_save_returns_delta(self, mock_makedirs, mock_file, mock_read, mock_replace, mock_get):
+        mock_get.return_value = type("Resp", (), {
+            "text": "1.1.1.1\n2.2.2.2\n",
+            "raise_for_status": staticmethod(lambda: None)
+        })()
+        added, removed = threat_intelligence.fetch_and_save()
+        self.assertEqual(added, {"2.2.2.2"})
+        self.assertEqual(removed, {"3.3.3.3"})
+
+    @patch("requests.get", side_effect=Exception("offline"))
+    @patch("os.replace")
+    @patch("os.makedirs")
+    def test_fetch_and_save_keeps_list_when_download_fails(self, mock_makedirs, mock_replace, mock_get):
+        self.assertEqual(threat_intelligence.fetch_and_save(), (set(), set()))
+        mock_replace.assert_not_called()
+
+
+class TestRefresher(unittest.TestCase):
+
+    FEED = os.path.join(current_dir, "fixtures", "nvd", "nvdcve-1.1-2021.json")
+
+    def setUp(self):
+        import gzip
+        import hashlib
+        import tempfile
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        with open(self.FEED, "rb") as f:
+            self.raw = f.read()
+        self.gz = gzip.compress(self.raw)
+        self.meta = (
+            "lastModifiedDate:2023-01-01T00:00:00-05:00\r\n"
+            f"size:{len(self.raw)}\r\n"
+            f"sha256:{hashlib.sha256(self.raw).hexdigest().upper()}\r\n"
+        )
+
+    def mock_responses(self, meta, body):
+        import io
+
+        meta_resp = MagicMock(text=meta)
+        feed_resp = MagicMock(raw=io.BytesIO(body))
+        feed_resp.__enter__.return_value = feed_resp
+        return [meta_resp, feed_resp]
+
+    def test_download_verifies_against_meta(self):
+        with patch("requests.get", side_effect=self.mock_responses(self.meta, self.gz)):
+            path = cve_lookup.download_nvd_feed("2021", self.dir)
+        self.assertEqual(os.listdir(self.dir), ["nvdcve-1.1-2021.json.gz"])
+        self.assertEqual(len(list(nvd_stream.iter_cve_items(path))), 3)
+
+    def test_corrupt_download_is_discarded(self):
+        import gzip
+
+        corrupt = gzip.compress(self.raw.replace(b"OpenSSH", b"OpenSSL"))
+        with patch("requests.get", side_effect=self.mock_responses(self.meta, corrupt)):
+            with self.assertRaises(ValueError):
+                cve_lookup.download_nvd_feed("2021", self.dir)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    @patch("vulnerability.refresher.cve_lookup.download_and_replace_nvd",
+           side_effect=Exception("offline"))
+    def test_failed_refresh_does_not_raise(self, mock_download):
+        refresher.refresh_cve_data()
+        mock_download.assert_called_once()
+
+    def test_thread_runs_due_jobs(self):
+        import threading
+        from datetime import datetime
+
+        ran = threading.Event()
+        with patch("vulnerability.refresher.refresh_cve_data", ran.set), \
+                patch("vulnerability.refresher.refresh_threat_data"):
+            worker = refresher.Refresher(poll_seconds=0.01)
+        worker.scheduler.jobs[0].next_run = datetime.now()
+        worker.start()
+        self.addCleanup(worker.stop)
+        self.assertTrue(ran.wait(5))
+
+    def test_reload_swaps_blacklist(self):
+        path = os.path.join(self.dir, "blacklist_ips.txt")
+        with open(path, "w") as f:
+            f.write("1.2.3.4\n")
+        with patch("vulnerability.threat_intelligence.ensure_blacklist_file_exists",
+                   return_value=path), \
+                patch("vulnerability.threat_intelligence._blacklist", None):
+            old = threat_intelligence.get_blacklist()
+            with open(path, "w") as f:
+                f.write("5.6.7.8\n")
+            # lookups keep the loaded list until the refresher swaps it
+            self.assertIs(threat_intelligence.get_blacklist(), old)
+            new = threat_intelligence.reload_blacklist()
+            self.assertIs(threat_intelligence.get_blacklist(), new)
+        self.assertIn("1.2.3.4", old)
+        self.assertIn("5.6.7.8", new)
+        self.assertNotIn("1.2.3.4", new)
+
+
+class TestThreatSweep(unittest.TestCase):
+
+    @patch("vulnerability.db_operations.THREAT_SWEEP_CHUNK_SIZE", 2)
+    @patch("vulnerability.db_operations.threat_intelligence.get_blacklist")
+    @patch("vulnerability.db_operations.monogo_connections.connect_monogo")
+    def test_sweep_applies_delta_in_chunks(self, mock_connect, mock_get_blacklist):
+        mock_db = MagicMock()
+        mock_db.scan_results.bulk_write.return_value.modified_count = 4
+        mock_connect.return_value = mock_db
+        blacklist = MagicMock()
+        blacklist.check_batch.side_effect = lambda ips: {
+            ip: ip == "10.0.0.1" for ip in ips}
+        mock_get_blacklist.return_value = blacklist
+
+        changed = db_operations.sweep_threat_intel(
+            {"1.1.1.1", "1.1.1.2", "1.1.1.3"}, {"10.0.0.1", "10.0.0.2"})
+
+        self.assertEqual(changed, 4)
+        operations = mock_db.scan_results.bulk_write.call_args[0][0]
+        flagged = [op._filter["_id"]["$in"] for op in operations
+                   if op._doc["$set"]["threat_inteligence"]]
+        unflagged = [op._filter["_id"]["$in"] for op in operations
+                     if not op._doc["$set"]["threat_inteligence"]]
+        self.assertEqual(sorted(sum(flagged, [])), ["1.1.1.1", "1.1.1.2", "1.1.1.3"])
+        self.assertEqual(len(flagged), 2)
+        # 10.0.0.1 is still covered by another entry
+        self.assertEqual(unflagged, [["10.0.0.2"]])
+
+    @patch("vulnerability.db_operations.monogo_connections.connect_monogo")
+    def test_sweep_without_delta_writes_nothing(self, mock_connect):
+        with patch("vulnerability.db_operations.threat_intelligence.get_blacklist"):
+            self.assertEqual(db_operations.sweep_threat_intel(set(), set()), 0)
+        mock_connect.return_value.scan_results.bulk_write.assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()
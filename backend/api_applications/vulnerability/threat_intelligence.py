@@ -1,6 +1,11 @@
-import requests
+import ipaddress
 import logging
 import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+import requests
 
 def ensure_blacklist_file_exists():
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -10,14 +15,50 @@ def ensure_blacklist_file_exists():
     os.makedirs(data_dir, exist_ok=True)
 
     if not os.path.exists(file_path):
-        print("[INFO] Blacklist file not found. Downloading...")
+        logging.info("[threat_intelligence] Blacklist file not found, downloading")
         fetch_and_save()
-        print("[INFO] Download completed.")
+        logging.info("[threat_intelligence] Blacklist download completed")
 
     return file_path
 
 
+def read_entries(path):
+    try:
+        with open(path, "r") as f:
+            return {
+                line.strip()
+                for line in f
+                if line.strip() and not line.startswith("#")
+            }
+    except FileNotFoundError:
+        return set()
+
+
+def expand_entries(entries, max_addresses=65536):
+    """Yield every address of the given IP/CIDR entries as a string.
+
+    Networks bigger than max_addresses are skipped; flagging those needs a
+    range query rather than an _id list.
+    """
+    for entry in entries:
+        try:
+            net = ipaddress.ip_network(entry, strict=False)
+        except ValueError:
+            continue
+        if net.num_addresses == 1:
+            yield str(net.network_address)
+        elif net.num_addresses > max_addresses:
+            logging.warning(f"[threat_intelligence] {entry} is too large to expand")
+        else:
+            yield from (str(ip) for ip in net)
+
+
 def fetch_and_save():
+    """Download the blacklists and replace blacklist_ips.txt.
+
+    Returns (added, removed): the entries that were not in the previous
+    file and the ones that are gone from it.
+    """
     script_dir = os.path.dirname(os.path.abspath(__file__))
     threat_dir = os.path.join(script_dir, "threat_ips")
     output_file = os.path.join(threat_dir, "blacklist_ips.txt")
@@ -41,20 +82,172 @@ def fetch_and_save():
         except Exception as e:
             logging.error(f"Failed to download from {url} - {e}")
 
-    with open(output_file, "w") as f:
+    if not all_ips:
+        # an outage upstream must not clear every flag on the next sweep
+        logging.error("No blacklist entries downloaded, keeping the old list")
+        return set(), set()
+
+    previous = read_entries(output_file)
+
+    # written aside and swapped in so a reload never sees half a file
+    tmp_file = f"{output_file}.tmp"
+    with open(tmp_file, "w") as f:
         for ip in sorted(all_ips):
             f.write(ip + "\n")
+    os.replace(tmp_file, output_file)
 
     logging.info(f"All IPs saved to {output_file}")
+    return all_ips - previous, previous - all_ips
+
+
+class Blacklist:
+    """Compact, reloadable view of blacklist_ips.txt.
+
+    Single IPv4 addresses sit in a sorted uint32 array and CIDR entries are
+    merged into disjoint [start, end] intervals, so a lookup is a bisect on
+    each. Anything else (IPv6) goes in a plain set. The file is only
+    re-parsed when its mtime changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        # (ips, starts, ends, others), replaced as one tuple so a batch
+        # running during a reload never mixes the old and new lists
+        self._tables = (array("I"), array("I"), array("I"), frozenset())
+        self._lock = threading.Lock()
+
+    @property
+    def ips(self):
+        return self._tables[0]
+
+    @property
+    def starts(self):
+        return self._tables[1]
+
+    @property
+    def ends(self):
+        return self._tables[2]
+
+    @property
+    def others(self):
+        return self._tables[3]
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        singles, intervals, others = set(), [], set()
+        with open(self.path, "r") as f:
+            for line in f:
+                entry = line.strip()
+                if not entry or entry.startswith("#"):
+                    continue
+                try:
+                    net = ipaddress.ip_network(entry, strict=False)
+                except ValueError:
+                    continue
+                if net.version != 4:
+                    others.add(net)
+                elif net.num_addresses == 1:
+                    singles.add(int(net.network_address))
+                else:
+                    intervals.append(
+                        (int(net.network_address), int(net.broadcast_address)))
+
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        self._tables = (
+            array("I", sorted(singles)),
+            array("I", (start for start, _ in merged)),
+            array("I", (end for _, end in merged)),
+            frozenset(others),
+        )
+        self.mtime = mtime
+        logging.info(
+            f"[threat_intelligence] Loaded {len(self.ips)} IPs and "
+            f"{len(self.starts)} ranges from {self.path}"
+        )
+
+    def refresh(self):
+        """Re-parse the file if its mtime changed; otherwise one stat."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logging.error(f"[threat_intelligence] Could not stat {self.path}: {e}")
+            return self
+        if mtime != self.mtime:
+            with self._lock:
+                if mtime != self.mtime:
+                    self.load()
+        return self
+
+    @staticmethod
+    def _contains_other(others, ip):
+        return any(ip in net for net in others)
+
+    def check_batch(self, ip_addresses):
+        """Return {ip: bool} for a whole batch in one sorted pass.
+
+        Queries are sorted once, so each bisect starts where the previous
+        one ended instead of at the front of the arrays.
+        """
+        ips, starts, ends, others = self._tables
+        result = {}
+        queries = []
+        for ip in ip_addresses:
+            try:
+                addr = ipaddress.ip_address(ip)
+            except ValueError:
+                result[ip] = False
+                continue
+            if addr.version == 4:
+                queries.append((int(addr), ip))
+            else:
+                result[ip] = self._contains_other(others, addr)
+
+        ip_pos = range_pos = 0
+        for value, ip in sorted(queries):
+            ip_pos = bisect_left(ips, value, ip_pos)
+            hit = ip_pos < len(ips) and ips[ip_pos] == value
+            if not hit:
+                range_pos = bisect_right(starts, value, range_pos)
+                hit = range_pos > 0 and value <= ends[range_pos - 1]
+            result[ip] = hit
+        return result
+
+    def __contains__(self, ip):
+        return self.check_batch([ip])[ip]
+
+
+_blacklist = None
+
+
+def reload_blacklist():
+    """Parse the current file into a new Blacklist and swap it in.
+
+    Run by the refresher after a download, so lookups keep using the old
+    list until the new one is complete. A file replaced any other way is
+    picked up by the refresh() of the next check_batch.
+    """
+    global _blacklist
+    blacklist = Blacklist(ensure_blacklist_file_exists()).refresh()
+    _blacklist = blacklist
+    return blacklist
+
+
+def get_blacklist():
+    blacklist = _blacklist
+    return blacklist if blacklist is not None else reload_blacklist()
 
 
 def is_ip_blacklisted(ip_address):
-    output_file = ensure_blacklist_file_exists()
-
-    if not os.path.exists(output_file):
-        raise FileNotFoundError(f"Blacklist file not found: {output_file}")
+    return ip_address in get_blacklist()
 
-    with open(output_file, "r") as f:
-        ips = set(line.strip() for line in f if line.strip())
 
-    return ip_address in ips
+def check_batch(ip_addresses):
+    # one stat per batch; the list is only re-parsed when the file changed
+    return get_blacklist().refresh().check_batch(ip_addresses)
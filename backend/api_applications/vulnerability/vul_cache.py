@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+
+from shared_libs.lru import LRUCache
+from shared_libs.redis_tier import RedisTier, client_from_url
+
+VUL_CACHE_SIZE = int(os.getenv("VUL_CACHE_SIZE", "50000"))
+VUL_CACHE_REDIS_TTL = int(os.getenv("VUL_CACHE_REDIS_TTL", "86400"))
+# opt-in: the shared tier is only used when a URL is configured
+VUL_CACHE_REDIS_URL = os.getenv("VUL_CACHE_REDIS_URL")
+
+
+class VulCache:
+    """LRU of CVE matches keyed on (service name, version, feed version).
+
+    The same service/version pairs repeat across a sweep, so the match is
+    computed once per feed version. A new feed version drops the local tier;
+    the Redis tier carries the feed version in its keys and lets old entries
+    expire.
+    """
+
+    def __init__(self, max_size=VUL_CACHE_SIZE, redis_client=None,
+                 redis_ttl=VUL_CACHE_REDIS_TTL):
+        self.shared = RedisTier(redis_client, "vul_cache")
+        self.redis_ttl = redis_ttl
+        self._local = LRUCache(max_size)
+        self._feed_version = None
+        self._lock = threading.Lock()
+        self.hits = self.shared_hits = self.misses = 0
+
+    @staticmethod
+    def key(service_name, version, feed_version):
+        # the raw name, not normalize_product(): the description fallback
+        # searches its tokens, so "apache" and "apache_httpd" can match
+        # different CVEs. Case and surrounding spaces change neither path
+        return (
+            None if service_name is None else str(service_name).strip().lower(),
+            None if version is None else str(version).lower(),
+            feed_version,
+        )
+
+    def _redis_key(self, key):
+        product, version, feed_version = key
+        return f"vul:{feed_version}:{product}:{version}"
+
+    def _get_shared(self, key):
+        def get(client):
+            value = client.get(self._redis_key(key))
+            return None if value is None else json.loads(value)
+        return self.shared.run(get)
+
+    def _set_shared(self, key, value):
+        self.shared.run(lambda client: client.set(
+            self._redis_key(key), json.dumps(value), ex=self.redis_ttl))
+
+    def _put(self, key, value):
+        with self._lock:
+            # a compute that started before a feed change must not come back
+            if key[2] == self._feed_version:
+                self._local.put(key, value)
+
+    def get_or_compute(self, service_name, version, feed_version, compute):
+        key = self.key(service_name, version, feed_version)
+        with self._lock:
+            if feed_version != self._feed_version:
+                self._local.clear()
+                self._feed_version = feed_version
+            found = self._local.get_many([key])
+        if key in found:
+            self.hits += 1
+            return found[key]
+
+        value = self._get_shared(key)
+        if value is not None:
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+            value = compute()
+            self._set_shared(key, value)
+        self._put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+            self._local.evictions = 0
+            self._feed_version = None
+            self.hits = self.shared_hits = self.misses = 0
+
+    def counters(self):
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self._local.evictions,
+        }
+
+    def stats(self, extra=None):
+        """Size and counters; extra adds counters counted elsewhere."""
+        counters = self.counters()
+        for name, value in (extra or {}).items():
+            counters[name] += value
+        lookups = counters["hits"] + counters["shared_hits"] + counters["misses"]
+        return {
+            "size": len(self._local),
+            **counters,
+            "hit_rate": (
+                (counters["hits"] + counters["shared_hits"]) / lookups if lookups else 0.0
+            ),
+            "feed_version": self._feed_version,
+        }
+
+
+cache = VulCache(redis_client=client_from_url(VUL_CACHE_REDIS_URL, "vul_cache"))
@@ -0,0 +1,38 @@
+import pika
+import json
+from datetime import datetime
+
+
+def json_serializer(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+
+def send_vuln_batches(batches, host='broker'):
+    """Publish each list of targets in batches as one vuln_tasks message."""
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    channel = connection.channel()
+
+    channel.queue_declare(queue='vuln_tasks', durable=True)
+
+    sent = 0
+    for targets_list in batches:
+        message = {
+            'targets': targets_list,
+            'timestamp': datetime.now(),
+            'batch_id': f"reevaluate_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{sent}"
+        }
+
+        channel.basic_publish(
+            exchange='',
+            routing_key='vuln_tasks',
+            body=json.dumps(message, default=json_serializer),
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+            )
+        )
+        sent += 1
+
+    connection.close()
+    return sent
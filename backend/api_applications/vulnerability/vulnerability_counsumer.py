@@ -1,7 +1,7 @@
 import pika
 import json
 import logging
-from . import db_operations
+from . import cve_lookup, db_operations, matcher
 
 
 def callback(ch, method, properties, body):
@@ -17,12 +17,19 @@ def callback(ch, method, properties, body):
         for target in targets:
             logging.info(f'[Consumer] Processing target: {target}')
 
-        db_operations.update_vulnerability(targets)
-        db_operations.update_threat(targets)
+        process_targets(targets)
     except Exception as e:
         logging.error(f'[Consumer] Error processing message: {e}')
 
 
+def process_targets(targets):
+    # pick up whatever the refresher finished since the last batch
+    index = cve_lookup.swap_index()
+    with index.snapshot():
+        db_operations.update_results(targets)
+    logging.info(f'[Consumer] CVE match cache: {matcher.pool.cache_stats()}')
+
+
 def get_batches():
     try:
         connection = pika.BlockingConnection(
@@ -138,6 +138,12 @@ CELERY_BEAT_SCHEDULE = {
         "schedule": 24 * 30,
         "args": (),
     },
+    # incremental: each run only reads the hosts written since the last one
+    "facet-rollups": {
+        "task": "api_applications.search.tasks.update_facet_rollups_task",
+        "schedule": int(os.getenv("FACET_ROLLUP_INTERVAL", "300")),
+        "args": (),
+    },
 }
 
 PAYMENT_PROVIDERS = {
@@ -26,6 +26,7 @@ urlpatterns = [
     path("account/auth/", include("dj_rest_auth.urls")),
     path("account/", include("api_applications.accounts.urls")),
     path("account/scan/", include("api_applications.scan.urls")),
+    path("search/", include("api_applications.search.urls")),
 
     path("account/billing/", include("api_applications.billing.urls")),
     path("account/tickets/", include("api_applications.tickets.urls")),